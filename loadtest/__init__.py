@@ -0,0 +1 @@
+"""插件端到端压测：替身 AstrBot（fake_astrbot）、替身 picapi（stub_picapi）与并发会话驱动（run）"""
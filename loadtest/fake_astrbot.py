@@ -0,0 +1,124 @@
+"""
+替身 astrbot.api：只实现 main.py 用到的那一小块，让插件脱离真实机器人也能被导入和驱动。
+
+    from loadtest import fake_astrbot
+    fake_astrbot.install()      # 必须在 import main 之前
+    import main
+
+- filter.command / filter.regex 原样返回被装饰的函数，指令直接当异步生成器调用
+- AstrMessageEvent 记下会话 ID 与消息文本；plain_result / image_result / chain_result 返回 Result
+- 已经装过真的 astrbot 时 install() 什么也不做（除非 force=True）
+"""
+import logging
+import sys
+import types
+from dataclasses import dataclass, field
+from typing import Any, List
+
+
+@dataclass
+class Result:
+    kind: str                  # plain / image / chain
+    payload: Any
+
+    @property
+    def text(self) -> str:
+        if self.kind == "plain":
+            return self.payload
+        if self.kind == "chain":
+            return "\n".join(c.text for c in self.payload if isinstance(c, Plain))
+        return ""
+
+
+class Plain:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class Image:
+    def __init__(self, src: str, data: bytes = b""):
+        self.src = src
+        self.size = len(data)
+
+    @classmethod
+    def fromURL(cls, url: str):
+        return cls(url)
+
+    @classmethod
+    def fromFileSystem(cls, path: str):
+        return cls(path)
+
+    @classmethod
+    def fromBytes(cls, data: bytes):
+        return cls("bytes", data)
+
+
+class AstrMessageEvent:
+    def __init__(self, session: str, message_str: str = "", message_type: str = "group"):
+        self.unified_msg_origin = session
+        self.message_str = message_str
+        self.message_type = message_type
+
+    def plain_result(self, text: str) -> Result:
+        return Result("plain", text)
+
+    def image_result(self, url_or_path: str) -> Result:
+        return Result("image", url_or_path)
+
+    def chain_result(self, chain: List[Any]) -> Result:
+        return Result("chain", chain)
+
+
+class _Filter:
+    def command(self, *_a, **_kw):
+        return lambda fn: fn
+
+    def regex(self, *_a, **_kw):
+        return lambda fn: fn
+
+    def __getattr__(self, _name):
+        return lambda *_a, **_kw: (lambda fn: fn)
+
+
+@dataclass
+class Context:
+    config: dict = field(default_factory=dict)
+
+
+class Star:
+    def __init__(self, context: Context):
+        self.context = context
+
+
+def register(*_a, **_kw):
+    return lambda cls: cls
+
+
+logger = logging.getLogger("astrbot")
+
+
+def install(force: bool = False) -> bool:
+    """把替身注册进 sys.modules；返回是否真的装了"""
+    if "astrbot.api" in sys.modules and not force:
+        return False
+    root = types.ModuleType("astrbot")
+    api = types.ModuleType("astrbot.api")
+    event = types.ModuleType("astrbot.api.event")
+    star = types.ModuleType("astrbot.api.star")
+    comps = types.ModuleType("astrbot.api.message_components")
+
+    api.logger = logger
+    event.filter = _Filter()
+    event.AstrMessageEvent = AstrMessageEvent
+    star.Context, star.Star, star.register = Context, Star, register
+    comps.Plain, comps.Image = Plain, Image
+    root.api, api.event, api.star, api.message_components = api, event, star, comps
+
+    sys.modules.update({
+        "astrbot": root,
+        "astrbot.api": api,
+        "astrbot.api.event": event,
+        "astrbot.api.star": star,
+        "astrbot.api.message_components": comps,
+    })
+    return True
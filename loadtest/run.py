@@ -0,0 +1,370 @@
+"""
+插件端到端压测：替身 AstrBot 里加载 main.py 的 PicRater，用几百个并发模拟会话轮流发指令。
+
+    python -m loadtest.run --sessions 300 --duration 60 --out load.json            # 自带替身 picapi
+    python -m loadtest.run --picapi http://127.0.0.1:8000 --clean-ratio 0          # 打真实 picapi
+
+每个会话：思考一会（指数分布，均值 --think 秒）→ 按权重挑一条指令 → 把指令的异步生成器跑完。
+记录每条指令的耗时分布（首条回复 / 全部回复）与失败数；另有后台任务每 --sample 秒采一次：
+事件循环延迟、本进程打开的 socket 数、插件连接池里的连接数、last_sent / 响应缓存的条目数与估算体积、RSS。
+--churn 让一部分指令来自全新的会话（新群/新私聊），用来观察 last_sent 随时间的增长。
+
+替身 picapi 跑在子进程里，这样 socket 计数和事件循环延迟只反映插件这一侧。
+--stub-slow-* / --stub-fail-ratio / --stub-outage-* 让替身注入慢请求、503 和一段故障窗口，
+用来看插件的延迟预算、对冲、熔断和降级：回复以 ⚠️ 开头的算 stale（用旧数据顶上），🚦/⌛ 开头的算 busy。
+
+插件自己的准入控制（会话/用户令牌桶、进行中上限）默认关掉：200 个会话每秒一条远超每会话 20 次/分钟，
+不关的话测的是限流器而不是插件和 picapi。要连准入一起测加 --admission（按插件默认值，环境变量照样能覆盖）；
+被准入拒掉的（“发得太快了”“请求太多了”，以及等待期内不回复的）单独算 rejected。
+
+    python -m loadtest.run --stub-slow-ratio 0.05 --stub-slow-ms 4000 --stub-outage-at 10 --stub-outage-s 15
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from . import fake_astrbot
+
+ROOT = Path(__file__).resolve().parent.parent
+FAIL_PREFIXES = ("发图失败", "评分失败", "获取分类失败", "❌")
+REJECT_PREFIXES = ("⏸", "⏳", "🚦 现在处理的请求太多了")
+BUSY_PREFIXES = ("🚦", "⌛")
+STALE_PREFIXES = ("⚠️",)
+
+SEND_ARGS = ["", "", "", "风景", "人像:2,壁纸:1", "壁纸/sub1", "q:猫", "?sunset"]
+CAT_ARGS = ["", "", "风景", "动漫", "photos/sub3"]
+
+
+def summarize(samples_ms) -> dict:
+    s = sorted(samples_ms)
+    n = len(s)
+
+    def pct(p: float) -> float:
+        return round(s[min(n - 1, max(0, math.ceil(p / 100 * n) - 1))], 3) if n else 0.0
+
+    return {
+        "count": n,
+        "mean_ms": round(sum(s) / n, 3) if n else 0.0,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(s[-1], 3) if n else 0.0,
+    }
+
+
+def _open_sockets() -> int:
+    """本进程打开的 socket 数（Linux 读 /proc/self/fd；其他平台返回 -1）"""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return -1
+    n = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                n += 1
+        except OSError:
+            pass
+    return n
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576, 1)
+    except (OSError, ValueError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _deep_size(obj, seen=None) -> int:
+    """dict/list/tuple/str 的粗略递归体积（只为看增长趋势）"""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    return size
+
+
+def _pool_connections(plugin) -> int:
+    """插件共享 AsyncClient 的连接池里当前有多少连接（httpx/httpcore 内部结构，取不到返回 -1）"""
+    client = getattr(plugin, "_client", None)
+    if client is None or client.is_closed:
+        return 0
+    try:
+        return len(client._transport._pool.connections)
+    except AttributeError:
+        return -1
+
+
+class Recorder:
+    def __init__(self):
+        self.first_ms = {}
+        self.total_ms = {}
+        self.outcomes = {}
+        self.done = 0
+
+    def add(self, cmd: str, first_ms: float, total_ms: float, outcome: str):
+        self.first_ms.setdefault(cmd, []).append(first_ms)
+        self.total_ms.setdefault(cmd, []).append(total_ms)
+        oc = self.outcomes.setdefault(cmd, {})
+        oc[outcome] = oc.get(outcome, 0) + 1
+        self.done += 1
+
+    def report(self) -> dict:
+        out = {}
+        for cmd in sorted(self.total_ms):
+            out[cmd] = {"outcomes": self.outcomes[cmd],
+                        "first_reply": summarize(self.first_ms[cmd]),
+                        "complete": summarize(self.total_ms[cmd])}
+        return out
+
+
+def _outcome(results) -> str:
+    texts = [r.text for r in results if r.text]
+    if any(t.startswith(FAIL_PREFIXES) for t in texts):
+        return "error"
+    if any(t.startswith(REJECT_PREFIXES) for t in texts):
+        return "rejected"
+    if any(t.startswith(BUSY_PREFIXES) for t in texts):
+        return "busy"
+    if any(t.startswith(STALE_PREFIXES) for t in texts):
+        return "stale"
+    if any(t.startswith("本会话还没有") for t in texts):
+        return "no_target"
+    return "ok" if results else "rejected"     # 什么都没回只有一种情况：准入拒绝且还在提示的等待期内
+
+
+async def run_command(plugin, cmd: str, event, text: str, rec: Recorder):
+    gen = {
+        "send_random": plugin.cmd_send_random,
+        "rate": plugin.cmd_rate,
+        "categories": plugin.cmd_categories,
+        "clean_gallery": plugin.cmd_clean_gallery,
+    }[cmd](event, text)
+    t0 = time.perf_counter()
+    first = None
+    results = []
+    try:
+        async for r in gen:
+            if first is None:
+                first = time.perf_counter()
+            results.append(r)
+        outcome = _outcome(results)
+    except Exception:
+        outcome = "exception"
+    t1 = time.perf_counter()
+    rec.add(cmd, ((first or t1) - t0) * 1000, (t1 - t0) * 1000, outcome)
+
+
+async def session(idx: int, plugin, args, stop_at: float, rec: Recorder, new_ids):
+    rng = random.Random(idx)
+    sid = f"loadtest:group:{idx}"
+    cmds = ["send_random", "rate", "categories", "clean_gallery"]
+    weights = [args.send_ratio, args.rate_ratio, args.cat_ratio, args.clean_ratio]
+    while True:
+        await asyncio.sleep(rng.expovariate(1 / args.think) if args.think > 0 else 0)
+        if time.monotonic() >= stop_at:
+            return
+        if rng.random() < args.churn:
+            sid = f"loadtest:group:{idx}:{next(new_ids)}"
+        cmd = rng.choices(cmds, weights)[0]
+        if cmd == "send_random":
+            text = rng.choice(SEND_ARGS)
+        elif cmd == "rate":
+            text = f"{rng.choice([1, 2, 3, 3.5, 4, 4.5, 5])}" + (" 压测" if rng.random() < 0.2 else "")
+        elif cmd == "categories":
+            text = rng.choice(CAT_ARGS)
+        else:
+            text = ""
+        await run_command(plugin, cmd, fake_astrbot.AstrMessageEvent(sid, text), text, rec)
+
+
+async def loop_lag_monitor(samples: list, stop: asyncio.Event, interval: float = 0.05):
+    """每 interval 秒醒一次，记录实际醒来比预期晚了多少毫秒"""
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, (time.perf_counter() - t0 - interval) * 1000))
+
+
+async def sampler(plugin, rec: Recorder, lag: list, timeline: list, stop: asyncio.Event, every: float):
+    t_start = time.monotonic()
+    last_done, last_lag = 0, 0
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=every)
+        except asyncio.TimeoutError:
+            pass
+        window = lag[last_lag:]
+        last_lag = len(lag)
+        timeline.append({
+            "t": round(time.monotonic() - t_start, 1),
+            "commands_per_s": round((rec.done - last_done) / every, 1),
+            "loop_lag_max_ms": round(max(window), 2) if window else 0.0,
+            "open_sockets": _open_sockets(),
+            "pool_connections": _pool_connections(plugin),
+            "last_sent_entries": len(plugin.last_sent),
+            "last_sent_kb": round(_deep_size(plugin.last_sent) / 1024, 1),
+            "resp_cache_entries": len(plugin._resp_cache),
+            "rss_mb": _rss_mb(),
+        })
+        last_done = rec.done
+
+
+def _growth(timeline: list, key: str) -> float:
+    """最小二乘斜率，单位：每分钟"""
+    pts = [(p["t"], p[key]) for p in timeline]
+    if len(pts) < 2:
+        return 0.0
+    mx = sum(t for t, _ in pts) / len(pts)
+    my = sum(v for _, v in pts) / len(pts)
+    den = sum((t - mx) ** 2 for t, _ in pts)
+    return round(sum((t - mx) * (v - my) for t, v in pts) / den * 60, 2) if den else 0.0
+
+
+def _start_stub(args):
+    cmd = [sys.executable, "-m", "loadtest.stub_picapi", "--port", "0",
+           "--latency-ms", str(args.stub_latency_ms), "--jitter-ms", str(args.stub_jitter_ms),
+           "--maintenance-s", str(args.stub_maintenance_s),
+           "--slow-ratio", str(args.stub_slow_ratio), "--slow-ms", str(args.stub_slow_ms),
+           "--fail-ratio", str(args.stub_fail_ratio), "--outage-at", str(args.stub_outage_at),
+           "--outage-s", str(args.stub_outage_s), "--outage-mode", args.stub_outage_mode]
+    proc = subprocess.Popen(cmd, cwd=str(ROOT), stdout=subprocess.PIPE, text=True)
+    url = proc.stdout.readline().strip()
+    if not url.startswith("http"):
+        proc.kill()
+        raise SystemExit("[loadtest] stub picapi did not start")
+    return proc, url
+
+
+async def run(args) -> dict:
+    import main   # 替身 astrbot 已经装好；环境变量也已就位
+
+    plugin = main.PicRater(fake_astrbot.Context())
+    rec = Recorder()
+    lag, timeline = [], []
+    stop = asyncio.Event()
+    monitors = [asyncio.create_task(loop_lag_monitor(lag, stop)),
+                asyncio.create_task(sampler(plugin, rec, lag, timeline, stop, args.sample))]
+    stop_at = time.monotonic() + args.duration
+    new_ids = itertools.count(1)
+    t0 = time.perf_counter()
+    # 会话在一个思考时间内错开上线，避免第一秒齐刷刷打过去
+    await asyncio.gather(*(session(i, plugin, args, stop_at, rec, new_ids) for i in range(args.sessions)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await asyncio.gather(*monitors)
+    # 压测结束后用 #图库状态 把插件自己的指标也跑一遍（同时验证这条指令本身）
+    status = [r.text async for r in plugin.cmd_gallery_status(fake_astrbot.AstrMessageEvent("loadtest:admin"), "")]
+    await plugin.terminate()
+
+    return {
+        "commands": rec.report(),
+        "throughput_cmd_per_s": round(rec.done / wall, 1) if wall > 0 else None,
+        "loop_lag": summarize(lag),
+        "growth_per_min": {k: _growth(timeline, k) for k in ("last_sent_entries", "last_sent_kb", "rss_mb")},
+        "plugin_metrics": plugin._metrics.snapshot(),
+        "status_text": "\n".join(status),
+        "timeline": timeline,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="end-to-end load test for the PicRater plugin")
+    ap.add_argument("--picapi", default="", help="真实 picapi 地址（可逗号分隔多个）；不给则启动替身")
+    ap.add_argument("--sessions", type=int, default=200, help="并发模拟会话数")
+    ap.add_argument("--duration", type=float, default=30.0, help="压测时长（秒）")
+    ap.add_argument("--think", type=float, default=1.0, help="会话两条指令之间的平均间隔（秒）")
+    ap.add_argument("--churn", type=float, default=0.02, help="每条指令换成全新会话 ID 的概率")
+    ap.add_argument("--send-ratio", type=float, default=0.5)
+    ap.add_argument("--rate-ratio", type=float, default=0.35)
+    ap.add_argument("--cat-ratio", type=float, default=0.15)
+    ap.add_argument("--clean-ratio", type=float, default=0.002, help="#整理图库 的权重（对真实 picapi 会真的扫盘）")
+    ap.add_argument("--sample", type=float, default=1.0, help="采样间隔（秒）")
+    ap.add_argument("--local-cache", action="store_true", help="打开插件的本地图片缓存（放临时目录）")
+    ap.add_argument("--stub-latency-ms", type=float, default=5.0)
+    ap.add_argument("--stub-jitter-ms", type=float, default=5.0)
+    ap.add_argument("--stub-maintenance-s", type=float, default=3.0)
+    ap.add_argument("--stub-slow-ratio", type=float, default=0.0, help="替身：多大比例的请求额外慢 --stub-slow-ms")
+    ap.add_argument("--stub-slow-ms", type=float, default=3000.0)
+    ap.add_argument("--stub-fail-ratio", type=float, default=0.0, help="替身：多大比例的请求回 503")
+    ap.add_argument("--stub-outage-at", type=float, default=0.0, help="替身：故障窗口从启动后第几秒开始")
+    ap.add_argument("--stub-outage-s", type=float, default=0.0, help="替身：故障窗口持续几秒（0 = 没有）")
+    ap.add_argument("--stub-outage-mode", choices=("hang", "fail"), default="hang")
+    ap.add_argument("--out", default="", help="结果 JSON 路径；不给则打印到标准输出")
+    ap.add_argument("--admission", action="store_true", help="保留插件的准入控制默认值（限流 / 进行中上限）；默认全部放开")
+    ap.add_argument("--verbose", action="store_true", help="打印插件自己的日志（失败时每条都会打）")
+    args = ap.parse_args()
+
+    fake_astrbot.install()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, stream=sys.stderr)
+    stub = None
+    if args.picapi:
+        url = args.picapi
+        if args.clean_ratio > 0:
+            print("[loadtest] 注意：--clean-ratio > 0 会让真实 picapi 扫盘入库", file=sys.stderr)
+    else:
+        stub, url = _start_stub(args)
+    os.environ["PICAPI_URL"] = url
+    if not args.admission:
+        for k, v in (("PICRATER_SESSION_RPM", "0"), ("PICRATER_USER_RPM", "0"), ("PICRATER_WRITE_RPM", "0"),
+                     ("PICRATER_MAX_INFLIGHT", "0")):
+            os.environ.setdefault(k, v)
+    if args.local_cache:
+        os.environ["PICRATER_LOCAL_CACHE"] = "1"
+        os.environ["PICRATER_CACHE_DIR"] = tempfile.mkdtemp(prefix="picrater-cache-")
+    sys.path.insert(0, str(ROOT))
+
+    print(f"[loadtest] {args.sessions} sessions × {args.duration:g}s against {url}", file=sys.stderr)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait(5)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "picapi": url if args.picapi else f"stub ({args.stub_latency_ms:g}±{args.stub_jitter_ms:g} ms)",
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "picapi")},
+        },
+        **result,
+    }
+    for cmd, r in report["commands"].items():
+        c = r["complete"]
+        print(f"[loadtest] {cmd:<14} n={c['count']:<6} p50={c['p50_ms']:>8.1f}ms p95={c['p95_ms']:>8.1f}ms "
+              f"p99={c['p99_ms']:>8.1f}ms  {r['outcomes']}", file=sys.stderr)
+    print(f"[loadtest] loop lag p99={report['loop_lag']['p99_ms']:.1f}ms max={report['loop_lag']['max_ms']:.1f}ms; "
+          f"last_sent +{report['growth_per_min']['last_sent_entries']}/min", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+        print(f"[loadtest] wrote {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+替身 picapi：只用标准库，回插件会调的那几个接口，数据是内存里的假图库。
+
+    python -m loadtest.stub_picapi --port 8900 --latency-ms 5 --jitter-ms 10
+
+- /random_pic /random_pics /similar /rate /categories /dirs /tags /stats /reindex /sync_subjects /admin/sync_progress /admin/status
+- /categories、/dirs、/tags、/stats 带 ETag（"gen-N"），/rate 之后代数 +1，和真服务一样回 304
+- /reindex 与 /sync_subjects 按 --maintenance-s 慢慢推进进度；同时只允许一个，第二个回 409
+- /static/... /deriv/... 回一小段固定字节，插件开本地缓存时也能走下载路径
+- 每个请求先睡 latency ± jitter 毫秒（在请求线程里），模拟服务端处理耗时
+- 和真服务一样回显 X-Request-ID；/admin/status 里的 requests_with_rid 用来核对插件有没有带上
+- 故障注入（不影响 /health 与 /admin/*）：--slow-ratio 的请求额外睡 --slow-ms，--fail-ratio 的请求回 503；
+  --outage-at/--outage-s 给一个故障窗口，窗口内 --outage-mode=hang 的请求一直挂到窗口结束（模拟卡在长同步里），
+  fail 的直接回 503
+
+    python -m loadtest.stub_picapi --slow-ratio 0.05 --slow-ms 4000 --outage-at 10 --outage-s 20
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CATS = ["风景", "人像", "壁纸", "动漫", "photos", "misc"]
+_IMG = b"\xff\xd8\xff\xe0" + bytes(2048) + b"\xff\xd9"
+
+
+class StubState:
+    def __init__(self, images: int, latency_ms: float, jitter_ms: float, maintenance_s: float,
+                 slow_ratio: float = 0.0, slow_ms: float = 0.0, fail_ratio: float = 0.0,
+                 outage_at: float = 0.0, outage_s: float = 0.0, outage_mode: str = "hang"):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.maintenance_s = maintenance_s
+        self.slow_ratio = slow_ratio
+        self.slow = slow_ms / 1000
+        self.fail_ratio = fail_ratio
+        self.outage = (outage_at, outage_at + outage_s) if outage_s > 0 else None
+        self.outage_mode = outage_mode
+        self.faults = {"slow": 0, "fail": 0, "outage": 0}
+        self.lock = threading.Lock()
+        self.gen = 1
+        self.images = [f"{CATS[i % len(CATS)]}/sub{i % 7}/img_{i:06d}.jpg" for i in range(images)]
+        self.known = set(self.images)
+        self.by_id = {self.item_id(r): r for r in self.images}
+        self.ratings = {}                        # relpath -> [cnt, sum]
+        self.job = None                          # (name, t0, total)
+        self.requests = 0
+        self.requests_with_rid = 0
+        self.t0 = time.monotonic()
+
+    def pause(self):
+        d = self.latency + random.uniform(-self.jitter, self.jitter)
+        if d > 0:
+            time.sleep(d)
+
+    def fault(self, path: str) -> bool:
+        """先 pause()，再按注入的故障多睡一会；返回 True 表示这次该回 503"""
+        self.pause()
+        if path == "/health" or path.startswith("/admin/"):
+            return False
+        now = time.monotonic() - self.t0
+        if self.outage and self.outage[0] <= now < self.outage[1]:
+            with self.lock:
+                self.faults["outage"] += 1
+            if self.outage_mode == "fail":
+                return True
+            time.sleep(self.outage[1] - now)
+            return False
+        if random.random() < self.fail_ratio:
+            with self.lock:
+                self.faults["fail"] += 1
+            return True
+        if random.random() < self.slow_ratio:
+            with self.lock:
+                self.faults["slow"] += 1
+            time.sleep(self.slow)
+        return False
+
+    @staticmethod
+    def item_id(rel: str) -> str:
+        return f"h{zlib.crc32(rel.encode()):08x}"
+
+    def item(self, rel: str) -> dict:
+        cnt, total = self.ratings.get(rel, (0, 0.0))
+        return {"id": self.item_id(rel), "relpath": rel, "filename": rel.rsplit("/", 1)[-1],
+                "category": rel.split("/", 1)[0], "url": f"/static/{rel}", "orig_url": f"/static/{rel}",
+                "count": cnt, "avg": round(total / cnt, 2) if cnt else 0.0}
+
+    def pick(self, q: dict, n: int):
+        pool = self.images
+        cat = (q.get("cat") or "").split(":")[0].split(",")[0].strip("/")
+        if cat:
+            pool = [p for p in pool if p.startswith(cat + "/")]
+        if q.get("q") or q.get("tag"):
+            # 假装只有约一半的关键词/标签表达式能命中
+            pool = pool if zlib.crc32((q.get("q") or q["tag"]).encode()) % 2 == 0 else []
+        return random.sample(pool, min(n, len(pool)))
+
+    def job_progress(self):
+        """维护任务的进度：(name, done, total, finished)"""
+        if not self.job:
+            return None
+        name, t0, total = self.job
+        frac = min(1.0, (time.monotonic() - t0) / self.maintenance_s) if self.maintenance_s > 0 else 1.0
+        return name, int(total * frac), total, frac >= 1.0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive，插件的连接池才有意义
+    state: StubState = None
+
+    def log_message(self, *_a):
+        pass
+
+    def _send(self, code: int, body=None, etag: str = "", ctype: str = "application/json"):
+        data = b"" if body is None else (body if isinstance(body, bytes) else
+                                         json.dumps(body, ensure_ascii=False).encode("utf-8"))
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        if etag:
+            self.send_header("ETag", etag)
+        rid = self.headers.get("X-Request-ID")
+        if rid:
+            self.send_header("X-Request-ID", rid)
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def _cached(self, body_fn):
+        etag = f'"gen-{self.state.gen}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, etag=etag)
+        return self._send(200, body_fn(), etag=etag)
+
+    def do_GET(self):
+        st = self.state
+        u = urlparse(self.path)
+        q = {k: v[-1] for k, v in parse_qs(u.query).items()}
+        with st.lock:
+            st.requests += 1
+            st.requests_with_rid += bool(self.headers.get("X-Request-ID"))
+        p = u.path
+        if st.fault(p):
+            return self._send(503, {"detail": "injected fault"})
+        if p.startswith("/static/") or p.startswith("/deriv/"):
+            return self._send(200, _IMG, ctype="image/jpeg")
+        if p == "/random_pic":
+            got = st.pick(q, 1)
+            return self._send(200, st.item(got[0])) if got else self._send(404, {"detail": "no match"})
+        if p == "/random_pics":
+            got = st.pick(q, max(1, min(int(q.get("n", 1)), 50)))
+            return self._send(200, {"items": [st.item(r) for r in got]}) if got else self._send(404, {"detail": "no match"})
+        if p == "/similar":
+            rel = q.get("id", "") if q.get("id", "") in st.known else st.by_id.get(q.get("id", ""))
+            if rel is None:
+                return self._send(404, {"detail": "image id not found"})
+            # 假装同一子目录里的图彼此相似
+            near = [r for r in st.images if r.rsplit("/", 1)[0] == rel.rsplit("/", 1)[0] and r != rel]
+            near = random.sample(near, min(int(q.get("limit", 10)), len(near)))
+            items = [dict(st.item(r), distance=d, dup=d <= 4) for d, r in sorted((random.randint(1, 12), r) for r in near)]
+            return self._send(200, {"query": {"id": st.item_id(rel), "relpath": rel}, "count": len(items), "items": items})
+        if p == "/categories":
+            return self._cached(lambda: {"categories": CATS})
+        if p == "/dirs":
+            base = (q.get("path") or "").strip("/")
+            subs = sorted({r[len(base) + 1:].split("/", 1)[0] for r in st.images
+                           if r.startswith(base + "/") and r.count("/") > base.count("/") + 1})
+            return self._cached(lambda: {"base": base, "files_here": 0,
+                                         "dirs": [{"name": s, "path": f"{base}/{s}", "count": len(st.images) // 40}
+                                                  for s in subs]})
+        if p == "/tags":
+            pre = (q.get("prefix") or "").lower()
+            return self._cached(lambda: {"prefix": pre, "tags": [{"tag": c, "count": len(st.images) // len(CATS)}
+                                                                 for c in CATS if c.lower().startswith(pre)]
+                                         [:int(q.get("limit", 20))]})
+        if p == "/stats":
+            return self._cached(lambda: {"top": [dict(st.item(r), cnt=c, bayes=0.0)
+                                                 for r, (c, _s) in list(st.ratings.items())[:int(q.get("top", 10))]]})
+        if p == "/admin/sync_progress":
+            with st.lock:
+                prog = st.job_progress()
+            if not prog:
+                return self._send(200, {"running": False, "done": 0, "total": 0})
+            return self._send(200, {"running": not prog[3], "job": prog[0], "done": prog[1], "total": prog[2]})
+        if p == "/admin/status":
+            with st.lock:
+                prog = st.job_progress()
+            job = {"phase": prog[0] if prog and not prog[3] else "idle",
+                   "total": prog[2] if prog else 0, "done": prog[1] if prog else 0}
+            return self._send(200, {"role": "stub", "pid": os.getpid(), "uptime_s": int(time.monotonic() - st.t0),
+                                    "images": len(st.images), "in_flight": 0, "requests": st.requests,
+                                    "requests_with_rid": st.requests_with_rid, "faults": dict(st.faults),
+                                    "errors_5xx": 0, "slow_routes": [], "job": job, "watch": {"mode": "off"}})
+        if p in ("/health", "/admin/replica"):
+            return self._send(200, {"ok": True, "images": len(st.images)})
+        return self._send(404, {"detail": "not found"})
+
+    def do_POST(self):
+        st = self.state
+        u = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        with st.lock:
+            st.requests += 1
+            st.requests_with_rid += bool(self.headers.get("X-Request-ID"))
+        if st.fault(u.path):
+            return self._send(503, {"detail": "injected fault"})
+        if u.path == "/rate":
+            try:
+                body = json.loads(raw or b"{}")
+                score = float(body["score"])
+            except (ValueError, KeyError, TypeError):
+                return self._send(422, {"detail": "bad body"})
+            ident = str(body.get("id") or "")
+            rel = ident if ident in st.known else st.by_id.get(ident)
+            if rel is None:
+                return self._send(404, {"detail": "image not found"})
+            with st.lock:
+                cnt, total = st.ratings.get(rel, (0, 0.0))
+                st.ratings[rel] = (cnt + 1, total + score)
+                st.gen += 1
+            return self._send(200, {"ok": True, "count": cnt + 1, "avg": round((total + score) / (cnt + 1), 2)})
+        if u.path in ("/reindex", "/sync_subjects"):
+            return self._maintenance(u.path.strip("/"))
+        if u.path == "/admin/rebuild_fts":
+            return self._send(200, {"ok": True})
+        return self._send(404, {"detail": "not found"})
+
+    def _maintenance(self, name: str):
+        st = self.state
+        with st.lock:
+            prog = st.job_progress()
+            busy = bool(prog and not prog[3])
+            if not busy:
+                st.job = (name, time.monotonic(), len(st.images))
+        if busy:
+            return self._send(409, {"detail": f"{prog[0]} running"})
+        # 和真服务一样同步执行：请求一直挂着直到做完
+        time.sleep(st.maintenance_s)
+        with st.lock:
+            st.gen += 1
+        if name == "reindex":
+            return self._send(200, {"indexed": len(st.images), "purged": None, "moved": 0})
+        return self._send(200, {"processed": len(st.images)})
+
+
+def serve(port: int = 0, host: str = "127.0.0.1", images: int = 5000, latency_ms: float = 5.0,
+          jitter_ms: float = 5.0, maintenance_s: float = 3.0, **faults) -> ThreadingHTTPServer:
+    """启动替身服务（不阻塞，跑在后台线程里）；faults 是 StubState 的故障注入参数；返回 server，server.server_port 是实际端口"""
+    handler = type("StubHandler", (Handler,), {"state": StubState(images, latency_ms, jitter_ms, maintenance_s, **faults)})
+    srv = ThreadingHTTPServer((host, port), handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="stub-picapi", daemon=True).start()
+    return srv
+
+
+def main():
+    ap = argparse.ArgumentParser(description="stand-in picapi for plugin load tests")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--images", type=int, default=5000)
+    ap.add_argument("--latency-ms", type=float, default=5.0)
+    ap.add_argument("--jitter-ms", type=float, default=5.0)
+    ap.add_argument("--maintenance-s", type=float, default=3.0, help="reindex / sync_subjects 各耗时多少秒")
+    ap.add_argument("--slow-ratio", type=float, default=0.0, help="多大比例的请求额外睡 --slow-ms")
+    ap.add_argument("--slow-ms", type=float, default=3000.0)
+    ap.add_argument("--fail-ratio", type=float, default=0.0, help="多大比例的请求直接回 503")
+    ap.add_argument("--outage-at", type=float, default=0.0, help="故障窗口从启动后第几秒开始")
+    ap.add_argument("--outage-s", type=float, default=0.0, help="故障窗口持续几秒；0 = 没有")
+    ap.add_argument("--outage-mode", choices=("hang", "fail"), default="hang",
+                    help="hang：请求挂到窗口结束；fail：回 503")
+    args = ap.parse_args()
+    srv = serve(args.port, args.host, args.images, args.latency_ms, args.jitter_ms, args.maintenance_s,
+                slow_ratio=args.slow_ratio, slow_ms=args.slow_ms, fail_ratio=args.fail_ratio,
+                outage_at=args.outage_at, outage_s=args.outage_s, outage_mode=args.outage_mode)
+    print(f"http://{args.host}:{srv.server_port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,610 @@
 from typing import Dict, Any, Optional
+from collections import OrderedDict, deque
 import os
 
 from astrbot.api import logger
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
+import astrbot.api.message_components as Comp
 import re
-import asyncio, time, httpx
+import bisect
+import asyncio, time, httpx, random
 import contextlib  # new: _wait_with_progress 里用到了 suppress
+import contextvars, functools, hashlib, uuid
+import tempfile, threading
 
 
 _CAT_HINT_RE = re.compile(r"[,:/]")
+# “#来N张 [参数]”：唤醒符可能已被框架剥掉，这里两种都认
+_BATCH_CMD_RE = re.compile(r"^[#/]?\s*来\s*(\d{1,2})\s*张(?:\s+(.*))?$", re.S)
+BATCH_MAX = int(os.getenv("PICRATER_BATCH_MAX", "9"))
+# “#来一张 相似”：以本会话上一张图为查询，从 picapi 的 /similar 里挑一张
+_SIMILAR_ARGS = {"相似", "类似", "相似的", "类似的", "like"}
+# 按会话不重复出图（picapi 的 scope 游标）；设为 0 则恢复纯随机/少评优先
+NO_REPEAT = os.getenv("PICRATER_NO_REPEAT", "1").lower() in {"1", "true", "yes"}
+# picapi 的派生图预设（如 chat / thumb）：发压缩版而不是原图；空=原图
+IMAGE_PRESET = os.getenv("PICRATER_PRESET", "chat").strip()
+# 本地图片缓存：开启后插件先把图下载到本地（按图片 ID 做 LRU），再把本地文件交给平台发送
+LOCAL_CACHE = os.getenv("PICRATER_LOCAL_CACHE", "0").lower() in {"1", "true", "yes"}
+LOCAL_CACHE_DIR = os.getenv("PICRATER_CACHE_DIR", os.path.join("data", "pic_rater_cache"))
+LOCAL_CACHE_MB = float(os.getenv("PICRATER_CACHE_MB", "512"))
+# 指令总耗时超过这么多秒打一条 WARNING（带请求 ID 与 picapi/发送耗时拆分）；0 = 不打
+SLOW_LOG_S = float(os.getenv("PICRATER_SLOW_LOG", "3"))
+# 准入控制：每个会话 / 每个用户一个令牌桶（每分钟回多少个、最多攒几个；0 = 不限），全局同时处理的指令上限
+SESSION_RPM = float(os.getenv("PICRATER_SESSION_RPM", "20"))
+SESSION_BURST = int(os.getenv("PICRATER_SESSION_BURST", "5"))
+USER_RPM = float(os.getenv("PICRATER_USER_RPM", "10"))
+USER_BURST = int(os.getenv("PICRATER_USER_BURST", "3"))
+# 写指令（#评分）按用户单独一个桶：连着给一批图打分不和抽图抢令牌
+WRITE_RPM = float(os.getenv("PICRATER_WRITE_RPM", "60"))
+WRITE_BURST = int(os.getenv("PICRATER_WRITE_BURST", "20"))
+MAX_INFLIGHT = int(os.getenv("PICRATER_MAX_INFLIGHT", "16"))
+# 尾延迟保护：每个读接口一个总预算（秒，含对冲与换端点重试）；超了就放弃，能降级的用缓存/最近的图顶上
+# PICRATER_BUDGETS 按 "接口=秒" 逗号分隔覆盖，例如 "/random_pic=3,/dirs=10"；没列出的接口用 PICRATER_BUDGET_DEFAULT
+_BUDGETS = {"/random_pic": 5.0, "/random_pics": 10.0, "/similar": 5.0, "/categories": 4.0, "/dirs": 5.0,
+            "/tags": 4.0, "/stats": 8.0, "/stats/hist": 5.0, "/stats/rollup": 8.0}
+for _kv in os.getenv("PICRATER_BUDGETS", "").split(","):
+    _ep, _, _sec = _kv.partition("=")
+    with contextlib.suppress(ValueError):
+        _BUDGETS[_ep.strip()] = float(_sec)
+BUDGET_DEFAULT = float(os.getenv("PICRATER_BUDGET_DEFAULT", "10"))
+# 对冲：读请求超过该接口最近 p95 延迟（至少 HEDGE_MIN_MS）还没回，就再发一份（有别的端点优先发别的），谁先回用谁；
+# 带 scope 的随机图不对冲（两份都会推进会话游标）
+HEDGE = os.getenv("PICRATER_HEDGE", "1").lower() in {"1", "true", "yes"}
+HEDGE_MIN_MS = float(os.getenv("PICRATER_HEDGE_MIN_MS", "300"))
+# 熔断：某个端点连续失败（连不上 / 5xx / 超预算）这么多次就断开，BREAKER_OPEN_S 秒后放一个探测请求试试；
+# 503 + Retry-After 是 picapi 的准入背压，不算失败，只在它要求的秒数内不往那个端点发（最多 BACKOFF_MAX_S）
+BREAKER_FAILS = int(os.getenv("PICRATER_BREAKER_FAILS", "5"))
+BREAKER_OPEN_S = float(os.getenv("PICRATER_BREAKER_OPEN_S", "30"))
+BACKOFF_MAX_S = float(os.getenv("PICRATER_BACKOFF_MAX_S", "60"))
+# 降级时从最近发过的这么多张图里随机挑
+STALE_RECENT = int(os.getenv("PICRATER_STALE_RECENT", "200"))
+
+
+class _ImageByteCache:
+    """
+    按图片 ID（+ 预设）落盘的 LRU：总字节数超过上限时从最久未用的开始删。
+    索引只在内存里，启动时按文件 mtime 从旧到新重建；命中时 touch 一下，重启后顺序也不丢。
+    store 在工作线程里跑（可能几个并发），lookup 在事件循环里：索引和计数都在 self.lock 下改，
+    落盘写各自的临时文件再 rename，淘汰的文件出了锁再删。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index: "OrderedDict[str, int]" = OrderedDict()   # 文件名 -> 字节数
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        entries = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            with contextlib.suppress(OSError):
+                if name.endswith(".tmp"):        # 上次没写完的
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.index[name] = size
+            self.total += size
+
+    @staticmethod
+    def key_for(iid: str, preset: str, url: str) -> str:
+        ext = os.path.splitext(url.split("?", 1)[0])[1].lower() or ".img"
+        safe = re.sub(r"[^0-9A-Za-z_-]", "_", f"{iid}_{preset or 'orig'}")
+        return safe + (ext if len(ext) <= 6 else ".img")
+
+    def lookup(self, name: str) -> Optional[str]:
+        path = os.path.join(self.root, name)
+        with self.lock:
+            size = self.index.get(name)
+            if size is None or not os.path.exists(path):
+                self.misses += 1
+                return None
+            self.index.move_to_end(name)
+            self.hits += 1
+            self.bytes_saved += size
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return path
+
+    def store(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.root, name)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=f"{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+        evicted = []
+        with self.lock:
+            self.total += len(data) - self.index.pop(name, 0)
+            self.index[name] = len(data)
+            self.bytes_fetched += len(data)
+            while self.total > self.max_bytes and len(self.index) > 1:
+                old, size = self.index.popitem(last=False)
+                self.total -= size
+                evicted.append(old)
+        for old in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.root, old))
+        return path
+
+    def stats(self) -> dict:
+        with self.lock:
+            return self._stats()
+
+    def _stats(self) -> dict:
+        looked = self.hits + self.misses
+        return {
+            "files": len(self.index), "bytes": self.total, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses,
+            "hit_ratio": round(self.hits / looked, 3) if looked else 0.0,
+            "bytes_saved": self.bytes_saved, "bytes_fetched": self.bytes_fetched,
+        }
+
+class _ReadEndpoints:
+    """
+    PICAPI_URL 写多个地址时的读请求路由：按 EWMA 延迟挑最快的端点，偶尔随机探测一下别的；
+    连不上/5xx 的端点冷却一段时间不参与选择。写请求和维护任务始终走第一个（primary）。
+    带会话游标（scope）的随机图例外：游标存在各实例自己的 state.sqlite 里，同一个 scope 要一直打到同一个端点，
+    否则一个会话的游标被拆成几份、图会重复。用 rendezvous 哈希定“家”端点，它不可用时顺延到下一个。
+    """
+
+    def __init__(self, urls, alpha: float = 0.3, explore: float = 0.05, cooldown: float = 30.0):
+        self.urls = list(urls)
+        self.alpha = alpha
+        self.explore = explore
+        self.cooldown = cooldown
+        self.ewma = {u: 0.0 for u in self.urls}        # 0 = 还没测过，优先试一次
+        self.down_until = {u: 0.0 for u in self.urls}
+
+    def pick(self, exclude=()) -> str:
+        now = time.monotonic()
+        cands = [u for u in self.urls if u not in exclude] or self.urls
+        live = [u for u in cands if self.down_until[u] <= now] or cands
+        if len(live) > 1 and random.random() < self.explore:
+            return random.choice(live)
+        return min(live, key=lambda u: self.ewma[u])
+
+    def home(self, key: str, exclude=()) -> str:
+        """key（scope）的 rendezvous 哈希排序里第一个没被排除、没在冷却的端点；端点增减只影响落在它上面的 scope"""
+        now = time.monotonic()
+        cands = [u for u in self.urls if u not in exclude] or self.urls
+        live = [u for u in cands if self.down_until[u] <= now] or cands
+        return max(live, key=lambda u: hashlib.blake2b(f"{u}\n{key}".encode("utf-8"), digest_size=8).digest())
+
+    def observe(self, url: str, seconds: float, ok: bool = True):
+        if not ok:
+            self.down_until[url] = time.monotonic() + self.cooldown
+            return
+        prev = self.ewma[url]
+        self.ewma[url] = seconds if prev == 0 else prev + self.alpha * (seconds - prev)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {u: {"ewma_ms": round(self.ewma[u] * 1000, 1), "down": self.down_until[u] > now} for u in self.urls}
+
+
+class _CircuitOpen(httpx.TransportError):
+    """端点熔断中：没发请求就失败（是 TransportError，原有的“picapi 不可用”分支照样接得住）"""
+
+
+class _Backoff(httpx.TransportError):
+    """端点刚回过 503 + Retry-After、还在它要求的等待期内：没发请求就失败，retry_after 为还剩几秒"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(r) -> Optional[float]:
+    """503 + 数字 Retry-After（picapi 准入控制的背压）→ 秒数；其他响应返回 None"""
+    after = (r.headers.get("retry-after") or "").strip()
+    if r.status_code != 503 or not after.isdigit():
+        return None
+    return min(float(after), BACKOFF_MAX_S)
+
+
+class _CircuitBreaker:
+    """
+    单个端点的熔断器：closed → 连续失败 fails 次 → open（直接拒绝）→ open_s 秒后 half_open，
+    只放一个探测请求：成功回到 closed，失败再 open 一轮。只在事件循环里调用，不加锁。
+    Retry-After 退避按 picapi 的准入类别分开记（picks = 读，writes = 写）：抽图排满了不耽误评分，反过来也一样；
+    cls=None 表示不受准入控制的请求（静态图、/admin 查询），只看熔断状态。
+    """
+
+    def __init__(self, fails: int = 5, open_s: float = 30.0):
+        self.fails = max(1, fails)
+        self.open_s = open_s
+        self.state = "closed"
+        self.streak = 0            # 连续失败次数
+        self.opened_at = 0.0
+        self.opened = 0            # 累计断开次数
+        self.probing = False
+        self.busy_until: Dict[str, float] = {}   # 准入类别 -> 服务端要求的退避（Retry-After）到期时间
+        self.backoffs = 0
+
+    def ready(self, cls: Optional[str] = "picks") -> bool:
+        """现在能不能往这个端点发这一类请求（不占探测名额，挑端点时用）"""
+        if cls is not None and self.busy_for(cls) > 0:
+            return False
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.open_s
+        return not self.probing
+
+    def allow(self, cls: Optional[str] = "picks") -> bool:
+        """真要发请求前调用：half_open 时占掉唯一的探测名额"""
+        if not self.ready(cls):
+            return False
+        if self.state != "closed":
+            self.state = "half_open"
+            self.probing = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.streak = 0
+        self.probing = False
+
+    def failure(self):
+        self.streak += 1
+        self.probing = False
+        if self.state == "half_open" or self.streak >= self.fails:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """请求被取消（对冲输了 / 超预算）：不算成败，只把探测名额还回去"""
+        self.probing = False
+
+    def backoff(self, seconds: float, cls: str = "picks"):
+        """服务端明说忙（503 + Retry-After）：端点是好的，不算失败、不动连续失败计数，只是这段时间内不发这一类请求"""
+        self.probing = False
+        self.busy_until[cls] = max(self.busy_until.get(cls, 0.0), time.monotonic() + seconds)
+        self.backoffs += 1
+
+    def busy_for(self, cls: str = "picks") -> float:
+        return max(0.0, self.busy_until.get(cls, 0.0) - time.monotonic())
+
+    def stats(self) -> dict:
+        left = self.open_s - (time.monotonic() - self.opened_at) if self.state == "open" else 0.0
+        busy = {cls: round(self.busy_for(cls), 1) for cls in self.busy_until if self.busy_for(cls) > 0}
+        return {"state": self.state, "streak": self.streak, "opened": self.opened, "retry_in_s": round(max(0.0, left), 1),
+                "busy_s": busy, "backoffs": self.backoffs}
+
+
+_CLS_LABELS = {"picks": "读", "writes": "写"}
+
+
+class _TokenBuckets:
+    """
+    按键（会话 / 用户）的令牌桶：每个键最多 burst 个令牌，每分钟回 per_min 个。
+    只在事件循环里调用，不加锁；键按最近使用排序，超过 max_keys 从最久没用的开始丢（丢了等于满桶）。
+    """
+
+    def __init__(self, per_min: float, burst: int, max_keys: int = 10000):
+        self.rate = per_min / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()   # key -> [令牌, 上次更新]
+
+    def wait(self, key: str, cost: int = 1) -> float:
+        """还要等几秒才够 cost 个令牌；0 = 现在就够（不扣）"""
+        if self.rate <= 0 or not key:
+            return 0.0
+        tokens, ts = self.buckets.get(key) or (float(self.burst), time.monotonic())
+        tokens = min(float(self.burst), tokens + (time.monotonic() - ts) * self.rate)
+        cost = min(cost, self.burst)
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def take(self, key: str, cost: int = 1):
+        if self.rate <= 0 or not key:
+            return
+        now = time.monotonic()
+        tokens, ts = self.buckets.pop(key, None) or (float(self.burst), now)
+        tokens = min(float(self.burst), tokens + (now - ts) * self.rate)
+        self.buckets[key] = [tokens - min(cost, self.burst), now]
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+class _Admission:
+    """
+    指令准入：会话 / 用户令牌桶 + 全局进行中上限 + 维护类指令单飞。
+    被拒时同一个键在等待期内只回一次提示，免得刷屏的人把机器人也带着刷屏；
+    写指令（评分）另用一个按用户的桶，被拒每次都回复，不能让人以为评上了。
+    """
+
+    def __init__(self):
+        self.sessions = _TokenBuckets(SESSION_RPM, SESSION_BURST)
+        self.users = _TokenBuckets(USER_RPM, USER_BURST)
+        self.writes = _TokenBuckets(WRITE_RPM, WRITE_BURST)
+        self.max_inflight = MAX_INFLIGHT
+        self.inflight = 0
+        self.running: Dict[str, tuple] = {}          # 单飞指令 -> (发起会话, 开始时间)
+        self.rejected: Dict[str, int] = {}           # 原因 -> 次数
+        self._hushed: "OrderedDict[str, float]" = OrderedDict()   # 键 -> 在此之前不再提示
+
+    def _reject(self, reason: str, key: str, text: str, quiet_for: float) -> str:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        if quiet_for <= 0:
+            return text
+        now = time.monotonic()
+        if self._hushed.get(key, 0.0) > now:
+            return ""
+        self._hushed[key] = now + quiet_for
+        self._hushed.move_to_end(key)
+        while len(self._hushed) > 10000:
+            self._hushed.popitem(last=False)
+        return text
+
+    def enter(self, cmd: str, sess: str, user: str, cost: int, single_flight: bool,
+              write: bool = False) -> Optional[str]:
+        """放行返回 None（之后必须 leave）；被拒返回要回复的文字，空串表示这次不回复（写指令总会回复）"""
+        if single_flight and cmd in self.running:
+            who, t0 = self.running[cmd]
+            where = "本会话" if who == sess else "其他会话"
+            return self._reject("single_flight", f"sf:{sess}", f"⏸ 已有同类任务在进行（{where}发起，已用时 "
+                                f"{int(time.monotonic() - t0)}s），完成后会在发起的会话里汇报，请勿重复发起。", 10.0)
+        if not single_flight and self.max_inflight > 0 and self.inflight >= self.max_inflight:
+            return self._reject("inflight", f"busy:{sess}",
+                                f"🚦 现在处理的请求太多了，{'这次没有记录，' if write else ''}请稍后再试。",
+                                0.0 if write else 5.0)
+        if write:
+            wait = self.writes.wait(user or sess, cost)
+            if wait > 0:
+                return self._reject("write_rate", "", f"⏳ 评得太快了，这次没有记录，请 {max(1, round(wait))} 秒后再发。", 0.0)
+            self.writes.take(user or sess, cost)
+        else:
+            wait = max(self.sessions.wait(sess, cost), self.users.wait(user, cost))
+            if wait > 0:
+                return self._reject("rate", f"rate:{sess}:{user}",
+                                    f"⏳ 发得太快了，请 {max(1, round(wait))} 秒后再试。", wait)
+            self.sessions.take(sess, cost)
+            self.users.take(user, cost)
+        if single_flight:
+            self.running[cmd] = (sess, time.monotonic())
+        else:
+            self.inflight += 1
+        return None
+
+    def leave(self, cmd: str, single_flight: bool):
+        if single_flight:
+            self.running.pop(cmd, None)
+        else:
+            self.inflight -= 1
+
+
+def _sender_id(event) -> str:
+    try:
+        return str(event.get_sender_id() or "")
+    except Exception:
+        return str(getattr(event, "user_id", "") or "")
+
+
+def _admitted(cost: int = 1, single_flight: bool = False, write: bool = False):
+    """
+    指令装饰器（放在 @_instrumented 下面，被拒的也照样计时）：过不了准入就快速回一句“稍后再试”，不碰 picapi。
+    cost：扣几个令牌；single_flight：同一时刻整个插件只跑一个（如 #整理图库），不占全局进行中名额；
+    write：写指令（#评分），走单独的写入桶，被拒时一定回复。
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, event, *args, **kwargs):
+            adm: _Admission = self._admission
+            reply = adm.enter(fn.__name__, self._session_key(event), _sender_id(event), cost, single_flight, write)
+            if reply is not None:
+                if reply:
+                    yield event.plain_result(reply)
+                return
+            try:
+                async for item in fn(self, event, *args, **kwargs):
+                    yield item
+            finally:
+                adm.leave(fn.__name__, single_flight)
+        return wrapper
+    return deco
+
+
+def _busy_hint(e: Exception) -> Optional[str]:
+    """
+    picapi 忙 / 卡住时给一句“稍后再试”：准入控制回的 503（带 Retry-After）、熔断中、超出延迟预算；
+    其他错误返回 None
+    """
+    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 503:
+        after = e.response.headers.get("retry-after", "")
+        return f"🚦 图库服务正忙，请{f' {after} 秒后' if after.isdigit() else '稍后'}再试。"
+    if isinstance(e, _Backoff):
+        return f"🚦 图库服务正忙，请 {max(1, int(e.retry_after + 0.999))} 秒后再试。"
+    if isinstance(e, _CircuitOpen):
+        return "🚦 图库服务暂时不可用（连续失败，已暂停请求），请稍后再试。"
+    if isinstance(e, asyncio.TimeoutError):
+        return "⌛ 图库服务响应太慢，这次先放弃了，请稍后再试。"
+    return None
+
+
+def _stale_note(data) -> str:
+    """降级返回的旧数据（_get 标了 stale）在回复最前面加一行说明；正常数据返回空串"""
+    return "⚠️ picapi 暂时不可用，以下是缓存的旧数据。\n" if isinstance(data, dict) and data.get("stale") else ""
+
+
+# 当前指令累计花在 picapi 上的时间；每条指令一个 dict（create_task 出去的子任务共享同一个）
+_CMD_API_TIME: contextvars.ContextVar = contextvars.ContextVar("picrater_cmd_api_time", default=None)
+# 当前指令的请求 ID：发往 picapi 的每个请求都带 X-Request-ID，picapi 的 /admin/traces?rid=… 能按它查分段耗时
+_CMD_RID: contextvars.ContextVar = contextvars.ContextVar("picrater_cmd_rid", default="")
+
+
+async def _add_request_id(request: httpx.Request):
+    rid = _CMD_RID.get()
+    if rid and "x-request-id" not in request.headers:
+        request.headers["X-Request-ID"] = rid
+
+
+_HTTP_HOOKS = {"request": [_add_request_id]}
+
+
+class _PluginMetrics:
+    """
+    插件自身的进程内指标：每条指令的耗时直方图（总 / picapi / 平台发送 三段）、picapi 错误按状态码计数、
+    各接口调用次数与耗时、进行中的指令与请求数。只有加法和一次 bisect，不额外起任务。
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+    PARTS = ("total", "api", "send", "bot")   # bot = 总 - picapi - 发送，即插件自己和框架排队的时间
+
+    def __init__(self):
+        self.started = time.time()
+        self.hist: Dict[tuple, list] = {}         # (指令, 段) -> [各桶计数..., +Inf, 总和]
+        self.api_errors: Dict[str, int] = {}      # "404" / "503" / "ConnectTimeout" …
+        self.api_calls: Dict[str, list] = {}      # 接口 -> [次数, 总耗时]
+        self.inflight_cmds = 0
+        self.inflight_api = 0
+        self.recent_lat: Dict[str, deque] = {}    # 接口 -> 最近成功请求的耗时（对冲阈值按它的 p95 算）
+        self.tail = {"hedged": 0, "hedge_won": 0, "over_budget": 0, "short_circuit": 0, "backoff": 0, "stale": 0}
+
+    def observe(self, cmd: str, part: str, seconds: float):
+        h = self.hist.get((cmd, part))
+        if h is None:
+            h = self.hist[(cmd, part)] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        h[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        h[-1] += seconds
+
+    def quantile(self, cmd: str, part: str, q: float) -> Optional[float]:
+        """按桶线性插值估算分位数（与 Prometheus histogram_quantile 同法）；超出最大桶时返回最大桶上界"""
+        h = self.hist.get((cmd, part))
+        if not h:
+            return None
+        total = sum(h[:-1])
+        if not total:
+            return None
+        rank, acc, lo = q * total, 0, 0.0
+        for ub, c in zip(self.BUCKETS, h):
+            if acc + c >= rank and c:
+                return lo + (ub - lo) * (rank - acc) / c
+            acc += c
+            lo = ub
+        return self.BUCKETS[-1]
+
+    def count(self, cmd: str) -> int:
+        h = self.hist.get((cmd, "total"))
+        return sum(h[:-1]) if h else 0
+
+    def api_error(self, key: str):
+        self.api_errors[key] = self.api_errors.get(key, 0) + 1
+
+    def latency(self, endpoint: str, seconds: float):
+        q = self.recent_lat.get(endpoint)
+        if q is None:
+            q = self.recent_lat[endpoint] = deque(maxlen=200)
+        q.append(seconds)
+
+    def recent_quantile(self, endpoint: str, q: float) -> Optional[float]:
+        """最近成功请求耗时的分位数；样本不到 20 个返回 None"""
+        lat = self.recent_lat.get(endpoint)
+        if not lat or len(lat) < 20:
+            return None
+        s = sorted(lat)
+        return s[min(len(s) - 1, int(q * len(s)))]
+
+    @contextlib.asynccontextmanager
+    async def api(self, endpoint: str):
+        """包住一次 picapi 调用：计耗时、进行中数、失败原因，并累加到当前指令的 picapi 时间里"""
+        self.inflight_api += 1
+        t0 = time.monotonic()
+        try:
+            yield
+        except httpx.HTTPStatusError as e:
+            self.api_error(str(e.response.status_code))
+            raise
+        except httpx.TransportError as e:
+            self.api_error(type(e).__name__)
+            raise
+        finally:
+            dt = time.monotonic() - t0
+            self.inflight_api -= 1
+            c = self.api_calls.setdefault(endpoint, [0, 0.0])
+            c[0] += 1
+            c[1] += dt
+            acc = _CMD_API_TIME.get()
+            if acc is not None:
+                acc[0] += dt
+
+    def snapshot(self) -> dict:
+        cmds = sorted({cmd for cmd, _ in self.hist})
+        return {
+            "uptime_s": int(time.time() - self.started),
+            "inflight_cmds": self.inflight_cmds,
+            "inflight_api": self.inflight_api,
+            "api_errors": dict(self.api_errors),
+            "tail": dict(self.tail),
+            "api_calls": {k: {"n": n, "mean_ms": round(t / n * 1000, 1) if n else 0.0}
+                          for k, (n, t) in self.api_calls.items()},
+            "commands": {
+                cmd: {"n": self.count(cmd),
+                      **{f"{part}_p{int(q * 100)}_s": round(v, 3)
+                         for part in self.PARTS for q in (0.5, 0.95)
+                         if (v := self.quantile(cmd, part, q)) is not None}}
+                for cmd in cmds
+            },
+        }
+
+
+def _instrumented(cmd: str):
+    """
+    指令装饰器（放在 @filter.command 下面）：记录一条指令的总耗时、花在 picapi 上的时间，
+    以及每次 yield 之后挂起的时间 —— AstrBot 在生成器挂起期间把这条结果发到平台，这段就是发送耗时。
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, event, *args, **kwargs):
+            m: _PluginMetrics = self._metrics
+            api = [0.0]
+            token = _CMD_API_TIME.set(api)
+            rid = f"{fn.__name__.removeprefix('cmd_')}-{uuid.uuid4().hex[:12]}"   # 请求头只能是 ASCII，用函数名
+            rid_token = _CMD_RID.set(rid)
+            send = 0.0
+            t0 = time.monotonic()
+            m.inflight_cmds += 1
+            try:
+                async for item in fn(self, event, *args, **kwargs):
+                    ts = time.monotonic()
+                    yield item
+                    send += time.monotonic() - ts
+            finally:
+                m.inflight_cmds -= 1
+                total = time.monotonic() - t0
+                m.observe(cmd, "total", total)
+                m.observe(cmd, "api", api[0])
+                m.observe(cmd, "send", send)
+                m.observe(cmd, "bot", max(0.0, total - api[0] - send))
+                if SLOW_LOG_S and total >= SLOW_LOG_S:
+                    logger.warning(f"[pic_rater] 慢指令 {cmd} rid={rid}: 共 {total:.2f}s，"
+                                   f"picapi {api[0]:.2f}s / 发送 {send:.2f}s / 插件 {max(0.0, total - api[0] - send):.2f}s")
+                with contextlib.suppress(ValueError):   # 生成器被别的上下文 aclose 时 reset 会报错，忽略
+                    _CMD_API_TIME.reset(token)
+                    _CMD_RID.reset(rid_token)
+        return wrapper
+    return deco
+
 
 def _build_random_params(arg_text: str) -> dict:
     """
     把“#来一张”后面的参数转成 /random_pic 的查询参数：
     - 以 '?' 或 'q:' 开头：走 q（模糊搜索/FTS）
+    - 以 'tag:' 开头：走 tag（标签布尔表达式，可带权重）：tag:风景 -夜景、tag:猫|狗、tag:猫:3,tag:狗:1
     - 含 , : / 任一字符：判为 cat（分类/权重/多级）
     - 其他：默认 q
     """
@@ -27,6 +617,9 @@ def _build_random_params(arg_text: str) -> dict:
         return {"q": t[1:].strip()}
     if low.startswith("q:"):
         return {"q": t[2:].strip()}
+    if low.startswith("tag:"):
+        groups = [g.strip() for g in t.split(",")]
+        return {"tag": ",".join(g[4:].strip() if g.lower().startswith("tag:") else g for g in groups if g)}
 
     if _CAT_HINT_RE.search(t):
         return {"cat": t}
@@ -35,6 +628,13 @@ def _build_random_params(arg_text: str) -> dict:
     return {"q": t}
 
 
+def _random_cmd_for_tag(tag: str) -> str:
+    """给标签拼一条能直接复制的 #来一张：含 , : / 或以 ? 开头的标签要显式加 q:，否则会被当成分类表达式"""
+    if _CAT_HINT_RE.search(tag) or tag.startswith("?"):
+        return f"#来一张 q:{tag}"
+    return f"#来一张 {tag}"
+
+
 
 @register(
     "astrbot_plugin_pic_rater",
@@ -47,10 +647,31 @@ class PicRater(Star):
     def __init__(self, context: Context):
         super().__init__(context)
         self.http_timeout = httpx.Timeout(connect=10.0, read=1200.0, write=1200.0, pool=10.0)
+        # 下载图片用短一点的超时：单张卡住就退回发 URL
+        self.img_timeout = httpx.Timeout(connect=10.0, read=60.0, write=60.0, pool=10.0)
+        self._client: Optional[httpx.AsyncClient] = None
+        # GET 响应缓存：(url, 参数) -> (ETag, JSON)；带 If-None-Match 回源，304 直接用本地副本
+        self._resp_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._resp_cache_max = 256
         # 与 docker-compose 在同一网络时可用服务名；需要的话用环境变量覆盖
-        self.base_url = os.getenv("PICAPI_URL", "http://picapi:8000").rstrip("/")
+        # 可写多个（逗号分隔）：第一个是 primary（写/维护），全部参与读请求的最低延迟选择
+        urls = [u.strip().rstrip("/") for u in os.getenv("PICAPI_URL", "http://picapi:8000").split(",") if u.strip()]
+        self.base_url = urls[0]
+        self._reads = _ReadEndpoints(urls)
+        self._breakers = {u: _CircuitBreaker(BREAKER_FAILS, BREAKER_OPEN_S) for u in urls}
+        # 最近取到的随机图：(查询键, 载荷)；picapi 熔断 / 超预算时从这里挑一张顶上
+        self._recent: deque = deque(maxlen=STALE_RECENT)
         self.last_sent: Dict[str, Dict[str, Any]] = {}
-        logger.info("[pic_rater] init: PICAPI_URL=%s", self.base_url)
+        self._metrics = _PluginMetrics()
+        self._admission = _Admission()
+        self._img_cache: Optional[_ImageByteCache] = None
+        if LOCAL_CACHE:
+            try:
+                self._img_cache = _ImageByteCache(LOCAL_CACHE_DIR, int(LOCAL_CACHE_MB * 1024 * 1024))
+            except Exception as e:
+                logger.warning(f"[pic_rater] 本地图片缓存不可用，改为直接发 URL: {e}")
+        logger.info("[pic_rater] init: PICAPI_URL=%s reads=%s local_cache=%s",
+                    self.base_url, len(urls), bool(self._img_cache))
 
     # --------- 小工具 ----------
     def _session_key(self, event: AstrMessageEvent) -> str:
@@ -75,19 +696,287 @@ class PicRater(Star):
             u = "/" + u
         return f"{self.base_url}{u}"
 
+    def _http(self) -> httpx.AsyncClient:
+        # 复用同一个连接池：批量发图时并发下载不必每张都重新握手
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.http_timeout,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                event_hooks=_HTTP_HOOKS,
+            )
+        return self._client
+
+    async def terminate(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+
+    @staticmethod
+    def _rebase(data, base: str):
+        """读端点返回的相对图片地址补成该端点的绝对地址（各副本挂的是同一份图库）"""
+        def fix(d: dict):
+            for k in ("url", "orig_url"):
+                v = d.get(k)
+                if isinstance(v, str) and v.startswith("/"):
+                    d[k] = base + v
+        if isinstance(data, dict):
+            fix(data)
+            for it in data.get("items") or []:
+                if isinstance(it, dict):
+                    fix(it)
+        return data
+
     async def _get(self, endpoint: str, **params):
-        url = f"{self.base_url}{endpoint}"
-        async with httpx.AsyncClient(timeout=self.http_timeout) as client:
-            r = await client.get(url, params={k: v for k, v in params.items() if v is not None and v != ""})
-            r.raise_for_status()
-            return r.json()
+        params = {k: v for k, v in params.items() if v is not None and v != ""}
+        # 各副本的 ETag 就是数据库代数，彼此通用 → 缓存键不带主机
+        key = (endpoint, tuple(sorted((k, str(v)) for k, v in params.items())))
+        cached = self._resp_cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else None
+
+        try:
+            async with self._metrics.api(endpoint):
+                r, base = await self._fetch(endpoint, params, headers)
+                if r.status_code == 304 and cached:
+                    self._resp_cache.move_to_end(key)
+                    return cached[1]
+                r.raise_for_status()
+        except (httpx.TransportError, httpx.HTTPStatusError, asyncio.TimeoutError) as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                raise
+            stale = self._stale(endpoint, key, params)
+            if stale is None:
+                raise
+            self._metrics.tail["stale"] += 1
+            logger.warning(f"[pic_rater] {endpoint} 不可用（{type(e).__name__}），降级用旧数据 rid={_CMD_RID.get()}")
+            return stale
+        data = self._rebase(r.json(), base)
+        etag = r.headers.get("etag")
+        if etag:
+            # 只缓存带校验器的接口（/categories、/dirs、/stats…）；/random_pic 没有 ETag 不会进来
+            self._resp_cache[key] = (etag, data)
+            self._resp_cache.move_to_end(key)
+            while len(self._resp_cache) > self._resp_cache_max:
+                self._resp_cache.popitem(last=False)
+        if endpoint in ("/random_pic", "/random_pics"):
+            qkey = self._pick_key(params)
+            for it in (data.get("items") or []) if endpoint == "/random_pics" else [data]:
+                if isinstance(it, dict) and it.get("url"):
+                    self._recent.append((qkey, it))
+        return data
+
+    @staticmethod
+    def _pick_key(params: dict) -> tuple:
+        """随机图的查询键：去掉会话游标和张数，剩下的（分类/关键词/标签/预设）相同才算同一种图"""
+        return tuple(sorted((k, str(v)) for k, v in params.items() if k not in ("scope", "n")))
+
+    def _stale(self, endpoint: str, key: tuple, params: dict):
+        """
+        降级数据：带 ETag 的列表接口用响应缓存里的旧副本；随机图从最近取到的同一查询的图里挑
+        （纯随机时不挑查询），尽量避开这个会话上一张。没有可用的返回 None。结果都带 stale=True。
+        """
+        if endpoint in ("/random_pic", "/random_pics"):
+            qkey = self._pick_key(params)
+            pool = [it for k, it in self._recent if k == qkey]
+            if not pool and not [k for k, _ in qkey if k != "preset"]:
+                pool = [it for _, it in self._recent]
+            last_id = (self.last_sent.get(params.get("scope", "")) or {}).get("id")
+            pool = [it for it in pool if it.get("id") != last_id] or pool
+            if not pool:
+                return None
+            if endpoint == "/random_pic":
+                return {**random.choice(pool), "stale": True}
+            uniq = list({it.get("id"): it for it in pool}.values())
+            items = random.sample(uniq, min(int(params.get("n") or 1), len(uniq)))
+            return {"count": len(items), "items": items, "stale": True}
+        cached = self._resp_cache.get(key)
+        return {**cached[1], "stale": True} if cached else None
+
+    def _hedge_delay(self, endpoint: str, budget: float) -> float:
+        """发对冲请求前等多久：该接口最近的 p95，没样本时用预算的 1/4；夹在 [HEDGE_MIN_MS, 预算/2]"""
+        p95 = self._metrics.recent_quantile(endpoint, 0.95)
+        return min(budget / 2, max(HEDGE_MIN_MS / 1000, p95 if p95 is not None else budget / 4))
+
+    def _endpoint_failed(self, base: str):
+        br = self._breakers[base]
+        was = br.state
+        br.failure()
+        self._reads.observe(base, 0, ok=False)
+        if br.state == "open" and was != "open":
+            logger.warning(f"[pic_rater] picapi 端点 {base} 连续失败 {br.streak} 次，熔断 {br.open_s:g}s")
+
+    async def _fetch(self, endpoint: str, params: dict, headers) -> tuple:
+        """
+        在该接口的总预算内拿到一个响应，返回 (响应, 端点)：
+        - 只往熔断器放行的端点发；全都断开直接抛 _CircuitOpen，都在 Retry-After 退避期内抛 _Backoff，不等
+        - 超过对冲阈值还没回，再发一份（优先没试过的端点，只有一个端点就同一个），先回的赢，输的取消；
+          带 scope 的随机图不对冲：服务端每收到一份就推进一次会话游标，输的那份会让游标白走；
+          也不按延迟挑端点，固定发往该 scope 的“家”端点（见 _ReadEndpoints.home），它失败才顺延
+        - 503 + Retry-After 是背压：不算端点失败，按它给的秒数暂停往那里发读请求，换别的端点
+        - 连不上 / 5xx 换没试过的端点；都失败时返回最后一个 5xx 响应（或抛最后一个异常）
+        - 超预算抛 asyncio.TimeoutError，还挂着的请求算这些端点失败一次
+        """
+        budget = _BUDGETS.get(endpoint, BUDGET_DEFAULT)
+        deadline = time.monotonic() + budget
+        m = self._metrics
+        tasks: Dict[asyncio.Task, tuple] = {}   # 请求 -> (端点, 开始时间, 是否对冲)
+        tried = []
+        last = None                             # 最后一次失败：(5xx 响应或异常, 端点)
+
+        def launch(hedge: bool) -> bool:
+            ready = [u for u in self._reads.urls if self._breakers[u].ready("picks")]
+            cands = [u for u in ready if u not in tried] or (ready if hedge else [])
+            if not cands:
+                return False
+            exclude = [u for u in self._reads.urls if u not in cands]
+            scope = params.get("scope")
+            base = self._reads.home(scope, exclude) if scope else self._reads.pick(exclude=exclude)
+            if not self._breakers[base].allow("picks"):
+                return False
+            tried.append(base)
+            t = asyncio.create_task(self._http().get(f"{base}{endpoint}", params=params, headers=headers))
+            tasks[t] = (base, time.monotonic(), hedge)
+            return True
+
+        def supersede(fail, base):
+            # 被后来的失败顶掉的这次在这里记；最后一次由 _metrics.api 记
+            nonlocal last
+            if last is not None:
+                m.api_error(str(last[0].status_code) if isinstance(last[0], httpx.Response) else type(last[0]).__name__)
+            last = (fail, base)
+
+        if not launch(False):
+            busy = [br.busy_for("picks") for br in self._breakers.values() if br.busy_for("picks") > 0]
+            if busy:
+                m.tail["backoff"] += 1
+                raise _Backoff(f"{endpoint}: picapi asked to back off", min(busy))
+            m.tail["short_circuit"] += 1
+            raise _CircuitOpen(f"{endpoint}: all picapi endpoints are circuit-open")
+        hedge_at = time.monotonic() + self._hedge_delay(endpoint, budget) if HEDGE and "scope" not in params else None
+        try:
+            while tasks:
+                now = time.monotonic()
+                if now >= deadline:
+                    for base in {b for b, _t0, _h in tasks.values()}:   # 对冲到同一端点的只算一次
+                        self._endpoint_failed(base)
+                    supersede(None, None)
+                    m.tail["over_budget"] += 1
+                    m.api_error("budget")
+                    raise asyncio.TimeoutError(f"{endpoint} exceeded its {budget:g}s budget")
+                until = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, until - now), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        if launch(True):
+                            m.tail["hedged"] += 1
+                    continue
+                for t in done:
+                    base, t0, hedge = tasks.pop(t)
+                    try:
+                        r = t.result()
+                    except httpx.TransportError as e:
+                        self._endpoint_failed(base)
+                        supersede(e, base)
+                        continue
+                    after = _retry_after(r)
+                    if after is not None:
+                        self._breakers[base].backoff(after, "picks")
+                        m.tail["backoff"] += 1
+                        supersede(r, base)
+                        continue
+                    if r.status_code >= 500:
+                        self._endpoint_failed(base)
+                        supersede(r, base)
+                        continue
+                    dt = time.monotonic() - t0
+                    self._breakers[base].success()
+                    self._reads.observe(base, dt)
+                    m.latency(endpoint, dt)
+                    m.tail["hedge_won"] += hedge
+                    return r, base
+                if not tasks:
+                    launch(False)
+        finally:
+            for t, (base, _t0, _h) in tasks.items():
+                t.cancel()
+                self._breakers[base].release()
+        if last is None:
+            raise _CircuitOpen(f"{endpoint}: picapi endpoints went circuit-open during retries")
+        if isinstance(last[0], httpx.Response):
+            return last
+        raise last[0]
 
     async def _post(self, endpoint: str, payload):
+        """
+        写请求（/rate）只发 primary，且不设延迟预算：写不是幂等的，超时取消时服务端可能已经记上了，
+        重发或提示失败都会让人多评一次。熔断中 / 写的退避期内直接失败（请求没发出去，可以放心重试）；
+        读请求收到的 Retry-After 不拦写，写收到的也只拦写。
+        """
         url = f"{self.base_url}{endpoint}"
-        async with httpx.AsyncClient(timeout=self.http_timeout) as client:
-            r = await client.post(url, json=payload)
+        br = self._breakers[self.base_url]
+        async with self._metrics.api(endpoint):
+            if br.busy_for("writes") > 0:
+                self._metrics.tail["backoff"] += 1
+                raise _Backoff(f"{endpoint}: picapi primary asked to back off", br.busy_for("writes"))
+            if not br.allow("writes"):
+                self._metrics.tail["short_circuit"] += 1
+                raise _CircuitOpen(f"{endpoint}: picapi primary is circuit-open")
+            try:
+                r = await self._http().post(url, json=payload)
+            except httpx.TransportError:
+                self._endpoint_failed(self.base_url)
+                raise
+            except asyncio.CancelledError:
+                br.release()
+                raise
+            after = _retry_after(r)
+            if after is not None:
+                br.backoff(after, "writes")
+                self._metrics.tail["backoff"] += 1
+            elif r.status_code >= 500:
+                self._endpoint_failed(self.base_url)
+            else:
+                br.success()
             r.raise_for_status()
-            return r.json()
+        return r.json()
+
+    async def _local_image(self, iid: Optional[str], url: str) -> Optional[str]:
+        """
+        本地缓存模式：命中直接返回本地路径；未命中则经连接池下载一次再落盘。
+        未开启缓存 / 下载失败返回 None（调用方退回发 URL）。
+        """
+        cache = self._img_cache
+        if cache is None or not iid:
+            return None
+        name = cache.key_for(iid, IMAGE_PRESET, url)
+        path = cache.lookup(name)
+        if path is None:
+            data = await self._fetch_image(url)
+            if data is None:
+                return None
+            try:
+                path = await asyncio.to_thread(cache.store, name, data)
+            except Exception as e:
+                logger.warning(f"[pic_rater] 写本地图片缓存失败: {e}")
+                return None
+        looked = cache.hits + cache.misses
+        if looked % 50 == 0:
+            st = cache.stats()
+            logger.info(f"[pic_rater] 本地图片缓存：命中率 {st['hit_ratio']:.1%}，"
+                        f"节省 {st['bytes_saved'] / 1048576:.1f}MB，占用 {st['bytes'] / 1048576:.1f}MB/{st['files']} 个")
+        return path
+
+    async def _fetch_image(self, url: str) -> Optional[bytes]:
+        """下载一张图；失败返回 None（由调用方退回发 URL）。所在端点熔断中时不等，直接返回 None"""
+        if any(url.startswith(u) and not br.ready(None) for u, br in self._breakers.items()):
+            return None
+        try:
+            async with self._metrics.api("image"):
+                r = await self._http().get(url, timeout=self.img_timeout)
+                r.raise_for_status()
+            return r.content
+        except Exception as e:
+            logger.warning(f"[pic_rater] 下载图片失败 {url}: {e}")
+            return None
 
     def _render_bar(self, done: int, total: int, width: int = 24) -> str:
         if total <= 0:
@@ -100,7 +989,7 @@ class PicRater(Star):
     async def _get_progress_json(self) -> dict | None:
         import httpx
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
+            async with httpx.AsyncClient(timeout=10.0, event_hooks=_HTTP_HOOKS) as client:
                 r = await client.get(f"{self.base_url}/admin/sync_progress")
                 if r.status_code == 200:
                     return r.json()
@@ -109,15 +998,46 @@ class PicRater(Star):
         return None
 
     # --------- 指令 ----------
-    # 用法：#来一张   或   #来一张 风景:3,人像:1   或   #来一张 壁纸/风景
+    async def _similar_pick(self, event) -> Optional[dict]:
+        """
+        以本会话上一张图为查询取一张相似图：优先不是“重复图”的，在最近的几张里随机挑；
+        本会话没发过图返回 None，没有相似图抛 LookupError。
+        """
+        last = self.last_sent.get(self._session_key(event))
+        if not last or not (last.get("id") or last.get("relpath")):
+            return None
+        data = await self._get("/similar", id=last.get("id") or last.get("relpath"), limit=10, preset=IMAGE_PRESET)
+        items = data.get("items") or []
+        if not items:
+            raise LookupError("no similar images")
+        fresh = [it for it in items if not it.get("dup")] or items
+        return random.choice(fresh[:5])
+
+    # 用法：#来一张   或   #来一张 风景:3,人像:1   或   #来一张 壁纸/风景   或   #来一张 tag:猫:3,tag:狗:1
+    #       #来一张 相似   —— 和本会话上一张图相似的一张（感知哈希）
     @filter.command("来一张")
+    @_instrumented("来一张")
+    @_admitted()
     async def cmd_send_random(self, event, text: str = ""):
+        similar = (text or "").strip().lower() in _SIMILAR_ARGS
         # ★ 新：把用户参数转成 q 或 cat
-        params = _build_random_params(text)
+        params = {} if similar else _build_random_params(text)
 
         try:
-            # ★ 原来是 cat=cat；现在改成 **params
-            data = await self._get("/random_pic", **params)
+            if similar:
+                try:
+                    data = await self._similar_pick(event)
+                except LookupError:
+                    yield event.plain_result("没有找到和上一张相似的图片（可能还没算感知哈希：#整理图库 会顺带补算）。")
+                    return
+                if data is None:
+                    yield event.plain_result("本会话还没有发过图片，请先发送：#/来一张")
+                    return
+            else:
+                # ★ 原来是 cat=cat；现在改成 **params
+                if NO_REPEAT:
+                    params["scope"] = self._session_key(event)
+                data = await self._get("/random_pic", preset=IMAGE_PRESET, **params)
 
             img_url = self._abs_url(data["url"])
             iid = data.get("id")
@@ -125,11 +1045,12 @@ class PicRater(Star):
             fname = data.get("filename", "")
             category = data.get("category") or "*"
 
+            # 本地缓存模式：下载与拼提示文字并行
+            local_task = asyncio.create_task(self._local_image(iid, img_url)) if self._img_cache else None
+
             # ★ 同时保存 id 和 relpath，评分更稳（后端 /rate 兼容二者）
             self.last_sent[self._session_key(event)] = {"id": iid, "relpath": relpath}
 
-            yield event.image_result(img_url)
-
             # 可选：给用户一个提示
             hint_lines = [
                 f"ID: {iid}",
@@ -137,18 +1058,79 @@ class PicRater(Star):
                 f"文件: {fname}",
                 "评分指令：#评分 <分值> [备注]（0~5，可小数；写回XMP会四舍五入为整数）",
             ]
+            if data.get("stale"):
+                hint_lines.insert(0, "⚠️ picapi 暂时不可用，先从最近发过的图里挑了一张")
             # 根据模式追加一行提示
-            if "q" in params:
+            if similar:
+                hint_lines.append(f"与上一张相似：汉明距离 {data.get('distance')}/64{'（几乎是同一张）' if data.get('dup') else ''}")
+            elif "tag" in params:
+                hint_lines.append(f"标签表达式：{params['tag']}")
+            elif "q" in params:
                 hint_lines.append(f"检索：{params['q']}")
             elif "cat" in params:
                 hint_lines.append(f"分类表达式：{params['cat']}")
+
+            local_path = await local_task if local_task else None
+            yield event.image_result(local_path or img_url)
             yield event.plain_result("\n".join(hint_lines))
 
         except Exception as e:
             from astrbot.api import logger
-            logger.error(f"[pic_rater] /来一张 失败: {e}")
+            logger.error(f"[pic_rater] /来一张 失败: {e} rid={_CMD_RID.get()}")
             # 404 场景常见是“q 没命中”或“cat 不存在”
-            yield event.plain_result("发图失败：没有匹配到图片，或 picapi 不可用。请更换关键词/分类或查看控制台日志。")
+            yield event.plain_result(_busy_hint(e) or "发图失败：没有匹配到图片，或 picapi 不可用。请更换关键词/分类或查看控制台日志。")
+
+    # 用法：#来5张   或   #来3张 风景:3,人像:1   或   #来4张 q:1girl   或   #来4张 tag:风景 -夜景
+    @filter.regex(r"^[#/]?\s*来\s*\d{1,2}\s*张")
+    @_instrumented("来N张")
+    @_admitted(cost=2)
+    async def cmd_send_batch(self, event: AstrMessageEvent):
+        m = _BATCH_CMD_RE.match((event.message_str or "").strip())
+        if not m:
+            return
+        n = int(m.group(1))
+        if n < 1:
+            return
+        n = min(n, BATCH_MAX)
+        params = _build_random_params(m.group(2) or "")
+        if NO_REPEAT:
+            params["scope"] = self._session_key(event)
+
+        try:
+            data = await self._get("/random_pics", n=n, preset=IMAGE_PRESET, **params)
+            items = data.get("items") or []
+            if not items:
+                raise ValueError("empty batch")
+
+            # 并发下载，拼成一条消息发出去；个别下载失败的退回发 URL
+            urls = [self._abs_url(it["url"]) for it in items]
+            if self._img_cache:
+                blobs = await asyncio.gather(*(self._local_image(it.get("id"), u) for it, u in zip(items, urls)))
+            else:
+                blobs = await asyncio.gather(*(self._fetch_image(u) for u in urls))
+
+            batch = [{"id": it.get("id"), "relpath": it.get("relpath")} for it in items]
+            self.last_sent[self._session_key(event)] = {**batch[0], "batch": batch}
+
+            chain = []
+            lines = []
+            for i, (it, url, blob) in enumerate(zip(items, urls, blobs), start=1):
+                if isinstance(blob, str):
+                    chain.append(Comp.Image.fromFileSystem(blob))
+                else:
+                    chain.append(Comp.Image.fromBytes(blob) if blob else Comp.Image.fromURL(url))
+                lines.append(f"{i}. ID: {it.get('id')}  分类: {it.get('category') or '*'}  文件: {it.get('filename', '')}")
+            if data.get("stale"):
+                lines.insert(0, "⚠️ picapi 暂时不可用，先从最近发过的图里挑的")
+            if len(items) < n:
+                lines.append(f"（只匹配到 {len(items)} 张）")
+            lines.append("评分指令：#评分 <序号> <分值> [备注]，例如：#评分 2 4.5")
+            chain.append(Comp.Plain("\n".join(lines)))
+            yield event.chain_result(chain)
+
+        except Exception as e:
+            logger.error(f"[pic_rater] /来N张 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "发图失败：没有匹配到图片，或 picapi 不可用。请更换关键词/分类或查看控制台日志。")
 
     # === 放在 PicRater 类里，和其它方法同级 ===
 
@@ -162,7 +1144,7 @@ class PicRater(Star):
         """
         url = f"{self.base_url}/reindex"
         import httpx
-        async with httpx.AsyncClient(timeout=120) as client:
+        async with httpx.AsyncClient(timeout=120, event_hooks=_HTTP_HOOKS) as client:
             try:
                 r = await client.post(url, json=purge)  # 发送裸布尔
                 r.raise_for_status()
@@ -189,7 +1171,7 @@ class PicRater(Star):
         import httpx
         total = 0
         url = f"{self.base_url}/sync_subjects"
-        async with httpx.AsyncClient(timeout=None) as client:
+        async with httpx.AsyncClient(timeout=None, event_hooks=_HTTP_HOOKS) as client:
             while True:
                 r = await client.post(url, params={"limit": batch})
                 r.raise_for_status()
@@ -207,7 +1189,7 @@ class PicRater(Star):
     async def _rebuild_fts_safe(self) -> str:
         import httpx
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
+            async with httpx.AsyncClient(timeout=None, event_hooks=_HTTP_HOOKS) as client:
                 r = await client.post(f"{self.base_url}/admin/rebuild_fts", params={"full": "true"})
                 if r.status_code == 200:
                     # 有的后端返回JSON，有的返回空体，这里不强制解析
@@ -278,6 +1260,8 @@ class PicRater(Star):
                     task.cancel()
 
     @filter.command("整理图库")
+    @_instrumented("整理图库")
+    @_admitted(single_flight=True)
     async def cmd_clean_gallery(self, event, text: str = ""):
         purge = self._parse_purge_flag(text)
 
@@ -288,9 +1272,12 @@ class PicRater(Star):
         async def do_reindex():
             import httpx
             url = f"{self.base_url}/reindex"
-            async with httpx.AsyncClient(timeout=self.http_timeout) as client:
+            async with httpx.AsyncClient(timeout=self.http_timeout, event_hooks=_HTTP_HOOKS) as client, \
+                    self._metrics.api("/reindex"):
                 try:
                     r = await client.post(url, json=purge)  # 兼容裸 boolean
+                    if r.status_code in (409, 503):  # 别的维护任务正在跑（可能来自另一个 worker），或维护名额已满
+                        return {"busy": r.json().get("detail")}
                     r.raise_for_status()
                     return r.json()
                 except httpx.HTTPStatusError:
@@ -321,12 +1308,18 @@ class PicRater(Star):
         if not isinstance(resp1, dict):
             yield event.plain_result(f"❌ 扫盘入库失败：返回内容异常：{resp1!r}")
             return
+        if resp1.get("busy"):
+            yield event.plain_result(f"⏸ 已有维护任务在进行（{resp1['busy']}），请稍后再试。")
+            return
 
         # ---------- 2) 同步 XMP ----------
         async def do_sync_all():
             import httpx
-            async with httpx.AsyncClient(timeout=self.http_timeout) as client:
+            async with httpx.AsyncClient(timeout=self.http_timeout, event_hooks=_HTTP_HOOKS) as client, \
+                    self._metrics.api("/sync_subjects"):
                 r = await client.post(f"{self.base_url}/sync_subjects", params={"limit": 0})
+                if r.status_code in (409, 503):
+                    return {"busy": r.json().get("detail")}
                 r.raise_for_status()
                 return r.json()
 
@@ -354,12 +1347,18 @@ class PicRater(Star):
         if not isinstance(resp2, dict):
             yield event.plain_result(f"❌ 同步标签失败：返回内容异常：{resp2!r}")
             return
+        if resp2.get("busy"):
+            yield event.plain_result(f"⏸ 入库已完成，但同步标签时已有别的维护任务在进行（{resp2['busy']}），请稍后再试。")
+            return
 
         # ---------- 汇总 ----------
         indexed = resp1.get("indexed")
         purged = resp1.get("purged")
+        moved = resp1.get("moved")
         processed = resp2.get("processed")
         msg = f"✅ 完成：入库 {indexed} 条"
+        if moved:
+            msg += f"，识别移动/改名 {moved} 条（评分已保留）"
         if purged is not None:
             msg += f"，清理 {purged} 条"
         msg += f"，同步标签 {processed} 条。"
@@ -367,12 +1366,28 @@ class PicRater(Star):
 
     # 用法：#/评分 4.5   或   #/评分 4 不错
     @filter.command("评分")
+    @_instrumented("评分")
+    @_admitted(write=True)
     async def cmd_rate(self, event, text: str = ""):
         txt = (text or "").strip()
         if not txt:
-            yield event.plain_result("用法：#/评分 <分值> [备注]  例如：#/评分 4.5 配色舒服")
+            yield event.plain_result("用法：#/评分 <分值> [备注]  例如：#/评分 4.5 配色舒服\n上一次是 #来N张 时：#/评分 <序号> <分值> [备注]")
             return
-        parts = txt.split(maxsplit=1)
+        sess = self._session_key(event)
+        last = self.last_sent.get(sess)
+
+        # 上一次是“#来N张”时支持：#评分 <序号> <分值> [备注]
+        parts = txt.split(maxsplit=2)
+        batch = (last or {}).get("batch") or []
+        if batch and len(parts) >= 2 and parts[0].isdigit() and 1 <= int(parts[0]) <= len(batch):
+            try:
+                float(parts[1])
+                last = batch[int(parts[0]) - 1]
+                parts = parts[1:]
+            except ValueError:
+                pass
+        parts = " ".join(parts).split(maxsplit=1)
+
         try:
             score = float(parts[0])
         except ValueError:
@@ -383,8 +1398,6 @@ class PicRater(Star):
             return
         note = parts[1] if len(parts) >= 2 else None
 
-        sess = self._session_key(event)
-        last = self.last_sent.get(sess)
         if not last:
             yield event.plain_result("本会话还没有待评分的图片，请先发送：#/来一张")
             return
@@ -409,10 +1422,10 @@ class PicRater(Star):
                 tried.append((ident, e.response.status_code))
                 # 404 就换下一个 ident，其他错误直接报
                 if e.response.status_code != 404:
-                    yield event.plain_result(f"评分失败：{e}")
+                    yield event.plain_result(_busy_hint(e) or f"评分失败：{e}")
                     return
             except Exception as e:
-                yield event.plain_result(f"评分失败：{e}")
+                yield event.plain_result(_busy_hint(e) or f"评分失败：{e}")
                 return
 
         # 都失败了
@@ -423,6 +1436,8 @@ class PicRater(Star):
     #   #图类目 pictures        -> 显示 pictures 下的子文件夹
     #   #图类目 pictures/壁纸   -> 再下一级
     @filter.command("图类目")
+    @_instrumented("图类目")
+    @_admitted()
     async def cmd_categories(self, event: AstrMessageEvent, text: str = ""):
         arg = (text or "").strip().strip("/")
         try:
@@ -434,7 +1449,7 @@ class PicRater(Star):
                     yield event.plain_result("没有检测到分类（顶级子文件夹）。")
                     return
                 joined = "、".join(cats[:100])
-                tip = (
+                tip = _stale_note(data) + (
                     f"顶级分类（前{min(100, len(cats))}个）：\n{joined}\n\n"
                     f"下钻查看子文件夹示例：\n#图类目 {cats[0]}\n"
                     f"直接按分类发图示例：\n#来一张 {cats[0]}"
@@ -457,7 +1472,7 @@ class PicRater(Star):
 
             # 只展示前 120 项，避免刷屏
             show = entries_sorted[:120]
-            lines = [f"📂 {base or '/'} 下的子文件夹（显示前 {len(show)} 项）:"]
+            lines = [f"{_stale_note(data)}📂 {base or '/'} 下的子文件夹（显示前 {len(show)} 项）:"]
             for d in show:
                 name = d.get("name", "")
                 path = d.get("path", "")
@@ -471,6 +1486,216 @@ class PicRater(Star):
 
         except Exception as e:
             from astrbot.api import logger
-            logger.error(f"[pic_rater] /图类目 失败: {e}")
-            yield event.plain_result("获取分类失败：请检查 picapi 是否在线。")
+            logger.error(f"[pic_rater] /图类目 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "获取分类失败：请检查 picapi 是否在线。")
+
+    # 用法：#标签   或   #标签 风
+    #   按前缀列出图库里最常用的标签（不分大小写）和图片数，并给出现成的 #来一张 指令，省得盲猜关键词
+    @filter.command("标签")
+    @_instrumented("标签")
+    @_admitted()
+    async def cmd_tags(self, event: AstrMessageEvent, text: str = ""):
+        prefix = (text or "").strip()
+        try:
+            data = await self._get("/tags", prefix=prefix, limit=15)
+        except Exception as e:
+            logger.error(f"[pic_rater] /标签 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "获取标签失败：请检查 picapi 是否在线。")
+            return
+
+        tags = data.get("tags") or []
+        if not tags:
+            if prefix:
+                yield event.plain_result(f"没有以‘{prefix}’开头的标签。试试更短的前缀，或直接 #标签 看最常用的。")
+            else:
+                yield event.plain_result("图库里还没有标签：先 #整理图库 同步一下 XMP 标签。")
+            return
+
+        head = f"以‘{prefix}’开头的标签" if prefix else "最常用的标签"
+        lines = [f"{_stale_note(data)}🏷️ {head}（前 {len(tags)} 个）："]
+        for t in tags:
+            tag = t.get("tag", "")
+            lines.append(f"- {tag}  ({int(t.get('count', 0))} 张)   →  {_random_cmd_for_tag(tag)}")
+        yield event.plain_result("\n".join(lines))
+
+    # 用法：#排行榜   或   #排行榜 20   或   #排行榜 均分 10
+    #   默认按贝叶斯均分（票数少的图向全站均分收缩，避免“一票 5 分”霸榜）
+    @filter.command("排行榜")
+    @_instrumented("排行榜")
+    @_admitted()
+    async def cmd_leaderboard(self, event: AstrMessageEvent, text: str = ""):
+        tokens = (text or "").strip().lower().split()
+        rank = "avg" if any(t in {"均分", "avg", "平均"} for t in tokens) else "bayes"
+        top = next((int(t) for t in tokens if t.isdigit()), 10)
+        top = max(1, min(top, 30))
+        try:
+            data = await self._get("/stats", top=top, rank=rank)
+            rows = data.get("top", [])
+            rows = [r for r in rows if int(r.get("cnt") or 0) > 0]
+            if not rows:
+                yield event.plain_result("还没有任何评分记录。")
+                return
+            title = "贝叶斯均分" if rank == "bayes" else "均分"
+            lines = [f"{_stale_note(data)}🏆 排行榜（按{title}，前 {len(rows)} 名）："]
+            for i, r in enumerate(rows, start=1):
+                name = r.get("filename") or (r.get("relpath") or "").split("/")[-1]
+                line = f"{i}. {name}  均分 {round(float(r.get('avg') or 0), 2)}（{r.get('cnt')} 次）"
+                if rank == "bayes":
+                    line += f"  加权 {round(float(r.get('bayes') or 0), 2)}"
+                lines.append(line)
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"[pic_rater] /排行榜 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "获取排行榜失败：请检查 picapi 是否在线。")
+
+    # 用法：#图片统计        -> 本会话上一张图的分数分布
+    #       #图片统计 2      -> 上一次 #来N张 里的第 2 张
+    @filter.command("图片统计")
+    @_instrumented("图片统计")
+    @_admitted()
+    async def cmd_image_stats(self, event: AstrMessageEvent, text: str = ""):
+        last = self.last_sent.get(self._session_key(event))
+        arg = (text or "").strip()
+        batch = (last or {}).get("batch") or []
+        if batch and arg.isdigit() and 1 <= int(arg) <= len(batch):
+            last = batch[int(arg) - 1]
+        if not last or not (last.get("id") or last.get("relpath")):
+            yield event.plain_result("本会话还没有发过图片，请先发送：#/来一张")
+            return
+        try:
+            data = await self._get("/stats/hist", id=last.get("id") or last.get("relpath"))
+            cnt = int(data.get("count") or 0)
+            if cnt == 0:
+                yield event.plain_result(f"ID {data.get('id')} 还没有人评分。")
+                return
+            peak = max(int(h.get("n") or 0) for h in data.get("hist", [])) or 1
+            lines = [f"{_stale_note(data)}📊 ID {data.get('id')}：均分 {data.get('avg')}，标准差 {data.get('std')}（共 {cnt} 次）"]
+            for h in data.get("hist", []):
+                n = int(h.get("n") or 0)
+                if n:
+                    lines.append(f"{float(h.get('score')):>3} 分 {'█' * max(1, round(12 * n / peak))} {n}")
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"[pic_rater] /图片统计 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "获取统计失败：请检查 picapi 是否在线。")
+
+    # 用法：#评分趋势   或   #评分趋势 7   或   #评分趋势 14 风景   或   #评分趋势 24h
+    @filter.command("评分趋势")
+    @_instrumented("评分趋势")
+    @_admitted()
+    async def cmd_rating_trend(self, event: AstrMessageEvent, text: str = ""):
+        gran, span, category = "day", 7, "*"
+        for tok in (text or "").strip().split():
+            low = tok.lower()
+            if low.endswith("h") and low[:-1].isdigit():
+                gran, span = "hour", int(low[:-1])
+            elif low.isdigit():
+                span = int(low)
+            else:
+                category = tok
+        try:
+            data = await self._get("/stats/rollup", gran=gran, span=max(1, min(span, 90 if gran == "day" else 72)), category=category)
+            series = data.get("series", [])
+            if not series:
+                yield event.plain_result("这段时间没有评分记录。")
+                return
+            fmt = "%m-%d" if gran == "day" else "%m-%d %H:00"
+            unit = "天" if gran == "day" else "小时"
+            lines = [f"{_stale_note(data)}📈 {'全站' if category == '*' else category} 最近 {span} {unit}的评分："]
+            for it in series:
+                lines.append(f"{time.strftime(fmt, time.localtime(int(it['ts'])))}  {it['n']} 次  均分 {it['avg']}")
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"[pic_rater] /评分趋势 失败: {e} rid={_CMD_RID.get()}")
+            yield event.plain_result(_busy_hint(e) or "获取评分趋势失败：请检查 picapi 是否在线。")
+
+    # 用法：#图库状态   —— 插件自身（各指令耗时拆成 picapi / 平台发送 / 插件）+ picapi 的健康与队列
+    @filter.command("图库状态")
+    @_instrumented("图库状态")
+    async def cmd_gallery_status(self, event: AstrMessageEvent, text: str = ""):
+        m = self._metrics
+
+        def fmt(v: Optional[float]) -> str:
+            if v is None:
+                return "-"
+            return f"{v * 1000:.0f}ms" if v < 1 else f"{v:.1f}s"
+
+        def fmt_age(sec: int) -> str:
+            h, rem = divmod(int(sec), 3600)
+            return f"{h}h{rem // 60:02d}m" if h else f"{rem // 60}m{rem % 60:02d}s"
+
+        lines = [
+            "🩺 图库状态",
+            f"插件：运行 {fmt_age(time.time() - m.started)}，进行中 {m.inflight_cmds - 1} 条指令 / "
+            f"{m.inflight_api} 个 picapi 请求，last_sent {len(self.last_sent)} 个会话，响应缓存 {len(self._resp_cache)} 条",
+        ]
+        cmds = sorted({cmd for cmd, _ in m.hist}, key=lambda c: -m.count(c))
+        if cmds:
+            lines.append("指令耗时 p50/p95（总 = picapi + 发送 + 插件）：")
+            for cmd in cmds:
+                parts = "  ".join(f"{label} {fmt(m.quantile(cmd, part, 0.5))}/{fmt(m.quantile(cmd, part, 0.95))}"
+                                  for part, label in (("total", "总"), ("api", "picapi"), ("send", "发送"), ("bot", "插件")))
+                lines.append(f"- {cmd} ×{m.count(cmd)}：{parts}")
+        adm = self._admission
+        if adm.rejected or adm.running:
+            rej = "，".join(f"{label}×{adm.rejected[k]}" for k, label in
+                           (("rate", "限流"), ("write_rate", "评分限流"), ("inflight", "满载"),
+                            ("single_flight", "重复维护")) if adm.rejected.get(k))
+            lines.append(f"准入：进行中 {adm.inflight}/{adm.max_inflight or '∞'}"
+                         + (f"，拒绝 {rej}" if rej else "")
+                         + (f"，维护中 {'、'.join(c.removeprefix('cmd_') for c in adm.running)}" if adm.running else ""))
+        if m.api_errors:
+            errs = "，".join(f"{k}×{v}" for k, v in sorted(m.api_errors.items(), key=lambda kv: -kv[1]))
+            lines.append(f"picapi 错误：{errs}")
+        tail = m.tail
+        if any(tail.values()):
+            lines.append(f"尾延迟保护：对冲 {tail['hedged']} 次（对冲先回 {tail['hedge_won']}），超预算 {tail['over_budget']}，"
+                         f"熔断拦下 {tail['short_circuit']}，按 Retry-After 退避 {tail['backoff']}，降级用旧数据 {tail['stale']}")
+        for u, br in self._breakers.items():
+            bs = br.stats()
+            if len(self._reads.urls) > 1 or bs["state"] != "closed" or bs["busy_s"]:
+                ew = self._reads.stats()[u]
+                wait = f"{bs['retry_in_s']:g}s 后" if bs["retry_in_s"] else "下次请求时"
+                state = {"open": f"熔断中（{wait}探测）", "half_open": "探测中"}.get(bs["state"], "")
+                if bs["busy_s"]:
+                    left = "，".join(f"{_CLS_LABELS.get(c, c)}还剩 {s:g}s" for c, s in bs["busy_s"].items())
+                    state = "，".join(x for x in (state, f"按 Retry-After 退避中（{left}）") if x)
+                lines.append(f"- 端点 {u}：EWMA {ew['ewma_ms']}ms{'（冷却中）' if ew['down'] else ''}"
+                             + (f"，{state}" if state else "") + (f"，累计熔断 {bs['opened']} 次" if bs["opened"] else ""))
+
+        # picapi 自己的数字（只问 primary：维护任务和写入都在那边）；primary 熔断中就不去等它
+        if not self._breakers[self.base_url].ready(None):
+            lines.append("picapi：primary 熔断中，跳过取状态")
+            yield event.plain_result("\n".join(lines))
+            return
+        try:
+            async with self._metrics.api("/admin/status"):
+                r = await self._http().get(f"{self.base_url}/admin/status", timeout=10.0)
+                r.raise_for_status()
+            st = r.json()
+            lines.append(f"picapi（{st.get('role')}，pid {st.get('pid')}）：运行 {fmt_age(st.get('uptime_s') or 0)}，"
+                         f"图片 {st.get('images', '?')} 张，进行中 {st.get('in_flight')} 个请求，"
+                         f"累计 {st.get('requests')} 个请求 / 5xx {st.get('errors_5xx')}")
+            job = st.get("job") or {}
+            if job.get("phase", "idle") != "idle":
+                bar = self._render_bar(int(job.get("done") or 0), int(job.get("total") or 0))
+                lines.append(f"维护任务：{job['phase']} {bar}")
+            elif st.get("maintenance_running"):
+                lines.append("维护任务：进行中（无进度信息）")
+            watch = st.get("watch") or {}
+            if watch.get("mode") not in (None, "off"):
+                lines.append(f"文件监听：{watch['mode']}，待落库 {watch.get('pending', 0)}")
+            if st.get("replica_age_s") is not None:
+                lines.append(f"副本：距上次同步 {st['replica_age_s']}s")
+            gates = st.get("admission") or {}
+            busy = [f"{k} {g.get('in_flight')}/{g.get('limit')}（拒绝 {g.get('rejected')}）"
+                    for k, g in gates.items() if g.get("rejected") or g.get("waiting")]
+            if busy:
+                lines.append("picapi 准入：" + "，".join(busy))
+            slow = st.get("slow_routes") or []
+            if slow:
+                lines.append("最慢的接口（均值）：" + "，".join(f"{x['route']} {x['mean_ms']}ms×{x['n']}" for x in slow))
+        except Exception as e:
+            lines.append(f"picapi：取状态失败（{type(e).__name__}: {e}）")
 
+        yield event.plain_result("\n".join(lines))
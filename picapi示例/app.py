@@ -1,15 +1,33 @@
-from fastapi import FastAPI, HTTPException, Query, Body
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Query, Body, Request, Response
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from pathlib import Path
-from typing import Optional, List, Tuple
-import os, random, sqlite3, time, hashlib, urllib.parse, subprocess, math
+from typing import Callable, Optional, List, Tuple
+import os, random, sqlite3, time, hashlib, urllib.parse, subprocess, math, heapq, mmap, struct, shutil
+import urllib.request, urllib.error
 import json
 from fastapi import Body  # 新增：用于接收 JSON body
 from pydantic import BaseModel, Field
 import shlex
 from fastapi import Query
-from threading import Lock
+from threading import Lock, Event, Thread
+from collections import OrderedDict
+from array import array
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+import functools, contextvars, re, uuid, logging, sys, threading, selectors, asyncio
+from collections import deque
+
+try:  # 多 worker 间的互斥靠 flock；没有 fcntl 的平台（Windows）退回进程内锁，只适合单 worker
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:  # 可选依赖：没装 Pillow 时派生图功能自动关闭，直接回原图
+    from PIL import Image, ImageOps
+except Exception:
+    Image = ImageOps = None
 
 _progress = {"phase":"idle", "total":0, "done":0, "started":0, "updated":0}
 _prog_lock = Lock()
@@ -22,6 +40,20 @@ PICK_BIAS = os.environ.get("PICK_BIAS", "min").lower()      # off|min|weighted
 PICK_BIAS_ALPHA = float(os.environ.get("PICK_BIAS_ALPHA", "1.0"))  # weighted 的指数
 
 FTS_TABLE = os.environ.get("FTS_TABLE", "images_fts")
+TAG_PREFIX_MAX = int(os.environ.get("TAG_PREFIX_MAX", "8"))   # /tags 前缀索引展开到几个字符；更长的前缀走范围扫描
+TAG_INDEX = os.environ.get("TAG_INDEX", "on").lower() in {"1", "true", "yes", "on"}   # tag= 布尔表达式用的内存位图
+TAG_INDEX_MIN_INTERVAL = float(os.environ.get("TAG_INDEX_MIN_INTERVAL", "2"))  # 标签变了以后多久重建一次（秒）
+TAG_POOL_CACHE = int(os.environ.get("TAG_POOL_CACHE", "64"))   # 每个 worker 缓存最近多少个 tag= 表达式的命中集合
+# 感知哈希（dHash，64 位）：相似图 / 重复图；算哈希要 Pillow
+PHASH = os.environ.get("PHASH", "on").lower() in {"1", "true", "yes", "on"}
+PHASH_MIN_INTERVAL = float(os.environ.get("PHASH_MIN_INTERVAL", "5"))   # 哈希变了以后多久重建一次内存索引（秒）
+PHASH_SIMILAR_RADIUS = int(os.environ.get("PHASH_SIMILAR_RADIUS", "12"))  # /similar 默认的汉明半径
+PHASH_DUP_RADIUS = int(os.environ.get("PHASH_DUP_RADIUS", "4"))          # 距离不超过它算“重复图”
+PHASH_MAX_RADIUS = 16                                                    # 半径越大每个分块要试的键越多
+# 拼音/首字母检索：q 是纯字母时（fengjing / fj）先经 pinyin_map 换成图库里实际出现过的汉字串，再和原词一起检索
+PINYIN = os.environ.get("PINYIN", "on").lower() in {"1", "true", "yes", "on"}
+PINYIN_TABLE = Path(os.environ.get("PINYIN_TABLE", str(Path(__file__).with_name("pinyin.txt"))))   # 随 app.py 一起分发
+PINYIN_MAX_ALTS = int(os.environ.get("PINYIN_MAX_ALTS", "20"))   # 一个拼音词最多换成几个汉字串
 
 GALLERY_DIR = Path(os.environ.get("GALLERY_DIR", "/data/gallery")).resolve()
 STATIC_PREFIX = os.environ.get("STATIC_PREFIX", "/static")
@@ -29,22 +61,715 @@ ALLOWED_SUFFIXES = tuple(
     s.strip().lower() for s in os.environ.get("ALLOWED_SUFFIXES", ".jpg,.jpeg,.png,.gif,.webp").split(",")
 )
 RECURSIVE = os.environ.get("RECURSIVE", "true").lower() in {"1", "true", "yes"}
-DB_PATH = Path("/data/db/picapi.sqlite")
+DB_PATH = Path(os.environ.get("DB_PATH", "/data/db/picapi.sqlite"))
+# 部署角色：primary 负责写库与维护任务；replica 只读，定期从 primary 拉整库快照，/rate 转发给 primary
+PICAPI_ROLE = os.environ.get("PICAPI_ROLE", "primary").lower()
+IS_REPLICA = PICAPI_ROLE == "replica"
+PRIMARY_URL = os.environ.get("PRIMARY_URL", "").rstrip("/")
+REPLICA_PULL_INTERVAL = float(os.environ.get("REPLICA_PULL_INTERVAL", "30"))   # 副本多久拉一次（秒）
 WRITE_META_MIN_COUNT = int(os.environ.get("WRITE_META_MIN_COUNT", "1"))
 SCORE_PRECISION = int(os.environ.get("SCORE_PRECISION", "2"))
+RANDOM_PICS_MAX = int(os.environ.get("RANDOM_PICS_MAX", "20"))   # /random_pics 单次最多几张
+# 文件监听：off | auto（有 watchdog 用 inotify，否则轮询）| inotify | poll（网络盘用这个）
+WATCH = os.environ.get("WATCH", "off").lower()
+WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", "2.0"))       # 静默多少秒后落库一批
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", "30"))
+WATCH_BATCH = int(os.environ.get("WATCH_BATCH", "200"))               # 每个事务最多处理多少个路径
+FP_BLOCK = int(os.environ.get("FP_BLOCK", "16384"))             # 内容指纹读取文件头尾各多少字节
+CURSOR_TTL = int(os.environ.get("CURSOR_TTL", "3600"))          # 不重复游标闲置多久回收（秒）
+CURSOR_MAX = int(os.environ.get("CURSOR_MAX", "20000"))         # 游标最多保留多少个（超出按 LRU 淘汰）
+CURSOR_BIAS_WINDOW = int(os.environ.get("CURSOR_BIAS_WINDOW", "64"))  # 带 bias 时游标每次在接下来多少张里按 bias 挑
+SCOPE_POOL_CACHE = int(os.environ.get("SCOPE_POOL_CACHE", "64"))  # 每个 worker 缓存最近多少个带 scope 的分类/检索候选集合
+BAYES_M = float(os.environ.get("BAYES_M", "5"))                 # 贝叶斯均分的“最少票数”先验权重
+BAYES_PRIOR = float(os.environ.get("BAYES_PRIOR", "2.5"))       # 还没有任何评分时的先验均分
+# 紧凑索引快照：随机出图/分类过滤直接在 mmap 上做，不再逐请求扫盘（需 RECURSIVE=true，且图已 reindex 入库）
+INDEX_SNAPSHOT = os.environ.get("INDEX_SNAPSHOT", "off").lower() in {"1", "true", "yes", "on"}
+INDEX_SNAPSHOT_PATH = Path(os.environ.get("INDEX_SNAPSHOT_PATH", str(DB_PATH.parent / "gallery.idx")))
+INDEX_SNAPSHOT_MIN_INTERVAL = float(os.environ.get("INDEX_SNAPSHOT_MIN_INTERVAL", "5"))  # 后台重建最短间隔（秒）
+
+# 派生图（聊天压缩版/缩略图）：按需生成，落盘缓存，按总字节数 LRU 淘汰
+DERIV_DIR = Path(os.environ.get("DERIV_DIR", "/data/db/deriv"))
+DERIV_PREFIX = os.environ.get("DERIV_PREFIX", "/deriv")
+DERIV_MAX_BYTES = int(float(os.environ.get("DERIV_MAX_MB", "2048")) * 1024 * 1024)
+DERIV_DEFAULT_PRESET = os.environ.get("DERIV_DEFAULT_PRESET", "")   # random_pic 没带 preset 时用哪个；空=原图
+# 名称=最长边:格式:质量，逗号分隔
+DERIV_PRESETS_RAW = os.environ.get("DERIV_PRESETS", "chat=1600:jpeg:85,thumb=320:webp:75")
+
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", "86400"))   # /static 的 Cache-Control max-age（秒）
+
+# 多 worker（uvicorn --workers N）协调用的小文件，与数据库放一起
+RUN_DIR = Path(os.environ.get("RUN_DIR", str(DB_PATH.parent)))
+
+METRICS = os.environ.get("METRICS", "on").lower() in {"1", "true", "yes", "on"}   # /admin/metrics 与热路径计时
+
+# 请求追踪（/admin/traces）：纯内存环形缓冲，不依赖任何追踪后端
+TRACE = os.environ.get("TRACE", "on").lower() in {"1", "true", "yes", "on"}
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", "1000"))          # 最近 N 个请求
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "500"))       # 超过这个耗时另存一份并打 WARNING
+TRACE_SLOW_BUFFER = int(os.environ.get("TRACE_SLOW_BUFFER", "200")) # 慢请求单独留 N 个，不被快请求挤掉
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "300"))     # 单个请求最多记多少段，超出只计数
+
+# 慢 SQL 日志（/admin/slow_queries）：超过阈值的语句按“形状”（去掉字面量后的 SQL）汇总，首次出现时抓 EXPLAIN QUERY PLAN
+SLOW_SQL_MS = float(os.environ.get("SLOW_SQL_MS", "200"))           # <=0 关闭
+SLOW_SQL_SHAPES = int(os.environ.get("SLOW_SQL_SHAPES", "500"))     # 最多记多少种形状，超出只计数
+
+# 采样剖析（/admin/profile）：单次最长多少秒
+PROFILE_MAX_S = float(os.environ.get("PROFILE_MAX_S", "60"))
+
+# 准入控制：每个 worker 按接口类别限并发，满了短暂排队，排不上直接 503 + Retry-After（不无限堆在线程池里）
+# 三类加起来要小于 anyio 线程池（默认 40），给 /admin/status、/health 等留出线程
+ADMIT = os.environ.get("ADMIT", "on").lower() in {"1", "true", "yes", "on"}
+ADMIT_PICKS = int(os.environ.get("ADMIT_PICKS", "24"))      # 出图/检索/列表等读接口
+ADMIT_WRITES = int(os.environ.get("ADMIT_WRITES", "8"))     # /rate 等写接口
+ADMIT_MAINT = int(os.environ.get("ADMIT_MAINT", "2"))       # /reindex、/sync_subjects、POST /admin/*
+ADMIT_QUEUE = int(os.environ.get("ADMIT_QUEUE", "16"))      # 每类最多几个请求排队等位
+ADMIT_WAIT_MS = float(os.environ.get("ADMIT_WAIT_MS", "250"))  # 排队最多等多久；<=0 不排队
+
+log = logging.getLogger("picapi")
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles 自带 ETag/Last-Modified/304 与 Range；这里补上 Cache-Control"""
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers.setdefault("Cache-Control", f"public, max-age={STATIC_MAX_AGE}")
+        return resp
+
 
 app = FastAPI(title="Picture API with Ratings", version="2.0.0")
-app.mount(STATIC_PREFIX, StaticFiles(directory=str(GALLERY_DIR), html=False), name="static")
+app.mount(STATIC_PREFIX, CachedStaticFiles(directory=str(GALLERY_DIR), html=False), name="static")
+
+# ===== 指标（/admin/metrics，Prometheus 文本格式）=====
+# 全在进程内：每个指标族是 {标签值元组: 数值/桶计数} + 一把锁，热路径上只多两次 perf_counter 和一次 bisect。
+# 多 worker 时各 worker 各记各的（picapi_worker_info 带 pid），抓到哪个 worker 就是哪个的数，按 pid 聚合即可。
+_LAT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+_metrics_registry: list = []
+
+
+def _fmt_num(v) -> str:
+    if isinstance(v, float):
+        return repr(int(v)) + ".0" if v.is_integer() and abs(v) < 1e15 else repr(v)
+    return str(v)
+
+
+def _fmt_labels(names, values) -> str:
+    if not names:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(names, esc)) + "}"
+
+
+class _Metric:
+    """一个指标族：counter / gauge / histogram；values 以标签值元组为键"""
+
+    def __init__(self, name: str, kind: str, help_: str, labels: Tuple[str, ...] = (), buckets=None):
+        self.name, self.kind, self.help, self.labels = name, kind, help_, labels
+        self.buckets = tuple(buckets or ())
+        self.values: dict = {}
+        self.lock = Lock()
+        _metrics_registry.append(self)
+
+    def inc(self, *labels, by: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + by
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)       # 第一个 >= value 的桶（le 语义）；超出最大桶落在 +Inf
+        with self.lock:
+            h = self.values.get(labels)
+            if h is None:
+                h = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += value
+
+    def get(self, *labels, default=0):
+        with self.lock:
+            v = self.values.get(labels, default)
+            return list(v) if isinstance(v, list) else v
+
+    def render(self, out: List[str]):
+        with self.lock:
+            items = sorted((k, list(v) if isinstance(v, list) else v) for k, v in self.values.items())
+        if not items:
+            return
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for labels, v in items:
+            if self.kind != "histogram":
+                out.append(f"{self.name}{_fmt_labels(self.labels, labels)} {_fmt_num(v)}")
+                continue
+            acc = 0
+            names = self.labels + ("le",)
+            for b, c in zip(self.buckets, v):
+                acc += c
+                out.append(f"{self.name}_bucket{_fmt_labels(names, labels + (_fmt_num(b),))} {acc}")
+            acc += v[len(self.buckets)]
+            out.append(f"{self.name}_bucket{_fmt_labels(names, labels + ('+Inf',))} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, labels)} {_fmt_num(round(v[-1], 6))}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, labels)} {acc}")
+
+
+_M_HTTP = _Metric("picapi_http_request_duration_seconds", "histogram", "HTTP 请求耗时（按路由模板）",
+                  ("route", "method", "status"), _LAT_BUCKETS)
+_M_INFLIGHT = _Metric("picapi_http_requests_in_flight", "gauge", "正在处理的请求数")
+_M_SQL = _Metric("picapi_sqlite_query_seconds", "histogram", "SQLite execute 耗时（按语句标签：动词:表）",
+                 ("stmt",), _LAT_BUCKETS)
+_M_SQL_FETCH = _Metric("picapi_sqlite_fetch_seconds_total", "counter", "fetchall 取结果的累计耗时（按语句标签）", ("stmt",))
+_M_EXIF = _Metric("picapi_exiftool_seconds", "histogram", "exiftool 单次调用耗时", ("op",), _LAT_BUCKETS)
+_M_EXIF_CALLS = _Metric("picapi_exiftool_calls_total", "counter", "exiftool 调用次数", ("op", "result"))
+_M_WALKED = _Metric("picapi_files_walked_total", "counter", "扫盘遍历到的图片文件数", ("op",))
+_M_WALKED_REQ = _Metric("picapi_request_files_walked", "histogram", "单个请求里扫盘遍历的图片文件数",
+                        ("route",), _COUNT_BUCKETS)
+_M_CACHE = _Metric("picapi_cache_requests_total", "counter", "各缓存的命中/未命中次数", ("cache", "result"))
+_M_ADMIT_REJECT = _Metric("picapi_admission_rejected_total", "counter", "准入控制拒掉（503）的请求数（按接口类别）", ("cls",))
+_M_ADMIT_WAIT = _Metric("picapi_admission_wait_seconds", "histogram", "拿到执行名额前排队等了多久", ("cls",), _LAT_BUCKETS)
+_M_GAUGE = {}   # 抓取时现算的状态量，在 /admin/metrics 里按需创建
+
+_walk_ctr: contextvars.ContextVar = contextvars.ContextVar("picapi_walk_ctr", default=None)
+
+
+def _count_walked(op: str, n: int):
+    """扫盘计数：全局按 op 累计；在请求里时也记到该请求头上（请求结束时进直方图）"""
+    if not METRICS or not n:
+        return
+    _M_WALKED.inc(op, by=n)
+    ctr = _walk_ctr.get()
+    if ctr is not None:
+        ctr[0] += n
+
+
+# ===== 请求追踪：X-Request-ID + 分段耗时 =====
+_RID_RE = re.compile(r"[^A-Za-z0-9._:-]")
+
+
+class _Trace:
+    __slots__ = ("rid", "method", "route", "path", "t0", "ts", "spans", "dropped", "depth", "agg", "status", "ms")
+
+    def __init__(self, rid: str, method: str, path: str):
+        self.rid, self.method, self.path = rid, method, path
+        self.route = "unmatched"
+        self.t0 = time.perf_counter()
+        self.ts = time.time()
+        self.spans = []          # (name, 起点 ms, 耗时 ms, 嵌套深度, attrs)
+        self.dropped = 0
+        self.depth = 0
+        self.agg = {}            # name -> [次数, 总 ms]，超出 TRACE_MAX_SPANS 的段也算在内
+        self.status = 0
+        self.ms = 0.0
+
+    def as_dict(self, with_spans: bool = True) -> dict:
+        d = {"rid": self.rid, "method": self.method, "route": self.route, "path": self.path,
+             "status": self.status, "ms": round(self.ms, 2), "ts": round(self.ts, 3),
+             "by_name": sorted(({"name": k, "n": v[0], "ms": round(v[1], 2)} for k, v in self.agg.items()),
+                               key=lambda x: -x["ms"])}
+        if with_spans:
+            d["spans"] = [{"name": n, "at_ms": round(a, 2), "ms": round(m, 2), "depth": dp, **(at or {})}
+                          for n, a, m, dp, at in self.spans]
+            d["spans_dropped"] = self.dropped
+        return d
+
+
+_trace_cur: contextvars.ContextVar = contextvars.ContextVar("picapi_trace", default=None)
+_traces_recent: deque = deque(maxlen=max(1, TRACE_BUFFER))
+_traces_slow: deque = deque(maxlen=max(1, TRACE_SLOW_BUFFER))
+_traces_lock = Lock()
+
+
+@contextmanager
+def _span(name: str, **attrs):
+    """给当前请求记一段耗时；不在请求里（后台线程、TRACE=off）时什么也不做。yield 出的 dict 可以往里补字段"""
+    tr = _trace_cur.get()
+    if tr is None:
+        yield attrs
+        return
+    t0 = time.perf_counter()
+    tr.depth += 1
+    try:
+        yield attrs
+    finally:
+        tr.depth -= 1
+        t1 = time.perf_counter()
+        ms = (t1 - t0) * 1000
+        a = tr.agg.get(name)
+        if a is None:
+            tr.agg[name] = [1, ms]
+        else:
+            a[0] += 1
+            a[1] += ms
+        if len(tr.spans) < TRACE_MAX_SPANS:
+            tr.spans.append((name, (t0 - tr.t0) * 1000, ms, tr.depth, attrs or None))
+        else:
+            tr.dropped += 1
+
+
+def _trace_finish(tr: "_Trace"):
+    tr.spans.sort(key=lambda s: s[1])       # 嵌套段是先结束先入列的，按起点排回时间顺序
+    with _traces_lock:
+        _traces_recent.append(tr)
+        if tr.ms >= TRACE_SLOW_MS:
+            _traces_slow.append(tr)
+    if tr.ms >= TRACE_SLOW_MS:
+        top = sorted(tr.agg.items(), key=lambda kv: -kv[1][1])[:4]
+        log.warning("slow request rid=%s %s %s -> %s in %.0fms; %s", tr.rid, tr.method, tr.route, tr.status, tr.ms,
+                    ", ".join(f"{k}={v[1]:.0f}ms/{v[0]}" for k, v in top) or "no spans")
+
+
+def _cache_event(cache: str, hit: bool):
+    if METRICS:
+        _M_CACHE.inc(cache, "hit" if hit else "miss")
+
+
+_STMT_RE = re.compile(r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER|ON)\s+"
+                      r"(?:IF\s+(?:NOT\s+)?EXISTS\s+)?[\"\[`]?(\w+))?", re.I | re.S)
+_stmt_labels: dict = {}
+
+
+def _stmt_label(sql: str) -> str:
+    """SQL → 低基数标签：动词:主表（select:images、insert:ratings、pragma:journal_mode…）"""
+    lbl = _stmt_labels.get(sql)
+    if lbl is None:
+        m = _STMT_RE.match(sql)
+        verb = (m.group(1) if m else "other").lower()
+        if verb in ("update", "pragma"):
+            tbl = re.match(r"\s*\w+\s+(?:OR\s+\w+\s+)?[\"\[`]?(\w+)", sql, re.I)
+            tbl = tbl.group(1) if tbl else ""
+        else:
+            tbl = (m.group(2) if m else "") or ""
+        lbl = f"{verb}:{tbl.lower()}" if tbl else verb
+        if len(_stmt_labels) < 4096:          # 动态拼的 IN (?,?,…) 会有很多变体，够用就不再记
+            _stmt_labels[sql] = lbl
+    return lbl
+
+
+_SQL_STR_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUM_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_SQL_IN_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_sql_shapes: dict = {}
+_slow_sql: dict = {}            # 形状 -> 汇总
+_slow_sql_dropped = [0]         # 形状数到上限后没记上的慢语句
+_slow_sql_lock = Lock()
+_EXPLAINABLE = {"select", "insert", "update", "delete", "replace", "with"}
+
+
+def _sql_shape(sql: str) -> str:
+    """归一化 SQL：字符串/数字字面量换成 ?，IN (?,?,…) 折成一个，空白压成单个空格"""
+    shape = _sql_shapes.get(sql)
+    if shape is None:
+        shape = _SQL_STR_RE.sub("?", sql)
+        shape = _SQL_NUM_RE.sub("?", shape)
+        shape = " ".join(shape.split())
+        shape = _SQL_IN_RE.sub("(?,…)", shape)
+        if len(_sql_shapes) < 4096:
+            _sql_shapes[sql] = shape
+    return shape
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params) -> List[str]:
+    """EXPLAIN QUERY PLAN，按 parent 缩进成几行文本；用原生游标，不会再被计时/追踪"""
+    try:
+        rows = conn.cursor().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"(explain failed: {e})"]
+    depth = {0: -1}
+    out = []
+    for node, parent, _unused, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        out.append("  " * depth[node] + detail)
+    return out
+
+
+def _slow_sql_record(cur: sqlite3.Cursor, sql: str, params, nparams: int, ms: float, label: str, many: bool):
+    shape = _sql_shape(sql)
+    tr = _trace_cur.get()
+    new = False
+    with _slow_sql_lock:
+        st = _slow_sql.get(shape)
+        if st is None and len(_slow_sql) < SLOW_SQL_SHAPES:
+            st = _slow_sql[shape] = {"stmt": label, "sql": shape, "params": nparams, "many": many,
+                                     "n": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ts": 0, "last_rid": None,
+                                     "plan": None}
+            new = True
+        if st is None:
+            _slow_sql_dropped[0] += 1
+        else:
+            st["n"] += 1
+            st["total_ms"] += ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            st["last_ts"] = int(time.time())
+            st["last_rid"] = tr.rid if tr is not None else None
+    plan = None
+    if new and label.split(":", 1)[0] in _EXPLAINABLE:
+        plan = _explain(cur.connection, sql, params)       # 同一形状只抓一次
+        st["plan"] = plan
+    log.warning("slow sql %.1fms rid=%s params=%d%s: %s%s", ms, tr.rid if tr is not None else "-", nparams,
+                " (executemany)" if many else "", shape[:500],
+                "".join("\n    " + ln for ln in plan) if plan else "")
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """计时游标：SQLite 直方图（METRICS）、追踪分段（TRACE）、慢 SQL 日志（SLOW_SQL_MS）都在这里记"""
+    _label = ""
+    _slow = None        # 还没记慢日志的 (sql, params, execute 耗时 ms)：fetchall 取完再合计判断一次
+
+    def execute(self, sql, *args):
+        self._label = _stmt_label(sql)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            with _span("sql " + self._label):
+                res = super().execute(sql, *args)
+            ok = True
+            return res
+        finally:
+            dt = time.perf_counter() - t0
+            if METRICS:
+                _M_SQL.observe(dt, self._label)
+            self._slow = None
+            if ok and SLOW_SQL_MS > 0:
+                params = args[0] if args else ()
+                if dt * 1000 >= SLOW_SQL_MS:
+                    _slow_sql_record(self, sql, params, len(params), dt * 1000, self._label, False)
+                else:
+                    self._slow = (sql, params, dt * 1000)
+
+    def executemany(self, sql, *args):
+        self._label = _stmt_label(sql)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            with _span("sql " + self._label, many=True):
+                res = super().executemany(sql, *args)
+            ok = True
+            return res
+        finally:
+            dt = time.perf_counter() - t0
+            if METRICS:
+                _M_SQL.observe(dt, self._label)
+            self._slow = None
+            if ok and SLOW_SQL_MS > 0 and dt * 1000 >= SLOW_SQL_MS:
+                # 参数序列可能是生成器、已经用完了：EXPLAIN 用同样个数的 NULL 占位
+                n = sql.count("?")
+                _slow_sql_record(self, sql, (None,) * n, n, dt * 1000, self._label, True)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            dt = time.perf_counter() - t0
+            if METRICS:
+                _M_SQL_FETCH.inc(self._label or "other", by=dt)
+            # SELECT 的扫描大多发生在取结果时：execute + fetchall 合计超阈值也算慢
+            if self._slow is not None:
+                sql, params, exec_ms = self._slow
+                self._slow = None
+                if exec_ms + dt * 1000 >= SLOW_SQL_MS:
+                    _slow_sql_record(self, sql, params, len(params), exec_ms + dt * 1000, self._label, False)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """db() 用的连接类：conn.execute / executemany 走计时游标（METRICS、TRACE、慢 SQL 日志都关时直接用原生连接）"""
+
+    def execute(self, sql, *args):
+        return self.cursor(_TimedCursor).execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor(_TimedCursor).executemany(sql, *args)
+
+
+_SQL_FACTORY = _TimedConnection if (METRICS or TRACE or SLOW_SQL_MS > 0) else sqlite3.Connection
+
+
+def _exiftool(op: str, args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run 的计时版：所有 exiftool 调用都走这里，按 op 记耗时与成败"""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        with _span("exiftool." + op):
+            res = subprocess.run(args, **kwargs)
+        ok = res.returncode == 0
+        return res
+    finally:
+        if METRICS:
+            _M_EXIF.observe(time.perf_counter() - t0, op)
+            _M_EXIF_CALLS.inc(op, "ok" if ok else "error")
+
+
+_TRACE_SKIP = ("/admin/traces", "/admin/metrics")
+
+
+class _ObserveMiddleware:
+    """纯 ASGI 中间件（比 BaseHTTPMiddleware 开销小）：
+    - METRICS：按路由模板记耗时/状态码，并汇总本请求扫了多少文件
+    - TRACE：读取或生成 X-Request-ID 并回写到响应头，本请求内的各段耗时挂到这个 ID 上"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = [500]
+        walked = [0]
+        token = _walk_ctr.set(walked)
+        tr = tr_token = None
+        rid = b""
+        if TRACE:
+            raw = next((v for k, v in scope["headers"] if k == b"x-request-id"), b"")
+            rid = _RID_RE.sub("", raw.decode("latin-1"))[:64] or uuid.uuid4().hex[:16]
+            path = scope["path"]
+            if not path.startswith(STATIC_PREFIX) and not path.startswith(_TRACE_SKIP):
+                tr = _Trace(rid, scope["method"], path)
+                tr_token = _trace_cur.set(tr)
+            rid = rid.encode("latin-1")
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if rid:
+                    message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", rid)]
+            await send(message)
+
+        t0 = time.perf_counter()
+        if METRICS:
+            _M_INFLIGHT.inc(by=1)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if METRICS:
+                _M_INFLIGHT.inc(by=-1)
+                _M_HTTP.observe(time.perf_counter() - t0, route, scope["method"], str(status[0]))
+                if walked[0]:
+                    _M_WALKED_REQ.observe(walked[0], route)
+            _walk_ctr.reset(token)
+            if tr is not None:
+                _trace_cur.reset(tr_token)
+                tr.route, tr.status, tr.ms = route, status[0], (time.perf_counter() - t0) * 1000
+                _trace_finish(tr)
+
+
+# ===== 准入控制 =====
+# 中间件在路由之前按 方法 + 路径 归类；/static、/deriv、GET /admin/*、/health 不限，出问题时照样能看状态。
+# 计数只在事件循环线程里改，不用加锁；多 worker 时每个进程各限各的。
+class _Gate:
+    def __init__(self, name: str, limit: int):
+        self.name, self.limit = name, max(1, limit)
+        self.sem = asyncio.Semaphore(self.limit)
+        self.in_flight = self.waiting = self.rejected = 0
+        self.hold = 0.0     # 占用一个名额的平均时长（EWMA，秒）
+
+    def retry_after(self) -> int:
+        """前面排着的都做完大约要多久"""
+        return max(1, math.ceil(self.hold * (self.waiting + 1) / self.limit))
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting,
+                "rejected": self.rejected, "hold_ms": round(self.hold * 1000, 1)}
+
+
+_GATES = {"picks": _Gate("picks", ADMIT_PICKS), "writes": _Gate("writes", ADMIT_WRITES),
+          "maintenance": _Gate("maintenance", ADMIT_MAINT)}
+_ADMIT_FREE_POST = {"/admin/slow_queries/reset"}
+
+
+def _admit_class(method: str, path: str) -> Optional[str]:
+    if path.startswith(STATIC_PREFIX) or path.startswith(DERIV_PREFIX) or path == "/health":
+        return None
+    if method == "POST":
+        if path in ("/reindex", "/sync_subjects") or (path.startswith("/admin/") and path not in _ADMIT_FREE_POST):
+            return "maintenance"
+        return "writes"
+    if path.startswith("/admin/"):
+        return None
+    return "picks"
+
+
+class _AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        gate = _GATES.get(_admit_class(scope["method"], scope["path"])) if scope["type"] == "http" else None
+        if gate is None:
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        if gate.sem.locked():
+            if ADMIT_WAIT_MS <= 0 or gate.waiting >= ADMIT_QUEUE:
+                return await self._reject(gate, send)
+            gate.waiting += 1
+            try:
+                await asyncio.wait_for(gate.sem.acquire(), ADMIT_WAIT_MS / 1000)
+            except asyncio.TimeoutError:
+                return await self._reject(gate, send)
+            finally:
+                gate.waiting -= 1
+        else:
+            await gate.sem.acquire()
+        if METRICS:
+            _M_ADMIT_WAIT.observe(time.perf_counter() - t0, gate.name)
+        gate.in_flight += 1
+        t1 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.in_flight -= 1
+            gate.sem.release()
+            dt = time.perf_counter() - t1
+            gate.hold = dt if gate.hold == 0 else gate.hold + 0.1 * (dt - gate.hold)
+
+    @staticmethod
+    async def _reject(gate: _Gate, send):
+        gate.rejected += 1
+        if METRICS:
+            _M_ADMIT_REJECT.inc(gate.name)
+        body = json.dumps({"detail": f"busy: {gate.name} {gate.in_flight}/{gate.limit} in flight, "
+                                     f"{gate.waiting} waiting; retry later"}).encode()
+        await send({"type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(gate.retry_after()).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+# 先加的在里层：被拒的请求照样经过 _ObserveMiddleware 计数、带 X-Request-ID
+if ADMIT:
+    app.add_middleware(_AdmissionMiddleware)
+if METRICS or TRACE:
+    app.add_middleware(_ObserveMiddleware)
+
+# ===== 多 worker 协调 =====
+# - 进度：写进 RUN_DIR/picapi.progress（mmap 的定长记录），任何 worker 的 /admin/sync_progress 都读到同一份；
+#   写方只有持有维护锁的那个任务，读方用序号（奇数=正在写）避免读到写了一半的记录
+# - 重活（reindex / sync_subjects / FTS 重建 / 排行重算）用 flock 互斥，抢不到直接 409，不排队也不重复干活
+# - 其余缓存都以 meta.gen 为键（/dirs、/stats 的 ETag 等），任何 worker 写库都会 _bump_gen，天然全局失效
+_PROG_REC = struct.Struct("<Q32sqqqqq")   # seq, phase, total, done, started, updated, pid
+_prog_mm: list = [None]
+
+
+def _prog_map():
+    if _prog_mm[0] is None:
+        RUN_DIR.mkdir(parents=True, exist_ok=True)
+        fd = os.open(RUN_DIR / "picapi.progress", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _PROG_REC.size:
+                os.ftruncate(fd, _PROG_REC.size)
+            _prog_mm[0] = mmap.mmap(fd, _PROG_REC.size)
+        finally:
+            os.close(fd)
+    return _prog_mm[0]
+
+
+def _prog_publish():
+    """把本进程的 _progress 写进共享记录（调用方持有 _prog_lock）"""
+    mm = _prog_map()
+    seq = struct.unpack_from("<Q", mm, 0)[0]
+    struct.pack_into("<Q", mm, 0, seq | 1)
+    _PROG_REC.pack_into(mm, 0, seq | 1, _progress["phase"].encode()[:32], _progress["total"], _progress["done"],
+                        _progress["started"], _progress["updated"], os.getpid())
+    struct.pack_into("<Q", mm, 0, (seq | 1) + 1)
+
+
+def _prog_read() -> dict:
+    mm = _prog_map()
+    for _ in range(100):
+        seq, phase, total, done, started, updated, pid = _PROG_REC.unpack_from(mm, 0)
+        if not seq & 1 and struct.unpack_from("<Q", mm, 0)[0] == seq:
+            break
+        time.sleep(0.001)
+    return {"phase": phase.rstrip(b"\0").decode() or "idle", "total": total, "done": done,
+            "started": started, "updated": updated, "pid": pid}
+
 
 def _set_prog(phase, total=0, done=0):
     with _prog_lock:
         _progress.update({"phase":phase, "total":int(total), "done":int(done),
                           "started":int(time.time()), "updated":int(time.time())})
+        _prog_publish()
 
 def _tick_prog(n=1):
     with _prog_lock:
         _progress["done"] += int(n)
         _progress["updated"] = int(time.time())
+        _prog_publish()
+
+
+_local_maint_lock = Lock()   # 没有 fcntl 时的退路
+
+
+def _try_flock(name: str) -> Optional[int]:
+    """非阻塞地拿 RUN_DIR/<name> 的排它 flock；拿到返回 fd（close 即释放），拿不到返回 None"""
+    RUN_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(RUN_DIR / name, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except OSError:
+        os.close(fd)
+        return None
+
+
+@contextmanager
+def _maintenance(job: str):
+    """同一时刻全局只跑一个重活；别的 worker/线程正在跑就 409；只读副本上一律 403"""
+    if IS_REPLICA:
+        raise HTTPException(403, f"{job} is not available on a read-only replica; run it on the primary")
+    if fcntl is None:
+        if not _local_maint_lock.acquire(blocking=False):
+            raise HTTPException(409, f"maintenance busy: {_prog_read()['phase']}")
+        try:
+            yield
+        finally:
+            _local_maint_lock.release()
+        return
+    fd = _try_flock("picapi.maint.lock")
+    if fd is None:
+        cur = _prog_read()
+        raise HTTPException(409, f"maintenance busy: {cur['phase']} ({cur['done']}/{cur['total']}, pid {cur['pid']})")
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def _exclusive(job: str):
+    """端点装饰器版的 _maintenance；放在 @app.post 下面"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _maintenance(job):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+@contextmanager
+def _startup_lock():
+    """建表/迁移/建索引：多个 worker 同时启动时排队做，避免并发 ALTER、重复播种 meta"""
+    if fcntl is None:
+        yield
+        return
+    RUN_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(RUN_DIR / "picapi.init.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _maintenance_running() -> bool:
+    if fcntl is None:
+        return _local_maint_lock.locked()
+    fd = _try_flock("picapi.maint.lock")
+    if fd is None:
+        return True
+    os.close(fd)
+    return False
 
 def get_counts_for_rels(rels: List[str]) -> List[int]:
     """
@@ -73,7 +798,13 @@ def _assert_fts5_available():
         raise RuntimeError("SQLite 未启用 FTS5，无法使用全文索引") from e
 
 def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    if IS_REPLICA:
+        # 只读副本：库文件整个被新快照替换（换 inode），immutable 让 SQLite 不加锁、不碰 WAL
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(str(DB_PATH))}?mode=ro&immutable=1",
+                               uri=True, check_same_thread=False, factory=_SQL_FACTORY)
+        conn.row_factory = sqlite3.Row
+        return conn
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=_SQL_FACTORY)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA busy_timeout=5000;")  # 新增：最多等 5s
@@ -82,6 +813,348 @@ def db():
 
 
 
+def _bayes_prior(conn) -> float:
+    """全站平均分 C（贝叶斯均分的先验）"""
+    rows = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('ratings_n','ratings_sum')").fetchall())
+    n = rows.get("ratings_n") or 0
+    return (rows.get("ratings_sum") or 0) / n if n else BAYES_PRIOR
+
+
+def _bayes(avg: float, cnt: int, prior: float) -> float:
+    # (C*m + avg*cnt) / (m + cnt)：票数少的图向全站均分收缩
+    return (prior * BAYES_M + avg * cnt) / (BAYES_M + cnt) if (BAYES_M + cnt) > 0 else prior
+
+
+def _refresh_bayes(conn):
+    """用当前全站均分重算所有已评分图的贝叶斯均分（先验漂移后校正用；未评分的保持 0 排在最后）"""
+    prior = _bayes_prior(conn)
+    conn.execute("UPDATE images SET bayes = (? * ? + avg * cnt) / (? + cnt) WHERE cnt > 0",
+                 (prior, BAYES_M, BAYES_M))
+
+
+def _bump_gen(conn):
+    """数据库代数 +1：评分、入库、同步标签等写操作之后调用，列表接口的 ETag 随之失效"""
+    conn.execute("""
+        INSERT INTO meta(key, value) VALUES ('gen', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+
+
+def _bump_tag_gen(conn):
+    """标签代数 +1：image_tags 或图片路径变了之后调用，各 worker 内存里的标签位图据此重建（评分不动它）"""
+    conn.execute("""
+        INSERT INTO meta(key, value) VALUES ('tag_gen', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+
+
+def _db_gen() -> int:
+    with db() as conn:
+        row = conn.execute("SELECT value FROM meta WHERE key='gen'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _etag_for(*parts) -> str:
+    return '"' + hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8", "replace")).hexdigest()[:24] + '"'
+
+
+def _if_none_match(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    tags = [t.strip() for t in inm.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _conditional_json(request: Request, etag: str, build) -> Response:
+    """
+    带强 ETag 的 JSON 响应：客户端带着同一个 If-None-Match 来就直接 304，不再计算/序列化 body。
+    Cache-Control: no-cache —— 允许缓存，但每次都要回来验证一下。
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _if_none_match(request, etag):
+        _cache_event("etag", True)
+        return Response(status_code=304, headers=headers)
+    _cache_event("etag", False)
+    return JSONResponse(build(), headers=headers)
+
+
+def _hist_bucket(score: float) -> int:
+    return max(0, min(10, int(round(float(score) * 2))))
+
+
+def _rollup_buckets(ts: int) -> List[Tuple[str, int]]:
+    lt = time.localtime(ts)
+    day = int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1)))
+    return [("h", ts - ts % 3600), ("d", day)]
+
+
+def _record_rating_aggregates(conn, image_id: str, category: Optional[str], score: float, ts: int):
+    """评分时顺手更新直方图与小时/天汇总，读的时候只查几行"""
+    conn.execute("""
+        INSERT INTO rating_hist(image_id, bucket, n) VALUES (?, ?, 1)
+        ON CONFLICT(image_id, bucket) DO UPDATE SET n = n + 1
+    """, (image_id, _hist_bucket(score)))
+    rows = [(gran, b, cat, score) for gran, b in _rollup_buckets(ts) for cat in ("*", category or "")]
+    conn.executemany("""
+        INSERT INTO rating_rollup(gran, bucket_ts, category, n, sum) VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT(gran, category, bucket_ts) DO UPDATE SET n = n + 1, sum = sum + excluded.sum
+    """, rows)
+
+
+def _backfill_rating_aggregates(conn):
+    """首次升级：从现有 ratings 历史一次性补齐 sum/m2、直方图与汇总表"""
+    conn.execute("""
+        UPDATE images SET
+            sum = avg * cnt,
+            m2  = MAX(0, COALESCE((SELECT SUM(r.score * r.score) FROM ratings r WHERE r.image_id = images.id), 0)
+                         - cnt * avg * avg)
+        WHERE cnt > 0
+    """)
+    conn.execute("DELETE FROM rating_hist")
+    conn.execute("DELETE FROM rating_rollup")
+    cur = conn.execute("""
+        SELECT r.image_id, i.category, r.score, r.ts
+          FROM ratings r LEFT JOIN images i ON i.id = r.image_id
+    """)
+    for image_id, category, score, ts in cur.fetchall():
+        _record_rating_aggregates(conn, image_id, category, score, int(ts))
+
+
+def _init_cursor_table(conn):
+    # 不重复抽图游标：放库里，多个 worker 共用同一个排列
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(cursors)")}
+    if "a" in cols:
+        conn.execute("DROP TABLE cursors")      # 旧的仿射置换游标：状态是临时的，直接丢掉重来
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS cursors (
+        key     TEXT PRIMARY KEY,           -- json([scope, kind, arg])
+        n       INTEGER NOT NULL,
+        seed    INTEGER NOT NULL,           -- 本轮排列的密钥
+        off     INTEGER NOT NULL,
+        touched REAL NOT NULL,
+        skip    TEXT                        -- off 之后已经提前取走的位置（bias 窗口），逗号分隔
+    );""")
+    if cols and "a" not in cols and "skip" not in cols:
+        conn.execute("ALTER TABLE cursors ADD COLUMN skip TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cursors_touched ON cursors(touched)")
+
+
+def state_db():
+    """
+    可写的本进程组状态（不重复游标）：放在 RUN_DIR 下单独的小库里。
+    replica 的主库只读；primary 上也不和主库抢写锁，抽图不用排在 sync/reindex 的大事务后面。
+    """
+    conn = sqlite3.connect(RUN_DIR / "state.sqlite", check_same_thread=False, factory=_SQL_FACTORY)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _delete_tags(conn, rels: List[str]):
+    """删掉这些图片的全部标签（一批不超过 SQLite 的参数上限），同时扣减标签频次"""
+    q = ",".join("?" * len(rels))
+    deltas = {lc: (lc, -n) for lc, n in conn.execute(
+        f"SELECT tag_lc, COUNT(DISTINCT relpath) FROM image_tags WHERE relpath IN ({q}) GROUP BY tag_lc", tuple(rels))}
+    conn.execute(f"DELETE FROM image_tags WHERE relpath IN ({q})", tuple(rels))
+    _tag_stats_apply(conn, deltas)
+
+
+def _tag_prefixes(tag_lc: str) -> List[str]:
+    return [tag_lc[:i] for i in range(1, min(len(tag_lc), TAG_PREFIX_MAX) + 1)]
+
+
+def _tag_stats_apply(conn, deltas: dict):
+    """按 {tag_lc: (展示写法, 增量)} 调整 tag_stats 与 tag_prefix；减到 0 的标签连同前缀行一起删掉"""
+    if any(d for _t, d in deltas.values()):
+        _bump_tag_gen(conn)
+    for lc, (tag, d) in deltas.items():
+        if not d:
+            continue
+        conn.execute("""
+            INSERT INTO tag_stats(tag_lc, tag, n) VALUES (?, ?, ?)
+            ON CONFLICT(tag_lc) DO UPDATE SET n = n + excluded.n,
+                tag = CASE WHEN excluded.n > 0 THEN excluded.tag ELSE tag END
+        """, (lc, tag, d))
+        n = conn.execute("SELECT n FROM tag_stats WHERE tag_lc=?", (lc,)).fetchone()[0]
+        if n == d:                                  # 新出现的标签
+            _pinyin_index(conn, [tag])
+        if n > 0:
+            conn.executemany("""
+                INSERT INTO tag_prefix(prefix, tag_lc, n) VALUES (?, ?, ?)
+                ON CONFLICT(prefix, tag_lc) DO UPDATE SET n = excluded.n
+            """, [(p, lc, n) for p in _tag_prefixes(lc)])
+        else:
+            conn.execute("DELETE FROM tag_stats WHERE tag_lc=?", (lc,))
+            conn.executemany("DELETE FROM tag_prefix WHERE prefix=? AND tag_lc=?", [(p, lc) for p in _tag_prefixes(lc)])
+
+
+def _rebuild_tag_stats(conn):
+    """从 image_tags 全量重算标签频次（建表时、启动时发现 TAG_PREFIX_MAX 改过、或 /admin/rebuild_tags）"""
+    conn.execute("DELETE FROM tag_stats")
+    conn.execute("DELETE FROM tag_prefix")
+    conn.execute("""
+        INSERT INTO tag_stats(tag_lc, tag, n)
+        SELECT tag_lc, MAX(tag), COUNT(DISTINCT relpath) FROM image_tags GROUP BY tag_lc
+    """)
+    rows = conn.execute("SELECT tag_lc, n FROM tag_stats").fetchall()
+    conn.executemany("INSERT INTO tag_prefix(prefix, tag_lc, n) VALUES (?, ?, ?)",
+                     [(p, lc, n) for lc, n in rows for p in _tag_prefixes(lc)])
+    # 记下 tag_prefix 实际展开到的长度：查询按它判断走等值还是范围扫描，启动时对不上就重建
+    conn.execute("""
+        INSERT INTO meta(key, value) VALUES ('tag_prefix_max', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (TAG_PREFIX_MAX,))
+    _bump_tag_gen(conn)
+    return len(rows)
+
+
+# ===== 拼音/首字母检索 =====
+# pinyin_map(key, native)：图库里出现过的汉字串（标签、目录名、文件名里连续的汉字，及其每个后缀）→ 全拼 / 首字母。
+# 按“词”记而不是按图片记：常见标签、目录名只占几行，表大小跟词汇量走，和图片数无关。
+# 查询时 q 的纯字母词在 key 上做前缀范围扫描，换回汉字串后和原词一起走 LIKE —— 和直接输入汉字一样快。
+_PINYIN_RUN_MAX = 16
+_PINYIN_Q_RE = re.compile(r"[a-z]{2,64}")
+
+
+def _load_pinyin_table(path: Path) -> dict:
+    """pinyin.txt → {字: (首选读音, 其他读音…)}；文件不在时返回空表（拼音检索自动关闭）"""
+    table: dict = {}
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError:
+        return table
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        py, _, chars = line.partition(" ")
+        if py.startswith("*"):          # 多音字的其他读音：排在首选读音后面
+            for ch in chars:
+                if ch in table:
+                    table[ch] += (py[1:],)
+        else:
+            for ch in chars:
+                table[ch] = (py,)
+    return table
+
+
+_PINYIN = _load_pinyin_table(PINYIN_TABLE) if PINYIN else {}
+if PINYIN and not _PINYIN:
+    log.warning("pinyin table %s not found; romanized search is disabled", PINYIN_TABLE)
+_pinyin_seen: set = set()       # 本进程已登记过的汉字串，重复的不再生成 key
+
+
+def _han_runs(text: str) -> List[str]:
+    """文本里连续的、拼音表里有的汉字串（过长的截断）"""
+    runs, cur = [], []
+    for ch in text:
+        if ch in _PINYIN:
+            cur.append(ch)
+            continue
+        if cur:
+            runs.append("".join(cur[:_PINYIN_RUN_MAX]))
+            cur = []
+    if cur:
+        runs.append("".join(cur[:_PINYIN_RUN_MAX]))
+    return runs
+
+
+def _pinyin_keys(native: str) -> set:
+    """汉字串的全拼与首字母；多音字只做“单个字换读音”的变体（线性而不是组合爆炸）"""
+    readings = [_PINYIN[ch] for ch in native]
+    combos = [[r[0] for r in readings]]
+    for i, r in enumerate(readings):
+        for alt in r[1:]:
+            combo = list(combos[0])
+            combo[i] = alt
+            combos.append(combo)
+    keys = set()
+    for combo in combos:
+        keys.add("".join(combo))
+        keys.add("".join(py[0] for py in combo))
+    return keys
+
+
+def _pinyin_index(conn, texts):
+    """把这些文本（标签、目录名、文件名）里的汉字串登记进 pinyin_map；本进程登记过的直接跳过"""
+    if not _PINYIN:
+        return
+    rows = []
+    for text in texts:
+        for run in _han_runs(text):
+            if run in _pinyin_seen:
+                continue
+            if len(_pinyin_seen) > 200_000:
+                _pinyin_seen.clear()
+            _pinyin_seen.add(run)
+            for i in range(len(run)):
+                rows.extend((key, run[i:]) for key in _pinyin_keys(run[i:]))
+    if rows:
+        conn.executemany("INSERT OR IGNORE INTO pinyin_map(key, native) VALUES (?, ?)", rows)
+
+
+def _pinyin_texts_of_rel(rel: str) -> List[str]:
+    """图片路径里参与拼音检索的部分：各级目录名 + 不带扩展名的文件名"""
+    parts = rel.split("/")
+    return parts[:-1] + [Path(parts[-1]).stem]
+
+
+def _rebuild_pinyin(conn) -> int:
+    """从 tag_stats 与 images 全量重建 pinyin_map（建表时、换了拼音表之后用 /admin/rebuild_pinyin）"""
+    conn.execute("DELETE FROM pinyin_map")
+    _pinyin_seen.clear()
+    _pinyin_index(conn, (t for t, in conn.execute("SELECT tag FROM tag_stats").fetchall()))
+    texts = set()
+    for rel, in conn.execute("SELECT relpath FROM images").fetchall():
+        texts.update(_pinyin_texts_of_rel(rel))
+    _pinyin_index(conn, texts)
+    return conn.execute("SELECT COUNT(*) FROM pinyin_map").fetchone()[0]
+
+
+def _pinyin_cover(native: str, q: str) -> Optional[str]:
+    """native 里能拼出 q 的最短前缀（全拼或首字母，q 可以停在音节中间），拼不出返回 None"""
+    def walk(k: int, pos: int, initials: bool) -> int:
+        if pos == len(q):
+            return k
+        if k == len(native):
+            return 0
+        rest = q[pos:]
+        for py in _PINYIN.get(native[k], ()):
+            form = py[0] if initials else py
+            if rest.startswith(form):
+                got = walk(k + 1, pos + len(form), initials)
+                if got:
+                    return got
+            elif form.startswith(rest):
+                return k + 1
+        return 0
+
+    k = walk(0, 0, False) or walk(0, 0, True)
+    return native[:k] if k else None
+
+
+def _pinyin_natives(conn, term: str) -> List[str]:
+    """纯字母的检索词 → 图库里能拼出它的汉字串（最多 PINYIN_MAX_ALTS 个；被更短的串包含的去掉）"""
+    q = term.lower()
+    if not _PINYIN or not _PINYIN_Q_RE.fullmatch(q):
+        return []
+    found = set()
+    for _key, native in conn.execute("SELECT key, native FROM pinyin_map WHERE key >= ? AND key < ? LIMIT 2000",
+                                     (q, q + "{")):
+        got = _pinyin_cover(native, q)
+        if got:
+            found.add(got)
+    out: List[str] = []
+    for s in sorted(found, key=lambda x: (len(x), x)):
+        if not any(o in s for o in out):          # LIKE %风% 已经涵盖 %风景%
+            out.append(s)
+        if len(out) >= PINYIN_MAX_ALTS:
+            break
+    return out
+
+
 def init_db():
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     with db() as conn:
@@ -104,16 +1177,127 @@ def init_db():
             ts INTEGER NOT NULL,
             FOREIGN KEY(image_id) REFERENCES images(id)
         );""")
-init_db()
+        # 小型键值表：全局评分总数/总分等计数器
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        );""")
+        # 物化的贝叶斯均分（评分时刷新），排行榜直接走 (bayes DESC, cnt DESC) 索引
+        try:
+            conn.execute("ALTER TABLE images ADD COLUMN bayes REAL NOT NULL DEFAULT 0")
+            fresh_bayes = True
+        except Exception:
+            fresh_bayes = False
+        if conn.execute("SELECT 1 FROM meta WHERE key='ratings_n'").fetchone() is None:
+            n, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(score), 0) FROM ratings").fetchone()
+            conn.executemany("INSERT INTO meta(key, value) VALUES (?, ?)",
+                             [("ratings_n", n), ("ratings_sum", total)])
+        if fresh_bayes:
+            _refresh_bayes(conn)
+
+        # 增量维护的聚合：单图分数直方图（0.5 分一档）+ 按小时/天、分类的评分量与总分
+        try:
+            conn.execute("ALTER TABLE images ADD COLUMN m2 REAL NOT NULL DEFAULT 0")   # Welford 的平方差累计
+            fresh_m2 = True
+        except Exception:
+            fresh_m2 = False
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS rating_hist (
+            image_id TEXT NOT NULL,
+            bucket   INTEGER NOT NULL,          -- round(score*2)：0..10
+            n        INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(image_id, bucket)
+        ) WITHOUT ROWID;""")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS rating_rollup (
+            gran      TEXT NOT NULL,            -- 'h' 小时 / 'd' 天（本地时区）
+            bucket_ts INTEGER NOT NULL,         -- 该小时/天开始的 unix 时间
+            category  TEXT NOT NULL,            -- 顶级分类；'*' 为全站合计
+            n         INTEGER NOT NULL DEFAULT 0,
+            sum       REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY(gran, category, bucket_ts)
+        ) WITHOUT ROWID;""")
+        if fresh_m2:
+            _backfill_rating_aggregates(conn)
+        conn.execute("DROP TABLE IF EXISTS cursors")      # 游标已挪到 state_db()
+
+        # 内容指纹：/reindex 靠它识别移动/改名；fp_ts = 算指纹时文件的 mtime_ns，对不上就说明文件改过、要重算
+        # self_ts = /rate 写回 XMP 后文件的 mtime_ns：文件监听看到 mtime 还是它，就知道是自己写的，不用重抽标签/重算哈希
+        for col in ("filename TEXT", "fp TEXT", "full_hash TEXT", "fp_ts INTEGER", "self_ts INTEGER"):
+            try:
+                conn.execute(f"ALTER TABLE images ADD COLUMN {col}")
+            except Exception:
+                pass
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_fp ON images(fp)")
+        # image_tags 在 FTS 初始化里建；这里也建一次，保证 SKIP_FTS_INIT 时移动/清理照样能用
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_tags(
+          relpath TEXT NOT NULL,
+          tag     TEXT NOT NULL,
+          tag_lc  TEXT NOT NULL,
+          PRIMARY KEY(relpath, tag)
+        )""")
+
+        # 标签频次（/tags 自动补全）：tag_stats 每个标签一行（n = 带这个标签的图片数）；
+        # tag_prefix 把每个标签的前 1..TAG_PREFIX_MAX 个字符展开成行，(prefix, n DESC) 索引让
+        # “某前缀下最常用的 k 个”直接按索引顺序取前 k 行，查询时不排序
+        fresh_tags = conn.execute("SELECT 1 FROM sqlite_master WHERE name='tag_stats'").fetchone() is None
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS tag_stats (
+            tag_lc TEXT PRIMARY KEY,
+            tag    TEXT NOT NULL,               -- 展示用的写法（最近一次写入的大小写）
+            n      INTEGER NOT NULL
+        ) WITHOUT ROWID;""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tag_stats_top ON tag_stats(n DESC, tag_lc)")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS tag_prefix (
+            prefix TEXT NOT NULL,
+            tag_lc TEXT NOT NULL,
+            n      INTEGER NOT NULL,
+            PRIMARY KEY(prefix, tag_lc)
+        ) WITHOUT ROWID;""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tag_prefix_top ON tag_prefix(prefix, n DESC, tag_lc)")
+        built = conn.execute("SELECT value FROM meta WHERE key='tag_prefix_max'").fetchone()
+        if fresh_tags or built is None or int(built[0]) != TAG_PREFIX_MAX:
+            _rebuild_tag_stats(conn)
+
+        # 拼音/首字母检索的“词 → 拼音”表（见 _pinyin_index）；升级后第一次启动从现有标签与路径回填
+        fresh_pinyin = conn.execute("SELECT 1 FROM sqlite_master WHERE name='pinyin_map'").fetchone() is None
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS pinyin_map (
+            key    TEXT NOT NULL,               -- 全拼或首字母，小写，ü 写作 v
+            native TEXT NOT NULL,               -- 图库里出现过的汉字串
+            PRIMARY KEY(key, native)
+        ) WITHOUT ROWID;""")
+        if fresh_pinyin:
+            _rebuild_pinyin(conn)
+
+        # 感知哈希：按图片 id 存（id 跟着内容走，移动/改名不用重算）；h 为 NULL = 解不开的文件，内容变了才重试
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_phash (
+            image_id TEXT PRIMARY KEY,
+            h        INTEGER                    -- 64 位 dHash，按有符号整数存
+        ) WITHOUT ROWID;""")
+with _startup_lock():
+    if not IS_REPLICA:
+        init_db()
+    RUN_DIR.mkdir(parents=True, exist_ok=True)
+    with state_db() as _conn:
+        _init_cursor_table(_conn)
 
 
 
 
 def list_all_files(root: Path) -> List[Path]:
-    if RECURSIVE:
-        return [p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in ALLOWED_SUFFIXES]
-    else:
-        return [p for p in root.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_SUFFIXES]
+    with _span("walk.list_all_files") as sp:
+        if RECURSIVE:
+            files = [p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in ALLOWED_SUFFIXES]
+        else:
+            files = [p for p in root.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_SUFFIXES]
+        sp["files"] = len(files)
+    _count_walked("list_all_files", len(files))
+    return files
 
 def list_top_categories() -> List[str]:
     return sorted([p.name for p in GALLERY_DIR.iterdir() if p.is_dir()])
@@ -122,8 +1306,141 @@ def to_url(rel: str) -> str:
     return f"{STATIC_PREFIX}/" + "/".join(urllib.parse.quote(seg) for seg in rel.split("/"))
 
 def file_id_for(rel: str) -> str:
+    # 旧的 id 方案（按路径）：老记录沿用，新记录改用 _content_id
     return hashlib.sha1(rel.encode("utf-8", errors="replace")).hexdigest()[:16]
 
+
+# ===== 按内容的图片身份：移动/改名不丢评分，也不必重新抽取元数据 =====
+def _quick_fingerprint(abs_path: Path, st=None) -> str:
+    """廉价内容指纹：文件大小 + 头尾各 FP_BLOCK 字节的 sha1（不读整个文件）"""
+    st = st or abs_path.stat()
+    h = hashlib.sha1()
+    with open(abs_path, "rb") as f:
+        h.update(f.read(FP_BLOCK))
+        if st.st_size > 2 * FP_BLOCK:
+            f.seek(-FP_BLOCK, os.SEEK_END)
+            h.update(f.read(FP_BLOCK))
+    return f"{st.st_size:x}-{h.hexdigest()[:24]}"
+
+
+def _fingerprint(abs_path: Path) -> Tuple[str, int]:
+    """入库用的指纹：(指纹, 算指纹时的 mtime_ns)，后者存进 images.fp_ts"""
+    st = abs_path.stat()
+    return _quick_fingerprint(abs_path, st), st.st_mtime_ns
+
+
+def _refresh_fp(conn, rel: str) -> Optional[str]:
+    """
+    文件内容变了（改标签、写回 XMP 都会改头部字节）就重算指纹，否则之后移动这张图会被当成删除 + 新增，评分丢失。
+    文件读不到返回 None。
+    """
+    try:
+        fp, ts = _fingerprint(GALLERY_DIR / rel)
+    except OSError:
+        return None
+    conn.execute("UPDATE images SET fp=?, fp_ts=? WHERE relpath=?", (fp, ts, rel))
+    return fp
+
+
+def _full_hash(abs_path: Path) -> str:
+    """整文件 sha1：只在指纹撞车时才算"""
+    h = hashlib.sha1()
+    with open(abs_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _content_id(conn, rel: str, fp: str, taken: Optional[set] = None) -> Tuple[str, Optional[str]]:
+    """
+    给新图片分配 id：默认由指纹派生；与已有 id 撞车时才算整文件哈希，
+    同时把对方缺失的 full_hash 补上（以后移动时靠它区分）。返回 (id, full_hash 或 None)。
+    """
+    def used(i: str) -> bool:
+        return (taken is not None and i in taken) or \
+            conn.execute("SELECT 1 FROM images WHERE id=?", (i,)).fetchone() is not None
+
+    iid = hashlib.sha1(f"fp:{fp}".encode()).hexdigest()[:16]
+    if not used(iid):
+        return iid, None
+
+    for other_rel, in conn.execute("SELECT relpath FROM images WHERE fp=? AND full_hash IS NULL", (fp,)).fetchall():
+        try:
+            conn.execute("UPDATE images SET full_hash=? WHERE relpath=?",
+                         (_full_hash(GALLERY_DIR / other_rel), other_rel))
+        except OSError:
+            pass
+    full = _full_hash(GALLERY_DIR / rel)
+    iid = hashlib.sha1(f"full:{full}".encode()).hexdigest()[:16]
+    if not used(iid):
+        return iid, full
+    # 内容完全相同的副本：再混入路径区分
+    return hashlib.sha1(f"full:{full}:{rel}".encode("utf-8", "replace")).hexdigest()[:16], full
+
+
+def _fts_exists(conn) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (FTS_TABLE,)).fetchone() is not None
+
+
+def _fts_tags_of(conn, relpath: str) -> str:
+    row = conn.execute("SELECT GROUP_CONCAT(tag, ' ') FROM image_tags WHERE relpath=?", (relpath,)).fetchone()
+    return (row[0] if row else None) or ""
+
+
+def _fts_remove(conn, rels: List[str]) -> bool:
+    """
+    删掉这些 relpath 的 FTS 条目（external content 表要带着当时写进去的值发 'delete'）。
+    必须在改/删 images、image_tags 之前调用。FTS 不存在或已损坏时返回 False（交给 /admin/rebuild_fts）。
+    """
+    if not rels or not _fts_exists(conn):
+        return False
+    try:
+        for rel in rels:
+            row = conn.execute("SELECT rowid, filename FROM images WHERE relpath=?", (rel,)).fetchone()
+            if row:
+                conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, relpath, filename, tags) VALUES('delete', ?, ?, ?, ?)",
+                             (row[0], rel, row[1] or "", _fts_tags_of(conn, rel)))
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def _fts_add(conn, rels: List[str]):
+    """按 images / image_tags 的当前值写入 FTS 条目（在改完之后调用）"""
+    if not rels or not _fts_exists(conn):
+        return
+    try:
+        for rel in rels:
+            row = conn.execute("SELECT rowid, filename FROM images WHERE relpath=?", (rel,)).fetchone()
+            if row:
+                conn.execute(f"INSERT INTO {FTS_TABLE}(rowid, relpath, filename, tags) VALUES (?, ?, ?, ?)",
+                             (row[0], rel, row[1] or Path(rel).name, _fts_tags_of(conn, rel)))
+    except sqlite3.Error:
+        pass
+
+
+def _apply_moves(conn, moves: List[Tuple[sqlite3.Row, str]]):
+    """
+    把旧记录批量改指向新路径：images / image_tags / FTS 一起改，评分历史按 id 关联不用动。
+    先改成临时路径再改成目标路径，避免 a↔b 互换时撞 UNIQUE(relpath)。
+    """
+    if not moves:
+        return
+    fts = _fts_remove(conn, [row["relpath"] for row, _ in moves])
+
+    tmp = [(f"\x00move:{row['id']}", row["relpath"]) for row, _ in moves]
+    conn.executemany("UPDATE images SET relpath=? WHERE relpath=?", tmp)
+    conn.executemany("UPDATE image_tags SET relpath=? WHERE relpath=?", tmp)
+    final = [(new_rel, f"\x00move:{row['id']}") for row, new_rel in moves]
+    conn.executemany("UPDATE image_tags SET relpath=? WHERE relpath=?", final)
+    conn.executemany("UPDATE images SET relpath=?, category=?, filename=? WHERE id=?",
+                     [(new_rel, _top_category_of(new_rel), Path(new_rel).name, row["id"]) for row, new_rel in moves])
+
+    if fts:
+        _fts_add(conn, [new_rel for _, new_rel in moves])
+    _bump_tag_gen(conn)
+    _pinyin_index(conn, {t for _, new_rel in moves for t in _pinyin_texts_of_rel(new_rel)})
+
 def collect_in_category(cat_path: str) -> List[Path]:
     base = (GALLERY_DIR / cat_path).resolve()
     try:
@@ -156,15 +1473,46 @@ def choice_by_weight(groups: List[Tuple[str,int]]) -> str:
     return random.choices(names, weights=weights, k=1)[0]
 
 def ensure_image_record(rel: str, category: Optional[str]):
-    iid = file_id_for(rel)
+    return ensure_image_records([(rel, category)])[rel]
+
+def ensure_image_records(items: List[Tuple[str, Optional[str]]]) -> dict:
+    """
+    一个连接里补齐记录，返回 {relpath: 库里的 id}。
+    已在库的直接返回现有 id（移动过的图 id 与路径无关）；新图按内容指纹分配 id。
+    """
     ts = int(time.time())
+    out = {}
+    if IS_REPLICA:
+        # 副本不写库：还没入库的新图先用 relpath 充当 id（/rate 也接受 relpath），等 primary 入库后随快照同步
+        with db() as conn:
+            for rel, _ in items:
+                row = conn.execute("SELECT id FROM images WHERE relpath=?", (rel,)).fetchone()
+                out[rel] = row[0] if row else rel
+        return out
     with db() as conn:
-        conn.execute("""
-        INSERT INTO images (id, relpath, category, last_ts)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(relpath) DO NOTHING;
-        """, (iid, rel, category, ts))
-    return iid
+        inserted = 0
+        for rel, category in items:
+            row = conn.execute("SELECT id FROM images WHERE relpath=?", (rel,)).fetchone()
+            if row:
+                out[rel] = row[0]
+                continue
+            try:
+                fp, fp_ts = _fingerprint(GALLERY_DIR / rel)
+                iid, full = _content_id(conn, rel, fp)
+            except OSError:
+                fp, fp_ts, full, iid = None, None, None, file_id_for(rel)
+            conn.execute("""
+            INSERT INTO images (id, relpath, category, last_ts, filename, fp, full_hash, fp_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(relpath) DO NOTHING;
+            """, (iid, rel, category, ts, Path(rel).name, fp, full, fp_ts))
+            out[rel] = conn.execute("SELECT id FROM images WHERE relpath=?", (rel,)).fetchone()[0]
+            inserted += 1
+        if inserted:
+            _bump_gen(conn)
+    if inserted:
+        _snapshot_mark_dirty()
+    return out
 
 # ===== reindex 辅助函数（复制整段）=====
 def _is_image_file(p: Path) -> bool:
@@ -186,7 +1534,8 @@ def _get_current_subjects(abs_path: Path) -> list:
     兼容没有 Subject、或 Subject 是字符串/列表两种情况。
     """
     try:
-        res = subprocess.run(
+        res = _exiftool(
+            "read_subjects",
             ["exiftool", "-j", "-XMP:Subject", str(abs_path)],
             capture_output=True,
             check=True,
@@ -250,7 +1599,7 @@ def write_metadata(abs_path: Path, avg: float, cnt: int):
     args.append(str(abs_path))
 
     try:
-        subprocess.run(args, capture_output=True, check=True)
+        _exiftool("write_meta", args, capture_output=True, check=True)
     except subprocess.CalledProcessError as e:
         # 如需排查可打印 e.stderr
         pass
@@ -264,7 +1613,7 @@ def _extract_subjects_from_file(abs_path: Path) -> list[str]:
     try:
         # -j json输出；只取 XMP:Subject；-s 简洁键名；文件路径用 str(abs_path)
         cmd = ["exiftool", "-j", "-s", "-XMP:Subject", str(abs_path)]
-        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        out = _exiftool("read_subjects", cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
         arr = json.loads(out.decode("utf-8", "ignore"))
         if not arr:
             return []
@@ -285,21 +1634,31 @@ def _extract_subjects_from_file(abs_path: Path) -> list[str]:
         return []
 
 def _upsert_tags(conn, relpath: str, tags: list[str]):
-    # 幂等：先清，再插
+    # 幂等：先清，再插；标签频次只按前后差量调整（同一张图大小写不同的同名标签只算一次）
+    old = {lc for lc, in conn.execute("SELECT DISTINCT tag_lc FROM image_tags WHERE relpath=?", (relpath,))}
     conn.execute("DELETE FROM image_tags WHERE relpath=?", (relpath,))
     rows = [(relpath, t, t.lower()) for t in tags]
     if rows:
         conn.executemany("INSERT OR IGNORE INTO image_tags(relpath, tag, tag_lc) VALUES (?,?,?)", rows)
+    new = {}
+    for _rel, t, lc in rows:
+        new.setdefault(lc, t)
+    deltas = {lc: (t, 1) for lc, t in new.items() if lc not in old}
+    deltas.update((lc, (lc, -1)) for lc in old if lc not in new)
+    _tag_stats_apply(conn, deltas)
+
+
 
 import os, time, subprocess, json
 from fastapi import Query
 
 @app.post("/sync_subjects")
+@_exclusive("sync_subjects")
 def sync_subjects(limit: int = 0):
     """
-    扫描数据库中的图片，读取 XMP:Subject 写入 image_tags。
+    扫描数据库中的图片，读取 XMP:Subject 写入 image_tags，顺带算感知哈希。
     - limit > 0：只处理最近 N 条（按 rowid DESC）
-    - 否则：仅处理“新增/有变更（mtime > last_ts）”的文件
+    - 否则：仅处理“新增/有变更（mtime > last_ts）”的文件，外加还没有感知哈希的图（升级后补算）
     """
     # 1) 取出候选 rows（最近 N 条或全部）
     with db() as conn:
@@ -323,34 +1682,46 @@ def sync_subjects(limit: int = 0):
         if limit > 0 or last_ts == 0 or mtime > last_ts:
             todo.append((relpath, mtime))
 
-    _set_prog("sync_subjects", total=len(todo), done=0)
-    if not todo:
+    todo_rels = {rel for rel, _ in todo}
+    hash_only = []
+    if not limit or limit <= 0:
+        with db() as conn:
+            hash_only = [rel for rel in _phash_missing(conn) if rel not in todo_rels]
+
+    _set_prog("sync_subjects", total=len(todo) + len(hash_only), done=0)
+    if not todo and not hash_only:
         _set_prog("idle", 0, 0)
         return {"processed": 0}
 
     # 3) 批量抽取标签（过滤 rated/score:/count:）
     subjects_map = _batch_exif_subjects([rel for rel, _ in todo])
 
-    # 4) 刷库：清旧标签→插入新标签→更新 last_ts（分批提交以免大事务）
+    # 4) 刷库：清旧标签→插入新标签→更新 last_ts（分批提交以免大事务；每批的感知哈希在开写事务前算好）
     processed = 0
     with db() as conn:
-        for relpath, mtime in todo:
-            tags = subjects_map.get(relpath, [])
-            conn.execute("DELETE FROM image_tags WHERE relpath=?", (relpath,))
-            if tags:
-                conn.executemany(
-                    "INSERT OR IGNORE INTO image_tags(relpath, tag, tag_lc) VALUES (?,?,?)",
-                    [(relpath, t, t.lower()) for t in tags]
-                )
-            conn.execute("UPDATE images SET last_ts=? WHERE relpath=?", (mtime, relpath))
-            processed += 1
-            if processed % 200 == 0:
-                conn.commit()
-            _tick_prog(1)
+        for i in range(0, len(todo), 200):
+            batch = todo[i:i + 200]
+            hashes = _phash_compute([rel for rel, _ in batch])
+            for relpath, mtime in batch:
+                _upsert_tags(conn, relpath, subjects_map.get(relpath, []))
+                conn.execute("UPDATE images SET last_ts=? WHERE relpath=?", (mtime, relpath))
+                _refresh_fp(conn, relpath)      # 标签是在外面改的：头部字节变了，指纹跟着刷新
+                processed += 1
+                _tick_prog(1)
+            _phash_store(conn, hashes)
+            conn.commit()
+        _bump_gen(conn)
         conn.commit()
 
+        # 5) 内容没变、只是缺感知哈希的图
+        hashed = 0
+        for i in range(0, len(hash_only), 200):
+            hashed += _phash_update(conn, hash_only[i:i + 200])
+            conn.commit()
+            _tick_prog(len(hash_only[i:i + 200]))
+
     _set_prog("idle", 0, 0)
-    return {"processed": processed}
+    return {"processed": processed, "phashed": hashed}
 
 
 
@@ -372,7 +1743,7 @@ def _batch_exif_subjects(relpaths: list[str]) -> dict[str, list[str]]:
         cmd = ["exiftool", "-j", "-s", "-XMP:Subject"] + files
 
         try:
-            out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+            out = _exiftool("batch_subjects", cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
             data = json.loads(out.decode("utf-8", errors="ignore") or "[]")
         except Exception:
             continue
@@ -455,15 +1826,32 @@ def _init_fts_schema():
           tokenize='unicode61'
         )""")
 
+        # 已收录的 rowid 从 FTS 自己的 _docsize 影子表取：external content 表做全表扫描会回 images 读 tags 列，
+        # 而 images 没有这一列（no such column: T.tags）
         conn.execute(f"""
         INSERT INTO {FTS_TABLE}(rowid, relpath, filename, tags)
-        SELECT i.rowid, i.relpath, COALESCE(i.filename,''), ''
+        SELECT i.rowid, i.relpath, COALESCE(i.filename,''),
+               COALESCE((SELECT GROUP_CONCAT(t.tag, ' ') FROM image_tags t WHERE t.relpath = i.relpath), '')
           FROM images AS i
-         WHERE i.rowid NOT IN (SELECT rowid FROM {FTS_TABLE})
+         WHERE i.rowid NOT IN (SELECT id FROM {FTS_TABLE}_docsize)
         """)
         conn.commit()
 
 
+def _fts_refill(conn):
+    """
+    按 images / image_tags 的当前值整表重写 FTS。external content 表不能直接 UPDATE
+    （SQLite 要先回 images 读旧值，images 没有 tags 列），只能 delete-all 再全量插入。
+    """
+    conn.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES('delete-all')")
+    conn.execute(f"""
+        INSERT INTO {FTS_TABLE}(rowid, relpath, filename, tags)
+        SELECT i.rowid, i.relpath, COALESCE(i.filename,''),
+               COALESCE((SELECT GROUP_CONCAT(t.tag, ' ') FROM image_tags t WHERE t.relpath = i.relpath), '')
+          FROM images AS i
+    """)
+
+
 
 
 
@@ -503,15 +1891,24 @@ def _init_indices():
         conn.execute("CREATE INDEX IF NOT EXISTS idx_images_relpath ON images(relpath)")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_images_cnt ON images(cnt)")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_images_cat ON images(category)")
+        # 评分历史按图片 + rid 倒序翻页；排行榜按索引顺序直接取前 N
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ratings_image_rid ON ratings(image_id, rid)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_rank_avg ON images(avg DESC, cnt DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_images_rank_bayes ON images(bayes DESC, cnt DESC)")
         conn.commit()
 
 
 @app.get("/admin/sync_progress")
 def sync_progress():
-    with _prog_lock:
-        return dict(_progress)  # {phase,total,done,started,updated}
+    prog = _prog_read()  # {phase,total,done,started,updated,pid}，所有 worker 共享
+    if prog["phase"] != "idle" and not _maintenance_running():
+        # 跑任务的进程中途挂了：锁已随进程释放，记录却停在半路
+        prog["interrupted"] = prog["phase"]
+        prog["phase"] = "idle"
+    return prog
 
 @app.post("/admin/nuke_legacy")
+@_exclusive("nuke_legacy")
 def admin_nuke_legacy():
     """
     仅清理旧视图/触发器；不会动任何表。
@@ -525,14 +1922,27 @@ def admin_nuke_legacy():
 
 @app.on_event("startup")
 def _on_startup():
-    _init_indices()
-    if os.environ.get("SKIP_FTS_INIT"):
+    if TAG_INDEX:
+        Thread(target=_tagidx.warm, name="picapi-tagidx", daemon=True).start()
+    if PHASH:
+        Thread(target=_phashidx.warm, name="picapi-phash", daemon=True).start()
+    if IS_REPLICA:
+        start_replica_sync()
+        if INDEX_SNAPSHOT and not INDEX_SNAPSHOT_PATH.exists():
+            _snapshot_mark_dirty()
         return
-    _init_fts_schema()
+    with _startup_lock():
+        _init_indices()
+        if not os.environ.get("SKIP_FTS_INIT"):
+            _init_fts_schema()
+    start_watcher()
+    if INDEX_SNAPSHOT and not INDEX_SNAPSHOT_PATH.exists():
+        _snapshot_mark_dirty()
 
 
 
 @app.post("/admin/rebuild_fts")
+@_exclusive("rebuild_fts")
 def admin_rebuild_fts(full: bool = True):
     try:
         with db() as conn:
@@ -553,14 +1963,7 @@ def admin_rebuild_fts(full: bool = True):
 
         # 回填 tags（只从 image_tags.tag 聚合）
         with db() as conn:
-            conn.execute(f"""
-                UPDATE {FTS_TABLE}
-                   SET tags = COALESCE((
-                       SELECT GROUP_CONCAT(image_tags.tag, ' ')
-                         FROM image_tags
-                        WHERE image_tags.relpath = {FTS_TABLE}.relpath
-                   ), '')
-            """)
+            _fts_refill(conn)
             conn.commit()
 
         return {"ok": True, "fts": FTS_TABLE}
@@ -572,16 +1975,10 @@ def admin_rebuild_fts(full: bool = True):
 
 
 @app.post("/admin/refresh_fts_tags")
+@_exclusive("refresh_fts_tags")
 def admin_refresh_fts_tags():
     with db() as conn:
-        conn.execute(f"""
-            UPDATE {FTS_TABLE}
-               SET tags = COALESCE((
-                   SELECT GROUP_CONCAT(image_tags.tag, ' ')
-                     FROM image_tags
-                    WHERE image_tags.relpath = {FTS_TABLE}.relpath
-               ), '')
-        """)
+        _fts_refill(conn)
         conn.commit()
     return {"ok": True, "fts": FTS_TABLE}
 
@@ -591,111 +1988,2050 @@ def admin_refresh_fts_tags():
 
 
 @app.post("/reindex")
+@_exclusive("reindex")
 def reindex(purge_missing: bool = Body(default=False, description="是否删除库里已不存在的图片记录")):
     """
     扫描 GALLERY_DIR，把所有图片登记到 images 表（仅补齐，不覆盖评分）；
     可选：purge_missing=True 会删除数据库里存在、但磁盘已删除的记录。
+
+    按内容识别移动/改名：新出现的文件先算廉价指纹（大小 + 头尾块哈希），
+    与“磁盘上消失了”的旧记录指纹相同就判为移动，直接改指向（评分、标签、last_ts 都保留，
+    sync_subjects 不会因此重跑 exiftool）；指纹相同的候选不止一个时才算整文件哈希区分。
+    在库的文件 mtime 与算指纹时（fp_ts）不同就重算指纹，免得在外面改过标签的图下次移动时认不出来。
     """
     # 1) 扫盘收集所有图片的相对路径
     all_relpaths: List[str] = []
-    for root, _, files in os.walk(GALLERY_DIR):
-        for fn in files:
-            p = Path(root) / fn
-            if _is_image_file(p):
-                rel = p.relative_to(GALLERY_DIR).as_posix()
-                all_relpaths.append(rel)
+    with _span("walk.reindex") as sp:
+        for root, _, files in os.walk(GALLERY_DIR):
+            _count_walked("reindex", len(files))
+            for fn in files:
+                p = Path(root) / fn
+                if _is_image_file(p):
+                    rel = p.relative_to(GALLERY_DIR).as_posix()
+                    all_relpaths.append(rel)
+        sp["files"] = len(all_relpaths)
+    disk_set = set(all_relpaths)
 
-    inserted = 0
     purged = 0
     with db() as conn:
-        # 2) 批量补充插入（已存在则忽略，不覆盖评分/次数）-------------------------------
-        rows = [(file_id_for(r), r, _top_category_of(r), Path(r).name) for r in all_relpaths]
+        known = {r["relpath"]: r for r in conn.execute(
+            "SELECT rowid, id, relpath, filename, fp, full_hash, fp_ts FROM images").fetchall()}
+        new_rels = [r for r in all_relpaths if r not in known]
+        gone = [row for rel, row in known.items() if rel not in disk_set]
+
+        # 2) 在库的文件：没有指纹、或算指纹之后文件又改过（mtime 对不上 fp_ts）的重算
+        #    （升级后第一次会扫一遍，之后只有改过的文件要算）
+        need_fp = []
+        for rel, row in known.items():
+            if rel not in disk_set:
+                continue
+            try:
+                mtime_ns = (GALLERY_DIR / rel).stat().st_mtime_ns
+            except OSError:
+                continue
+            if not row["fp"] or row["fp_ts"] != mtime_ns:
+                need_fp.append(rel)
+        _set_prog("reindex", total=len(need_fp) + len(new_rels), done=0)
+        for i, rel in enumerate(need_fp, start=1):
+            _refresh_fp(conn, rel)
+            if i % 500 == 0:
+                conn.commit()
+            _tick_prog(1)
+
+        # 3) 新文件算指纹，与消失的旧记录按指纹配对 → 移动/改名
+        gone_by_fp: dict = {}
+        for row in gone:
+            if row["fp"]:
+                gone_by_fp.setdefault(row["fp"], []).append(row)
+        moves: List[Tuple[sqlite3.Row, str]] = []
+        fresh: List[Tuple[str, Optional[str], Optional[int]]] = []
+        for rel in new_rels:
+            _tick_prog(1)
+            try:
+                fp, fp_ts = _fingerprint(GALLERY_DIR / rel)
+            except OSError:
+                fp, fp_ts = None, None
+            cands = gone_by_fp.get(fp) if fp else None
+            match = None
+            if cands:
+                if len(cands) == 1:
+                    match = cands[0]
+                else:
+                    full = _full_hash(GALLERY_DIR / rel)
+                    match = next((c for c in cands if c["full_hash"] == full), None) \
+                        or next((c for c in cands if not c["full_hash"]), None)
+            if match is not None:
+                cands.remove(match)
+                moves.append((match, rel))
+            else:
+                fresh.append((rel, fp, fp_ts))
+
+        # 4) 批量改指向
+        _apply_moves(conn, moves)
+        moved_ids = {row["id"] for row, _ in moves}
+
+        # 5) 真正新增的文件（已存在则忽略，不覆盖评分/次数）
+        taken: set = set()
+        rows = []
+        for rel, fp, fp_ts in fresh:
+            if fp:
+                iid, full = _content_id(conn, rel, fp, taken)
+            else:
+                iid, full = file_id_for(rel), None
+            taken.add(iid)
+            rows.append((iid, rel, _top_category_of(rel), Path(rel).name, fp, full, fp_ts))
         for i in range(0, len(rows), 800):
-            chunk = rows[i:i + 800]
             conn.executemany(
-                "INSERT OR IGNORE INTO images(id, relpath, category, filename) VALUES (?, ?, ?, ?)",
-                chunk
+                "INSERT OR IGNORE INTO images(id, relpath, category, filename, fp, full_hash, fp_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows[i:i + 800]
             )
+        _pinyin_index(conn, {t for r in rows for t in _pinyin_texts_of_rel(r[1])})
+        if rows:
+            _bump_tag_gen(conn)      # 图片全集变了：纯排除的标签表达式（-夜景）要算上新图
 
+        _bump_gen(conn)
         conn.commit()
-        # 统计本次“确实新增”的数量
-        cur = conn.execute("SELECT COUNT(*) FROM images")
-        total_rows = cur.fetchone()[0]
-        # 粗略估算：插入后总行数减去原有行数 ≈ 新增（如需精确可先查旧总数再插入）
-        # 这里简化处理，不强求 inserted 的精确值
-        inserted = None  # 可按需删去这行并实现精确统计
-
-        # 3) 可选：删除磁盘已不存在的记录
+
+        # 6) 可选：删除磁盘已不存在（且没被识别为移动）的记录
         if purge_missing:
-            cur = conn.execute("SELECT relpath FROM images")
-            db_paths = [row[0] for row in cur.fetchall()]
-            disk_set = set(all_relpaths)
-            missing = [r for r in db_paths if r not in disk_set]
+            missing = [row["relpath"] for row in gone if row["id"] not in moved_ids]
             for i in range(0, len(missing), 800):
                 chunk = missing[i:i+800]
                 q = ",".join("?" * len(chunk))
                 conn.execute(f"DELETE FROM images WHERE relpath IN ({q})", tuple(chunk))
+                _delete_tags(conn, chunk)
+            if missing:
+                _bump_tag_gen(conn)
+            _bump_gen(conn)
             conn.commit()
             purged = len(missing)
 
-    return {"indexed": len(all_relpaths), "purged": purged}
+    _snapshot_rebuild_now()
+    _set_prog("idle", 0, 0)
+    return {"indexed": len(all_relpaths), "inserted": len(rows), "moved": len(moves), "purged": purged}
 
 
 
-@app.get("/health")
-def health():
-    files = list_all_files(GALLERY_DIR)
-    return {
-        "ok": True,
-        "gallery": str(GALLERY_DIR),
-        "allowed_suffixes": ALLOWED_SUFFIXES,
-        "recursive": RECURSIVE,
-        "top_categories": list_top_categories(),
-        "total_files": len(files),
-        "db": str(DB_PATH),
-    }
+# ===== 文件监听：增量更新 images / image_tags / FTS =====
+# - inotify：装了 watchdog 就用它（递归监听）；poll：自带的定时扫描对比 (大小, mtime)，适合网络盘
+# - 事件先攒在内存里去抖：WATCH_DEBOUNCE 秒内没有新事件才落库，每 WATCH_BATCH 个路径一个事务
+# - 删除+新建指纹相同 → 当作移动（与 /reindex 同一套 _apply_moves），评分不丢
+_watch_lock = Lock()
+_watch_wake = Event()
+_watch_pending = {"upsert": set(), "delete": set(), "moves": []}   # moves: [(src, dst)]
+_watch_state = {"mode": "off", "last_event": 0.0, "last_apply": 0, "applied": 0, "self_skipped": 0, "errors": 0,
+                "fallbacks": 0, "last_error": None}
+WATCH_RETRIES = 3      # 同一批连续失败这么多次就改做一次全量 reindex + sync_subjects 兜底
 
-@app.get("/categories")
-def categories():
-    return {"categories": list_top_categories()}
 
-def _safe_join_under_gallery(sub: str) -> Path:
-    """
-    把用户传入的相对路径拼到 GALLERY_DIR 下，并做越界保护。
-    """
-    p = (GALLERY_DIR / (sub.strip("/"))) if sub else GALLERY_DIR
-    p = p.resolve()
-    g = GALLERY_DIR.resolve()
+def _watch_rel(path: str) -> Optional[str]:
     try:
-        p.relative_to(g)
+        rel = Path(path).resolve().relative_to(GALLERY_DIR).as_posix()
     except Exception:
-        raise HTTPException(status_code=400, detail="path out of gallery")
-    return p
+        return None
+    return rel if rel and rel != "." else None
 
-@app.get("/dirs")
-def list_subdirs(path: str = ""):
-    """
-    列出 path（相对图库根）下的**直接子文件夹**。
-    返回相对 GALLERY_DIR 的子路径，并附带该子路径下（递归）图片文件数量。
-    """
-    base = _safe_join_under_gallery(path)
-    if not base.exists() or not base.is_dir():
-        raise HTTPException(status_code=404, detail="path not found")
 
-    # 只列一层目录
-    subdirs = []
-    for child in sorted(base.iterdir()):
-        if child.is_dir():
-            # 统计该子目录下的图片数量（递归）
-            cnt = 0
-            for root, _, files in os.walk(child):
-                for fn in files:
-                    if _is_image_file(Path(root) / fn):
-                        cnt += 1
-            rel = child.relative_to(GALLERY_DIR).as_posix()
-            subdirs.append({"path": rel, "name": child.name, "count": cnt})
+def _watch_push(kind: str, rel: Optional[str], dst: Optional[str] = None, is_dir: bool = False):
+    if not rel:
+        return
+    if not is_dir and kind != "move" and not _is_image_file(Path(rel)):
+        return
+    with _watch_lock:
+        if kind == "move":
+            if dst:
+                _watch_pending["moves"].append((rel, dst, is_dir))
+        elif kind == "delete":
+            _watch_pending["upsert"].discard(rel)
+            _watch_pending["delete"].add((rel, is_dir))
+        else:
+            _watch_pending["upsert"].add(rel)
+        _watch_state["last_event"] = time.time()
+    _watch_wake.set()
 
-    # 当前层里的图片数量（非必须，仅用于提示）
+
+def _rows_under(conn, rel: str, is_dir: bool) -> list:
+    if is_dir:
+        pat = _like_escape(rel.rstrip("/")) + "/%"
+        return conn.execute("SELECT rowid, id, relpath, filename, fp, full_hash FROM images WHERE relpath LIKE ? ESCAPE '\\'",
+                            (pat,)).fetchall()
+    row = conn.execute("SELECT rowid, id, relpath, filename, fp, full_hash FROM images WHERE relpath=?", (rel,)).fetchone()
+    return [row] if row else []
+
+
+def _apply_fs_changes(upserts: set, deletes: set, moves: list) -> dict:
+    """把一批文件系统变化落库：移动 → 删除（先按指纹和新文件配对）→ 新增 → 重新抽标签"""
+    stats = {"moved": 0, "deleted": 0, "inserted": 0, "retagged": 0, "self": 0}
+    with db() as conn:
+        # 1) 明确的移动事件（目录移动展开成其下所有记录）；目标已在库/不是图片的按“删+增”处理
+        move_pairs: List[Tuple[sqlite3.Row, str]] = []
+        targets: set = set()
+        for src, dst, is_dir in moves:
+            rows = _rows_under(conn, src, is_dir)
+            for row in rows:
+                new_rel = (dst.rstrip("/") + row["relpath"][len(src.rstrip("/")):]) if is_dir else dst
+                target = GALLERY_DIR / new_rel
+                if (new_rel not in targets and target.is_file() and _is_image_file(target)
+                        and conn.execute("SELECT 1 FROM images WHERE relpath=?", (new_rel,)).fetchone() is None):
+                    move_pairs.append((row, new_rel))
+                    targets.add(new_rel)
+                    upserts.discard(new_rel)
+                else:
+                    deletes.add((row["relpath"], False))
+                    if target.is_file():
+                        upserts.add(new_rel)
+            # 源路径没入库：临时文件改名成图片（rsync 的 .x.jpg.XYZ → x.jpg、exiftool -overwrite_original、
+            # 编辑器的原子保存）或整个新目录挪进来 → 目标按新增/修改处理
+            if is_dir:
+                for root, _, files in os.walk(GALLERY_DIR / dst):
+                    for fn in files:
+                        p = Path(root) / fn
+                        rel = p.relative_to(GALLERY_DIR).as_posix()
+                        if rel not in targets and _is_image_file(p):
+                            upserts.add(rel)
+            elif not rows and _is_image_file(Path(dst)):
+                upserts.add(dst)
+        # 到这里还没写过库：/rate 写回 XMP 引起的修改（mtime 还是它写完时的 self_ts）直接丢掉，
+        # 其余新增/修改的文件先把 XMP 标签和感知哈希取好，exiftool 和解码图片都不占写锁（第 4 步只挑要重抽标签的写）
+        pending = []
+        for rel in sorted(upserts):
+            try:
+                mtime_ns = (GALLERY_DIR / rel).stat().st_mtime_ns
+            except OSError:
+                continue
+            row = conn.execute("SELECT self_ts FROM images WHERE relpath=?", (rel,)).fetchone()
+            if row is not None and row["self_ts"] == mtime_ns:
+                upserts.discard(rel)
+                stats["self"] += 1
+                continue
+            pending.append(rel)
+        subjects = _batch_exif_subjects(pending) if pending else {}
+        hashes = _phash_compute(pending)
+        _apply_moves(conn, move_pairs)
+        stats["moved"] += len(move_pairs)
+
+        # 2) 删除：先收集要删的记录，指纹与新文件相同的改判为移动
+        gone = []
+        for rel, is_dir in deletes:
+            gone.extend(r for r in _rows_under(conn, rel, is_dir) if not (GALLERY_DIR / r["relpath"]).exists())
+        gone_by_fp: dict = {}
+        for row in gone:
+            if row["fp"]:
+                gone_by_fp.setdefault(row["fp"], []).append(row)
+
+        fresh: List[Tuple[str, str, int]] = []
+        modified: List[str] = []
+        late_moves: List[Tuple[sqlite3.Row, str]] = []
+        for rel in sorted(upserts):
+            full = GALLERY_DIR / rel
+            if not full.is_file():
+                continue
+            known = conn.execute("SELECT 1 FROM images WHERE relpath=?", (rel,)).fetchone()
+            try:
+                fp, fp_ts = _fingerprint(full)
+            except OSError:
+                continue
+            if known:
+                conn.execute("UPDATE images SET fp=?, fp_ts=? WHERE relpath=?", (fp, fp_ts, rel))
+                modified.append(rel)
+                continue
+            cands = gone_by_fp.get(fp)
+            if cands:
+                late_moves.append((cands.pop(0), rel))
+            else:
+                fresh.append((rel, fp, fp_ts))
+        _apply_moves(conn, late_moves)
+        stats["moved"] += len(late_moves)
+
+        moved_ids = {row["id"] for row, _ in late_moves}
+        dead = [row["relpath"] for row in gone if row["id"] not in moved_ids]
+        if dead:
+            _fts_remove(conn, dead)
+            for i in range(0, len(dead), 800):
+                chunk = dead[i:i + 800]
+                q = ",".join("?" * len(chunk))
+                _delete_tags(conn, chunk)
+                conn.execute(f"DELETE FROM images WHERE relpath IN ({q})", tuple(chunk))
+            stats["deleted"] = len(dead)
+            _bump_tag_gen(conn)
+
+        # 3) 新文件入库
+        ids: set = set()
+        for rel, fp, fp_ts in fresh:
+            iid, full_hash = _content_id(conn, rel, fp, ids)
+            ids.add(iid)
+            conn.execute("""
+                INSERT OR IGNORE INTO images(id, relpath, category, filename, fp, full_hash, fp_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (iid, rel, _top_category_of(rel), Path(rel).name, fp, full_hash, fp_ts))
+        stats["inserted"] = len(fresh)
+        if fresh:
+            _bump_tag_gen(conn)
+        _pinyin_index(conn, {t for rel, _fp, _ts in fresh for t in _pinyin_texts_of_rel(rel)})
+
+        # 4) 新增/修改过的文件重新抽 XMP 标签（与 sync_subjects 相同的过滤规则；移动的内容没变，不用重抽）
+        retag = modified + [rel for rel, _fp, _ts in fresh]
+        if retag:
+            _fts_remove(conn, modified)
+            for rel in retag:
+                _upsert_tags(conn, rel, subjects.get(rel, []))
+                try:
+                    conn.execute("UPDATE images SET last_ts=? WHERE relpath=?",
+                                 (int((GALLERY_DIR / rel).stat().st_mtime), rel))
+                except OSError:
+                    pass
+            _fts_add(conn, retag)
+            stats["retagged"] = len(retag)
+            retag_set = set(retag)
+            _phash_store(conn, [(rel, h) for rel, h in hashes if rel in retag_set])
+
+        _bump_gen(conn)
+        conn.commit()
+    _snapshot_mark_dirty()
+    return stats
+
+
+def _watch_requeue(upserts: set, deletes: set, moves: list):
+    """失败的一批放回队列（移动放在最前面保持先后顺序）；落库时会按磁盘现状重新判断，重复放回也无妨"""
+    with _watch_lock:
+        _watch_pending["moves"][:0] = moves
+        _watch_pending["delete"] |= deletes
+        _watch_pending["upsert"] |= {rel for rel in upserts if (rel, False) not in _watch_pending["delete"]}
+
+
+def _watch_fallback() -> bool:
+    """增量落库一直失败：全量 reindex（含清理）+ sync_subjects 把库对齐磁盘；有维护任务在跑（409）返回 False"""
+    try:
+        reindex(purge_missing=True)
+        sync_subjects(limit=0)
+    except HTTPException as e:
+        if e.status_code == 409:
+            return False
+        raise
+    return True
+
+
+def _watch_worker():
+    fails = 0
+    while True:
+        _watch_wake.wait(timeout=WATCH_DEBOUNCE)
+        with _watch_lock:
+            quiet = time.time() - _watch_state["last_event"]
+            pending = len(_watch_pending["upsert"]) + len(_watch_pending["delete"]) + len(_watch_pending["moves"])
+            if not pending:
+                _watch_wake.clear()
+                continue
+            if quiet < WATCH_DEBOUNCE and pending < WATCH_BATCH * 10:
+                _watch_wake.clear()
+                continue
+            moves = _watch_pending["moves"][:WATCH_BATCH]
+            del _watch_pending["moves"][:WATCH_BATCH]
+            deletes = set(list(_watch_pending["delete"])[:WATCH_BATCH])
+            _watch_pending["delete"] -= deletes
+            upserts = set(list(_watch_pending["upsert"])[:WATCH_BATCH])
+            _watch_pending["upsert"] -= upserts
+        try:
+            st = _apply_fs_changes(upserts, deletes, moves)
+            fails = 0
+            with _watch_lock:
+                _watch_state["self_skipped"] += st.pop("self")
+                _watch_state["applied"] += sum(st.values())
+                _watch_state["last_apply"] = int(time.time())
+        except Exception as e:
+            # 不能丢：这批事件不会再来第二次。先退避重试，连续失败 WATCH_RETRIES 次改做全量兜底
+            fails += 1
+            log.exception("watch batch failed (%d in a row)", fails)
+            with _watch_lock:
+                _watch_state["errors"] += 1
+                _watch_state["last_error"] = f"{type(e).__name__}: {e}"
+            done = False
+            if fails >= WATCH_RETRIES:
+                try:
+                    done = _watch_fallback()
+                except Exception:
+                    log.exception("watch fallback reindex failed")
+                if done:
+                    fails = 0
+                    with _watch_lock:
+                        _watch_state["fallbacks"] += 1
+                        _watch_state["last_apply"] = int(time.time())
+            if not done:
+                _watch_requeue(upserts, deletes, moves)
+                time.sleep(min(60.0, WATCH_DEBOUNCE * 2 ** min(fails, 5)))
+        with _watch_lock:
+            if any(_watch_pending.values()):
+                _watch_wake.set()
+
+
+def _scan_tree() -> dict:
+    out = {}
+    for root, _, files in os.walk(GALLERY_DIR):
+        _count_walked("watch_poll", len(files))
+        for fn in files:
+            p = Path(root) / fn
+            if _is_image_file(p):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                out[p.relative_to(GALLERY_DIR).as_posix()] = (st.st_size, st.st_mtime_ns)
+    return out
+
+
+def _poll_loop():
+    """轮询模式：每 WATCH_POLL_INTERVAL 秒全量 stat 一遍，与上一次对比出增/删/改"""
+    prev = _scan_tree()
+    while True:
+        time.sleep(WATCH_POLL_INTERVAL)
+        try:
+            cur = _scan_tree()
+        except Exception:
+            continue
+        for rel in prev.keys() - cur.keys():
+            _watch_push("delete", rel)
+        for rel, sig in cur.items():
+            if prev.get(rel) != sig:
+                _watch_push("upsert", rel)
+        prev = cur
+
+
+def _start_inotify() -> bool:
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except Exception:
+        return False
+
+    class _Handler(FileSystemEventHandler):
+        def on_created(self, ev):
+            if not ev.is_directory:
+                _watch_push("upsert", _watch_rel(ev.src_path))
+
+        def on_modified(self, ev):
+            if not ev.is_directory:
+                _watch_push("upsert", _watch_rel(ev.src_path))
+
+        def on_deleted(self, ev):
+            _watch_push("delete", _watch_rel(ev.src_path), is_dir=ev.is_directory)
+
+        def on_moved(self, ev):
+            src, dst = _watch_rel(ev.src_path), _watch_rel(ev.dest_path)
+            if dst is None:
+                _watch_push("delete", src, is_dir=ev.is_directory)
+            elif src is None:
+                if not ev.is_directory:
+                    _watch_push("upsert", dst)
+            else:
+                _watch_push("move", src, dst, is_dir=ev.is_directory)
+
+    obs = Observer()
+    obs.daemon = True
+    obs.schedule(_Handler(), str(GALLERY_DIR), recursive=True)
+    obs.start()
+    return True
+
+
+_watch_lock_fd: list = [None]
+
+
+def start_watcher():
+    if WATCH in ("", "off", "0", "false", "no"):
+        return
+    # 多 worker 时只让一个进程监听（flock 随进程退出释放，worker 被重启后由新进程接手）
+    if fcntl is not None:
+        _watch_lock_fd[0] = _try_flock("picapi.watch.lock")
+        if _watch_lock_fd[0] is None:
+            _watch_state["mode"] = "standby"
+            return
+    mode = "off"
+    if WATCH in ("auto", "inotify") and _start_inotify():
+        mode = "inotify"
+    elif WATCH in ("auto", "poll", "inotify"):
+        Thread(target=_poll_loop, name="picapi-poll", daemon=True).start()
+        mode = "poll"
+    if mode != "off":
+        Thread(target=_watch_worker, name="picapi-watch", daemon=True).start()
+    _watch_state["mode"] = mode
+
+
+@app.get("/admin/watch")
+def watch_status():
+    with _watch_lock:
+        return {
+            **_watch_state,
+            "pending": {k: len(v) for k, v in _watch_pending.items()},
+        }
+
+
+
+# ===== 紧凑索引快照：mmap 共享，随机出图/分类过滤不再逐请求扫盘、也不为整库建 Path/str =====
+# 文件布局（本机字节序）：头部 + 10 个段，每段 8 字节对齐
+#   dirs：目录表 (n_dirs+1) 个 uint32 偏移 + UTF-8 blob（同一目录只存一次）
+#   names：文件名 (n+1) 个 uint32 偏移 + UTF-8 blob
+#   cats：顶层分类表（格式同 dirs）
+#   file_dir / file_cat：每个文件的目录、分类下标（uint32；根目录下的文件无分类 = 0xFFFFFFFF）
+#   ids：images.id（16 位十六进制）转 uint64；0 = 非常规 id，回库里查
+#   counts：评分次数 uint32；/rate 直接原地改（MAP_SHARED，多个 worker 映射的是同一份页缓存）
+# 文件按 relpath 排序 → 任一目录前缀都是一段连续区间，二分即可；
+# 重建写临时文件后 os.replace 原子替换，各 worker 发现 inode 变了就换新映射，旧映射随引用释放
+_SNAP_MAGIC = b"PICIDX01"
+_SNAP_HEAD = struct.Struct("<8sIIIQ10Q")   # magic, n, n_dirs, n_cats, gen, 10 个段偏移
+_SNAP_NONE = 0xFFFFFFFF
+
+_snap_lock = Lock()
+_snap_state = {"obj": None, "checked": 0.0, "built": 0.0, "dirty": False, "building": False, "error": None}
+
+
+def _snap_pack_strings(strs) -> Tuple[array, bytes]:
+    offs, blob = array("I", [0]), bytearray()
+    for s in strs:
+        blob += s.encode("utf-8", "surrogateescape")
+        offs.append(len(blob))
+    return offs, bytes(blob)
+
+
+class GallerySnapshot:
+    """只读视图（counts 除外）；所有数组都是 mmap 上的 memoryview，不拷贝"""
+
+    def __init__(self, path: Path):
+        with open(path, "r+b") as f:
+            self.ino = os.fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), 0)
+        magic, n, nd, nc, self.gen, *offs = _SNAP_HEAD.unpack_from(self._mm, 0)
+        if magic != _SNAP_MAGIC:
+            raise ValueError(f"not a gallery snapshot: {path}")
+        self.n, self.n_dirs, self.n_cats = n, nd, nc
+        mv = memoryview(self._mm)
+
+        def sec(i: int, count: int, fmt: str, size: int):
+            return mv[offs[i]:offs[i] + count * size].cast(fmt)
+
+        self.dir_offs = sec(0, nd + 1, "I", 4)
+        self.dir_blob = mv[offs[1]:offs[1] + self.dir_offs[nd]]
+        self.name_offs = sec(2, n + 1, "I", 4)
+        self.name_blob = mv[offs[3]:offs[3] + self.name_offs[n]]
+        self.cat_offs = sec(4, nc + 1, "I", 4)
+        self.cat_blob = mv[offs[5]:offs[5] + self.cat_offs[nc]]
+        self.file_dir = sec(6, n, "I", 4)
+        self.file_cat = sec(7, n, "I", 4)
+        self.ids = sec(8, n, "Q", 8)
+        self.counts = sec(9, n, "I", 4)
+        self.nbytes = len(self._mm)
+
+    @staticmethod
+    def _str(offs, blob, i: int) -> str:
+        return bytes(blob[offs[i]:offs[i + 1]]).decode("utf-8", "surrogateescape")
+
+    def dir_name(self, d: int) -> str:
+        return self._str(self.dir_offs, self.dir_blob, d)
+
+    def cat_name(self, c: int) -> Optional[str]:
+        return None if c == _SNAP_NONE else self._str(self.cat_offs, self.cat_blob, c)
+
+    def relpath(self, i: int) -> str:
+        d = self.dir_name(self.file_dir[i])
+        name = self._str(self.name_offs, self.name_blob, i)
+        return f"{d}/{name}" if d else name
+
+    def id_of(self, i: int) -> Optional[str]:
+        h = self.ids[i]
+        return f"{h:016x}" if h else None
+
+    def _bisect(self, key: str) -> int:
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.relpath(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def index_of(self, rel: str) -> Optional[int]:
+        i = self._bisect(rel)
+        return i if i < self.n and self.relpath(i) == rel else None
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """目录前缀（分类，可多级）→ [lo, hi)；空前缀 = 全库"""
+        p = (prefix or "").strip().strip("/")
+        if not p:
+            return 0, self.n
+        if ".." in p.split("/") or "\\" in p:
+            return 0, 0
+        p += "/"
+        return self._bisect(p), self._bisect(p + "\U0010ffff")
+
+
+def _snapshot_build(path: Path = INDEX_SNAPSHOT_PATH) -> int:
+    """从 images 表流式生成快照（relpath 有唯一索引，ORDER BY 不用额外排序）；返回收录的文件数"""
+    dirs: dict = {"": 0}
+    cats: dict = {}
+    names: List[str] = []
+    file_dir, file_cat = array("I"), array("I")
+    ids, counts = array("Q"), array("I")
+    with db() as conn:
+        gen_row = conn.execute("SELECT value FROM meta WHERE key='gen'").fetchone()
+        for iid, rel, category, cnt in conn.execute("SELECT id, relpath, category, cnt FROM images ORDER BY relpath"):
+            if os.path.splitext(rel)[1].lower() not in ALLOWED_SUFFIXES:
+                continue
+            d, _, name = rel.rpartition("/")
+            file_dir.append(dirs.setdefault(d, len(dirs)))
+            top = category or _top_category_of(rel)
+            file_cat.append(cats.setdefault(top, len(cats)) if top else _SNAP_NONE)
+            names.append(name)
+            try:
+                ids.append(int(iid, 16) if len(iid) == 16 else 0)
+            except (TypeError, ValueError):
+                ids.append(0)
+            counts.append(min(int(cnt or 0), _SNAP_NONE - 1))
+
+    dir_offs, dir_blob = _snap_pack_strings(dirs)
+    name_offs, name_blob = _snap_pack_strings(names)
+    del names
+    cat_offs, cat_blob = _snap_pack_strings(cats)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{id(dirs):x}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(b"\0" * _SNAP_HEAD.size)
+            offs = []
+            for part in (dir_offs, dir_blob, name_offs, name_blob, cat_offs, cat_blob,
+                         file_dir, file_cat, ids, counts):
+                f.write(b"\0" * (-f.tell() % 8))
+                offs.append(f.tell())
+                f.write(part)
+            f.seek(0)
+            f.write(_SNAP_HEAD.pack(_SNAP_MAGIC, len(file_dir), len(dirs), len(cats),
+                                    int(gen_row[0]) if gen_row else 0, *offs))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    with _snap_lock:
+        _snap_state["checked"] = 0.0   # 本进程下次取用时立刻换新映射
+    return len(file_dir)
+
+
+def _snapshot() -> Optional[GallerySnapshot]:
+    """当前快照；没开/不可用/为空返回 None（调用方退回扫盘）。每秒最多 stat 一次看是否被替换"""
+    if not INDEX_SNAPSHOT or not RECURSIVE:
+        return None
+    cur = _snap_state["obj"]
+    now = time.time()
+    if cur is not None and now - _snap_state["checked"] < 1.0:
+        return cur if cur.n else None
+    with _snap_lock:
+        _snap_state["checked"] = now
+        try:
+            ino = os.stat(INDEX_SNAPSHOT_PATH).st_ino
+        except OSError:
+            _snap_state["obj"] = None
+            return None
+        if cur is None or cur.ino != ino:
+            try:
+                cur = _snap_state["obj"] = GallerySnapshot(INDEX_SNAPSHOT_PATH)
+            except (OSError, ValueError, struct.error) as e:
+                _snap_state["error"] = f"{type(e).__name__}: {e}"
+                _snap_state["obj"] = None
+                return None
+    return cur if cur.n else None
+
+
+def _snapshot_rebuilder():
+    while True:
+        wait = _snap_state["built"] + INDEX_SNAPSHOT_MIN_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        with _snap_lock:
+            if not _snap_state["dirty"]:
+                _snap_state["building"] = False
+                return
+            _snap_state["dirty"] = False
+        try:
+            _snapshot_build()
+            _snap_state["error"] = None
+        except Exception as e:
+            _snap_state["error"] = f"{type(e).__name__}: {e}"
+        _snap_state["built"] = time.time()
+
+
+def _snapshot_mark_dirty():
+    """库里的文件集合变了：后台节流重建（多次变更合并成一次）"""
+    if not INDEX_SNAPSHOT:
+        return
+    with _snap_lock:
+        _snap_state["dirty"] = True
+        if _snap_state["building"]:
+            return
+        _snap_state["building"] = True
+    Thread(target=_snapshot_rebuilder, name="picapi-snapshot", daemon=True).start()
+
+
+def _snapshot_rebuild_now():
+    """reindex 之后同步重建，保证接口返回时快照已是新的；失败只记录，不影响 reindex 结果"""
+    if not INDEX_SNAPSHOT:
+        return
+    try:
+        _snapshot_build()
+        _snap_state["error"] = None
+    except Exception as e:
+        _snap_state["error"] = f"{type(e).__name__}: {e}"
+    _snap_state["built"] = time.time()
+
+
+def _snapshot_set_count(rel: str, cnt: int):
+    snap = _snapshot()
+    if snap is None:
+        return
+    i = snap.index_of(rel)
+    if i is not None:
+        snap.counts[i] = min(int(cnt), _SNAP_NONE - 1)
+
+
+def _snap_sample(snap: GallerySnapshot, lo: int, hi: int, k: int, bias: str, alpha: float,
+                 exclude: Optional[set] = None) -> List[int]:
+    """
+    在 [lo, hi) 里按 bias 无放回抽 k 个下标，语义同 _sample_indices，但不为整段建 Python 对象：
+    - min：拷一份这段 counts 到 array，min/count/index 都在 C 里跑；最少层够大时直接随机落点拒绝采样
+    - weighted / off：随机落点 + 按权重接受（逐次加权无放回，与 A-ES 同分布）；接受率太低才退回整段精确抽样
+    """
+    size = hi - lo
+    taken = set(j for j in (exclude or ()) if lo <= j < hi)
+    k = min(k, size - len(taken))
+    picked: List[int] = []
+    if k <= 0:
+        return picked
+
+    if bias == "min":
+        arr = array("I")
+        arr.frombytes(snap.counts[lo:hi].cast("B"))
+        for j in taken:
+            arr[j - lo] = _SNAP_NONE
+        while len(picked) < k:
+            m = min(arr)
+            c = arr.count(m)
+            need = k - len(picked)
+            if c <= need or c * 8 < size:
+                pos, j = [], -1
+                for _ in range(c):
+                    j = arr.index(m, j + 1)
+                    pos.append(j)
+                chosen = pos if c <= need else random.sample(pos, need)
+            else:
+                chosen = set()
+                while len(chosen) < need:
+                    j = random.randrange(size)
+                    if arr[j] == m:
+                        chosen.add(j)
+            for j in chosen:
+                arr[j] = _SNAP_NONE
+                picked.append(lo + j)
+        return picked
+
+    counts = snap.counts
+    weighted = bias == "weighted"
+    wmax = (min(counts[lo:hi]) + 1.0) ** -alpha if weighted else 1.0
+    tries, limit = 0, 64 * k + 256
+    while len(picked) < k and tries < limit:
+        tries += 1
+        j = random.randrange(lo, hi)
+        if j in taken:
+            continue
+        if weighted and random.random() * wmax > (counts[j] + 1.0) ** -alpha:
+            continue
+        taken.add(j)
+        picked.append(j)
+    if len(picked) < k:
+        rest = [j for j in range(lo, hi) if j not in taken]
+        picked += [rest[i] for i in _sample_indices([counts[j] for j in rest], k - len(picked), bias, alpha)]
+    return picked
+
+
+@app.get("/admin/index_snapshot")
+def index_snapshot_status():
+    snap = _snapshot()
+    out = {
+        "enabled": INDEX_SNAPSHOT and RECURSIVE,
+        "path": str(INDEX_SNAPSHOT_PATH),
+        "building": _snap_state["building"],
+        "error": _snap_state["error"],
+    }
+    if snap is not None:
+        per_cat = array("I")
+        per_cat.frombytes(snap.file_cat.cast("B"))
+        out.update({
+            "files": snap.n,
+            "dirs": snap.n_dirs,
+            "bytes": snap.nbytes,
+            "gen": snap.gen,
+            "categories": {snap.cat_name(c): per_cat.count(c) for c in range(snap.n_cats)},
+        })
+    return out
+
+
+@app.post("/admin/index_snapshot")
+def index_snapshot_rebuild():
+    if not INDEX_SNAPSHOT:
+        raise HTTPException(400, "INDEX_SNAPSHOT is off")
+    t0 = time.time()
+    n = _snapshot_build()
+    _snap_state["error"] = None
+    return {"ok": True, "files": n, "took_ms": int((time.time() - t0) * 1000)}
+
+
+
+# ===== 标签位图：tag= 布尔表达式 =====
+# 每个 worker 在内存里维护 标签 → 图片序号集合：序号是 images 按 relpath 排序后的下标（稠密，0..n-1）。
+# 集合按稠密程度二选一存（同 Roaring 的 array/bitmap 容器）：图少的标签存有序 array('I')，
+# 覆盖超过 1/32 的标签直接存成 Python int 位图；求值时统一成 int，AND/OR/NOT 都是 C 里的整数位运算。
+# 以 meta.tag_gen 为准判断是否过期（改标签、入库、删图、移动时 +1）；过期后后台节流重建，期间继续用旧的。
+_TAG_TERM_RE = re.compile(r'-?"[^"]*"|\S+')
+
+
+def _meta_int(conn, key: str) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return int(row[0]) if row else 0
+
+
+class _LiveIndex:
+    """
+    按 meta 里某个代数失效的进程内索引（标签位图、感知哈希）：每秒最多查一次代数，变了就后台节流重建，
+    期间继续用旧的；第一次用时同步建，旧的是空索引（.n == 0，比如启动时库还没入库）时也同步建，不让请求 404 到节流结束。
+    build() 返回的对象要带 .gen（建的时候读到的代数）。
+    gen_key 给元组时代数也是元组，任何一个变了都算过期。
+    """
+
+    def __init__(self, name: str, build, gen_key: str, min_interval: float):
+        self.name, self.build, self.gen_key, self.min_interval = name, build, gen_key, min_interval
+        self.lock = Lock()
+        self.obj = None
+        self.checked = self.built = 0.0
+        self.building = False
+        self.error = None
+
+    def _build(self):
+        try:
+            self.obj = self.build()
+            self.error = None
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+        self.built = time.time()
+
+    def warm(self):
+        """启动时预先建好，第一个请求不用等（它会在锁上等这次建完）"""
+        with self.lock:
+            if self.obj is None:
+                self._build()
+
+    def _rebuilder(self):
+        wait = self.built + self.min_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            self._build()
+        finally:
+            self.building = False
+
+    def get(self):
+        cur = self.obj
+        now = time.time()
+        if cur is not None and now - self.checked < 1.0:
+            return cur
+        if cur is None:
+            self.warm()
+            if self.obj is None:
+                raise HTTPException(503, f"{self.name} unavailable: {self.error}")
+            self.checked = time.time()
+            return self.obj
+        self.checked = now
+        with db() as conn:
+            gen = self.gen_of(conn)
+        if gen != cur.gen:
+            if getattr(cur, "n", 1) == 0:
+                with self.lock:
+                    if self.obj is cur:
+                        self._build()
+                return self.obj
+            with self.lock:
+                start = not self.building
+                self.building = True
+            if start:
+                Thread(target=self._rebuilder, name=f"picapi-{self.name}", daemon=True).start()
+        return cur
+
+    def gen_of(self, conn):
+        if isinstance(self.gen_key, str):
+            return _meta_int(conn, self.gen_key)
+        return tuple(_meta_int(conn, k) for k in self.gen_key)
+
+    def status(self) -> dict:
+        return {"built": int(self.built), "building": self.building, "error": self.error}
+
+
+class TagIndex:
+    def __init__(self):
+        t0 = time.time()
+        with db() as conn:
+            self.gen = _meta_int(conn, "tag_gen")
+            # 按 rowid 排：新入库的排在末尾、移动保留 rowid，tag_gen 变了已有序号也不动，带 scope 的游标不会因此重排
+            rows = conn.execute("SELECT relpath, id, category, cnt FROM images ORDER BY rowid").fetchall()
+            self.rels = [r[0] for r in rows]
+            self.ids = [r[1] for r in rows]
+            self.cats = [r[2] for r in rows]
+            self.counts = array("I", (min(int(r[3] or 0), _SNAP_NONE - 1) for r in rows))
+            self.pos = {rel: i for i, rel in enumerate(self.rels)}
+            posting: dict = {}
+            for rel, lc in conn.execute("SELECT relpath, tag_lc FROM image_tags"):
+                i = self.pos.get(rel)
+                if i is not None:
+                    posting.setdefault(lc, set()).add(i)
+        self.n = len(self.rels)
+        self.all = (1 << self.n) - 1
+        self.tags: dict = {}
+        for lc, ords in posting.items():
+            if len(ords) * 32 > self.n:
+                self.tags[lc] = self._to_bits(ords)
+            else:
+                self.tags[lc] = array("I", sorted(ords))
+        self.took_ms = int((time.time() - t0) * 1000)
+        # 表达式 → _TagPool；挂在这份索引上，索引按 tag_gen 重建后自然作废
+        self.pools: "OrderedDict[str, _TagPool]" = OrderedDict()
+        self.pools_lock = Lock()
+
+    def _to_bits(self, ords) -> int:
+        buf = bytearray((self.n + 7) // 8)
+        for i in ords:
+            buf[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(buf, "little")
+
+    def bits(self, lc: str) -> int:
+        p = self.tags.get(lc)
+        if p is None:
+            return 0
+        return p if isinstance(p, int) else self._to_bits(p)
+
+    def eval(self, clauses: List[Tuple[bool, List[str]]]) -> int:
+        """[(是否排除, [任一标签…]), …] 逐个求交；只有排除项时从全集里减"""
+        acc = None
+        for neg, alts in sorted(clauses, key=lambda c: c[0]):      # 先算包含项，结果已空就不用再往下算
+            b = 0
+            for lc in alts:
+                b |= self.bits(lc)
+            if neg:
+                acc = (self.all if acc is None else acc) & ~b
+            else:
+                acc = b if acc is None else acc & b
+            if not acc:
+                return 0
+        return self.all if acc is None else acc
+
+    @staticmethod
+    def members(bits: int) -> List[int]:
+        out, base = [], 0
+        for byte in bits.to_bytes((bits.bit_length() + 7) // 8, "little"):
+            while byte:
+                low = byte & -byte
+                out.append(base + low.bit_length() - 1)
+                byte ^= low
+            base += 8
+        return out
+
+    def nbytes(self) -> int:
+        return sum(sys.getsizeof(p) if isinstance(p, int) else p.itemsize * len(p) for p in self.tags.values())
+
+
+_tagidx = _LiveIndex("tagidx", TagIndex, "tag_gen", TAG_INDEX_MIN_INTERVAL)
+
+
+def _tag_index() -> TagIndex:
+    if not TAG_INDEX:
+        raise HTTPException(400, "TAG_INDEX is off")
+    return _tagidx.get()
+
+
+def _tag_index_set_count(rel: str, cnt: int):
+    idx = _tagidx.obj
+    if idx is not None:
+        i = idx.pos.get(rel)
+        if i is not None:
+            idx.counts[i] = min(int(cnt), _SNAP_NONE - 1)
+
+
+def _parse_tag_expr(expr: str) -> List[Tuple[bool, List[str]]]:
+    """
+    一个标签表达式 → [(是否排除, [任一标签…]), …]，不分大小写：
+    - 空格分隔：都要有（AND）     风景 海
+    - | 分隔：有其一即可（OR）     猫|狗
+    - - 开头：不能有（NOT）       风景 -夜景
+    - 标签里带空格的用双引号括起来："blue sky"
+    """
+    out = []
+    for tok in _TAG_TERM_RE.findall(expr or ""):
+        neg = tok.startswith("-") and len(tok) > 1
+        if neg:
+            tok = tok[1:]
+        alts = [a.strip().strip('"').strip().lower() for a in tok.split("|")]
+        alts = [a for a in alts if a]
+        if alts:
+            out.append((neg, alts))
+    return out
+
+
+def parse_weighted_tags(tag_param: Optional[str]) -> List[Tuple[str, int]]:
+    """tag=猫:3,狗:1 → [(表达式, 权重)]；只有最后一段是整数才当权重，re:zero 这种标签原样保留"""
+    out: List[Tuple[str, int]] = []
+    for item in (tag_param or "").split(","):
+        item = item.strip()
+        name, _, w = item.rpartition(":")
+        if name and w.strip().isdigit():
+            item, wv = name.strip(), max(1, int(w))
+        else:
+            wv = 1
+        if _parse_tag_expr(item):
+            out.append((item, wv))
+    return out
+
+
+class _TagPool:
+    """
+    一个表达式的命中集合（序号升序，即入库顺序：新命中的图追加在末尾，游标下标稳定）。
+    存位图的字节串和每 4096 位一块的累计 popcount：第 k 个命中先二分定位块，再在块内按 64 位字数，
+    纯随机/游标抽图不用把集合展开成列表；要按评分次数加权时才展开一次并缓存。
+    """
+    BLOCK = 512     # 字节
+
+    def __init__(self, bits: int):
+        self.n = bits.bit_count()
+        self.raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        self.cum: List[int] = []
+        acc = 0
+        for off in range(0, len(self.raw), self.BLOCK):
+            self.cum.append(acc)
+            acc += int.from_bytes(self.raw[off:off + self.BLOCK], "little").bit_count()
+        self._ords = None
+
+    def select(self, k: int) -> int:
+        """第 k 个（0 起）命中的序号"""
+        b = bisect_right(self.cum, k) - 1
+        k -= self.cum[b]
+        base = b * self.BLOCK
+        for off in range(base, min(base + self.BLOCK, len(self.raw)), 8):
+            word = int.from_bytes(self.raw[off:off + 8], "little")
+            c = word.bit_count()
+            if k < c:
+                for _ in range(k):
+                    word &= word - 1
+                return off * 8 + (word & -word).bit_length() - 1
+            k -= c
+        raise IndexError(k)
+
+    def ords(self) -> array:
+        if self._ords is None:
+            self._ords = array("I", TagIndex.members(int.from_bytes(self.raw, "little")))
+        return self._ords
+
+
+def _tag_pool(idx: TagIndex, expr: str) -> _TagPool:
+    """表达式命中的集合；按 (idx.gen, 表达式) 缓存，同一个表达式反复抽不再求值"""
+    with idx.pools_lock:
+        pool = idx.pools.get(expr)
+        if pool is not None:
+            idx.pools.move_to_end(expr)
+            return pool
+    with _span("tagidx.eval", expr=expr) as sp:
+        pool = _TagPool(idx.eval(_parse_tag_expr(expr)))
+        sp["n"] = pool.n
+    with idx.pools_lock:
+        idx.pools[expr] = pool
+        while len(idx.pools) > TAG_POOL_CACHE:
+            idx.pools.popitem(last=False)
+    return pool
+
+
+def _tag_take(idx: TagIndex, pool: _TagPool, want: int, scope: Optional[str], expr: str,
+              bias: str, alpha: float, exclude: set) -> List[int]:
+    """从命中集合里取 want 个序号：带 scope 走不重复游标（游标窗口里照样按 bias 挑），否则按 bias 抽；exclude 里的跳过"""
+    if scope:
+        counts = lambda ks: [idx.counts[pool.select(i)] for i in ks]
+        picks = (pool.select(i) for i in _cursor_next(_cursor_key(scope, "tag", expr), pool.n, want, counts, bias, alpha))
+        return [j for j in picks if j not in exclude]
+    if bias not in ("min", "weighted"):
+        # 纯随机：抽下标直接定位（多抽 len(exclude) 个，撞上已选的也够分）
+        out: List[int] = []
+        for i in random.sample(range(pool.n), min(pool.n, want + len(exclude))):
+            j = pool.select(i)
+            if j not in exclude:
+                out.append(j)
+                if len(out) >= want:
+                    break
+        return out
+    ords = pool.ords()
+    keep = [j for j in ords if j not in exclude] if exclude else ords
+    return [keep[i] for i in _sample_indices(list(map(idx.counts.__getitem__, keep)), want, bias, alpha)]
+
+
+def _tag_pick(tag: str, n: int, scope: Optional[str], bias: Optional[str],
+              alpha: Optional[float]) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    tag=表达式[:权重],… 抽 n 张不重复的图 → [(relpath, id, category)]：
+    每个名额按权重抽一个表达式，同一表达式只求值一次；某个表达式不够分时按顺序从其它表达式补位（同 cat）
+    """
+    weighted = parse_weighted_tags(tag)
+    if not weighted:
+        raise HTTPException(422, "Empty tag expression.")
+    idx = _tag_index()
+    eff_bias, eff_alpha = _effective_bias(bias, alpha)
+    quota: dict = {}
+    for expr in random.choices([e for e, _ in weighted], weights=[w for _, w in weighted], k=n):
+        quota[expr] = quota.get(expr, 0) + 1
+    pools: dict = {}
+    picked: List[int] = []
+    seen: set = set()
+
+    def take(expr: str, want: int):
+        if expr not in pools:
+            pools[expr] = _tag_pool(idx, expr)
+        for j in _tag_take(idx, pools[expr], want, scope, expr, eff_bias, eff_alpha, seen):
+            seen.add(j)
+            if (GALLERY_DIR / idx.rels[j]).is_file():     # 删了但还没 reindex 的图跳过
+                picked.append(j)
+
+    for expr, want in quota.items():
+        take(expr, want)
+    for expr, _ in weighted:
+        if len(picked) >= n:
+            break
+        take(expr, n - len(picked))
+    if not picked:
+        raise HTTPException(404, "No images matched the tag expression.")
+    return [(idx.rels[j], idx.ids[j], idx.cats[j]) for j in picked[:n]]
+
+
+@app.get("/admin/tag_index")
+def tag_index_status(expr: Optional[str] = Query(default=None, description="顺便算一个表达式命中多少张，如 风景 -夜景")):
+    idx = _tag_index()
+    out = {
+        "enabled": TAG_INDEX,
+        "images": idx.n,
+        "tags": len(idx.tags),
+        "bitmap_tags": sum(isinstance(p, int) for p in idx.tags.values()),
+        "bytes": idx.nbytes(),
+        "gen": idx.gen,
+        "build_ms": idx.took_ms,
+        "cached_exprs": len(idx.pools),
+        **_tagidx.status(),
+    }
+    if expr is not None:
+        out["expr"] = {"clauses": _parse_tag_expr(expr), "matched": idx.eval(_parse_tag_expr(expr)).bit_count()}
+    return out
+
+
+
+# ===== 感知哈希：相似图（/similar）与重复图聚类（/duplicates）=====
+# 每张图一个 64 位 dHash（缩成 9x8 灰度，逐行比较相邻像素），存 image_phash；sync_subjects 与文件监听顺带算，
+# /admin/sync_phash 补算。查询用多索引哈希：64 位切成 4 个 16 位分块，汉明距离 ≤ r 的两个哈希至少有一块
+# 距离 ≤ r // 4（抽屉原理），所以每块只要试 r // 4 以内的键再逐个核对全距离，不扫全库。
+# 每块存成按键排序的 (键, 序号) 两个定长数组，二分查找；以 (tag_gen, phash_gen) 为准过期重建（图片增删/移动、哈希变了）。
+_PHASH_MASK = (1 << 64) - 1
+
+
+def _dhash(abs_path: Path) -> int:
+    with Image.open(abs_path) as im:
+        im.draft("L", (64, 64))     # JPEG 直接按 1/2～1/8 解码，省掉大部分解码时间
+        im = ImageOps.exif_transpose(im).convert("L").resize((9, 8), Image.LANCZOS)
+        px = im.tobytes()
+    h = 0
+    for y in range(8):
+        row = px[y * 9:y * 9 + 9]
+        for x in range(8):
+            h = (h << 1) | (row[x] < row[x + 1])
+    return h
+
+
+def _phash_missing(conn, limit: Optional[int] = None) -> List[str]:
+    """还没有感知哈希记录的图片 relpath（算失败的有 NULL 记录，不在其中）"""
+    if not PHASH or Image is None:
+        return []
+    sql = """SELECT i.relpath FROM images i
+             WHERE NOT EXISTS (SELECT 1 FROM image_phash p WHERE p.image_id = i.id) ORDER BY i.rowid"""
+    if limit:
+        return [r[0] for r in conn.execute(sql + " LIMIT ?", (int(limit),))]
+    return [r[0] for r in conn.execute(sql)]
+
+
+def _phash_compute(rels: List[str]) -> List[Tuple[str, Optional[int]]]:
+    """给这些 relpath 算 dHash（有符号 64 位，算失败为 None），不碰库：解码图片很慢，调用方在开写事务之前算好"""
+    if not PHASH or Image is None or not rels:
+        return []
+    out = []
+    with _span("phash.compute", n=len(rels)):
+        for rel in rels:
+            try:
+                h = _dhash(GALLERY_DIR / rel)
+                h = h - (1 << 64) if h >> 63 else h
+            except Exception:
+                h = None
+            out.append((rel, h))
+    return out
+
+
+def _phash_store(conn, hashes: List[Tuple[str, Optional[int]]]) -> int:
+    """
+    把 _phash_compute 的结果写进 image_phash（不 commit）；返回对上了几张图。
+    只写和库里不一样的（新图、哈希变了）；全都没变就不动 phash_gen，评分改写 XMP 后重算不会让相似度索引和 /duplicates 缓存作废。
+    """
+    rows = []
+    done = 0
+    for rel, h in hashes:
+        row = conn.execute("""SELECT i.id, p.image_id IS NOT NULL AS has, p.h FROM images i
+                              LEFT JOIN image_phash p ON p.image_id = i.id WHERE i.relpath=?""", (rel,)).fetchone()
+        if row is None:
+            continue
+        done += 1
+        if not row["has"] or row["h"] != h:
+            rows.append((row["id"], h))
+    if rows:
+        conn.executemany("""
+            INSERT INTO image_phash(image_id, h) VALUES (?, ?)
+            ON CONFLICT(image_id) DO UPDATE SET h = excluded.h
+        """, rows)
+        conn.execute("""
+            INSERT INTO meta(key, value) VALUES ('phash_gen', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """)
+    return done
+
+
+def _phash_update(conn, rels: List[str]) -> int:
+    """算完再写（不 commit）；conn 上不能有没提交的写，否则算哈希的整段时间都占着写锁"""
+    return _phash_store(conn, _phash_compute(rels))
+
+
+@functools.lru_cache(maxsize=None)
+def _phash_block_masks(r: int) -> Tuple[int, ...]:
+    """16 位分块里汉明距离 ≤ r 的所有翻转掩码（按距离从小到大）"""
+    return tuple(sorted((m for m in range(1 << 16) if m.bit_count() <= r), key=int.bit_count))
+
+
+class PhashIndex:
+    BLOCKS = 4
+
+    def __init__(self):
+        t0 = time.time()
+        with db() as conn:
+            self.gen = (_meta_int(conn, "tag_gen"), _meta_int(conn, "phash_gen"))
+            rows = conn.execute("""
+                SELECT i.relpath, i.id, i.category, p.h FROM images i JOIN image_phash p ON p.image_id = i.id
+                WHERE p.h IS NOT NULL ORDER BY i.relpath
+            """).fetchall()
+        self.rels = [r[0] for r in rows]
+        self.ids = [r[1] for r in rows]
+        self.cats = [r[2] for r in rows]
+        self.hashes = array("Q", (r[3] & _PHASH_MASK for r in rows))
+        self.n = len(rows)
+        self.keys: List[array] = []
+        self.order: List[array] = []
+        for b in range(self.BLOCKS):
+            shift = 16 * b
+            block = [(h >> shift) & 0xFFFF for h in self.hashes]
+            order = sorted(range(self.n), key=block.__getitem__)
+            self.order.append(array("I", order))
+            self.keys.append(array("H", (block[i] for i in order)))
+        self._clusters: dict = {}      # 半径 -> 聚类结果（同一代数内不变）
+        self._clusters_lock = Lock()
+        self.took_ms = int((time.time() - t0) * 1000)
+
+    def near(self, h: int, r: int) -> List[Tuple[int, int]]:
+        """汉明距离 ≤ r 的 [(距离, 序号)]，按距离升序"""
+        out, seen = [], set()
+        masks = _phash_block_masks(r // self.BLOCKS)
+        for b in range(self.BLOCKS):
+            keys, order = self.keys[b], self.order[b]
+            key = (h >> (16 * b)) & 0xFFFF
+            for m in masks:
+                k = key ^ m
+                lo = bisect_left(keys, k)
+                if lo == self.n or keys[lo] != k:
+                    continue
+                for j in order[lo:bisect_right(keys, k, lo)]:
+                    if j not in seen:
+                        seen.add(j)
+                        d = (self.hashes[j] ^ h).bit_count()
+                        if d <= r:
+                            out.append((d, j))
+        out.sort()
+        return out
+
+    def clusters(self, r: int) -> List[List[int]]:
+        """
+        距离 ≤ r 连通的重复图组（并查集，传递合并），大的在前；每个半径只算一次。
+        不逐张调 near()：把 64 位切成 r+1 块，距离 ≤ r 的两张至少有一块完全相同，
+        所以只比较某一块相同的图对，每块一次分组即可。
+        """
+        with self._clusters_lock:
+            if r in self._clusters:
+                return self._clusters[r]
+            parent = list(range(self.n))
+
+            def find(i: int) -> int:
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            hashes = self.hashes
+            cuts = [64 * b // (r + 1) for b in range(r + 2)]
+            for lo, hi in zip(cuts, cuts[1:]):
+                mask = (1 << (hi - lo)) - 1
+                buckets: dict = {}
+                for i, h in enumerate(hashes):
+                    buckets.setdefault((h >> lo) & mask, []).append(i)
+                for members in buckets.values():
+                    for x, i in enumerate(members):
+                        hi_ = hashes[i]
+                        for j in members[x + 1:]:
+                            if (hashes[j] ^ hi_).bit_count() <= r:
+                                a, b = find(i), find(j)
+                                if a != b:
+                                    parent[max(a, b)] = min(a, b)
+            groups: dict = {}
+            for i in range(self.n):
+                groups.setdefault(find(i), []).append(i)
+            out = sorted((g for g in groups.values() if len(g) > 1), key=lambda g: (-len(g), g[0]))
+            self._clusters[r] = out
+            return out
+
+    def nbytes(self) -> int:
+        return self.hashes.itemsize * self.n + sum(a.itemsize * len(a) for a in self.keys + self.order)
+
+
+_phashidx = _LiveIndex("phash", PhashIndex, ("tag_gen", "phash_gen"), PHASH_MIN_INTERVAL)
+
+
+def _phash_index() -> PhashIndex:
+    if not PHASH:
+        raise HTTPException(400, "PHASH is off")
+    return _phashidx.get()
+
+
+def _phash_of(ident: str) -> Tuple[sqlite3.Row, int]:
+    """按 images.id 或 relpath 找图和它的哈希；还没算过的现算（不落库，副本上也能用）"""
+    with db() as conn:
+        row = None
+        for col in ("id", "relpath"):
+            row = conn.execute(f"""
+                SELECT i.id, i.relpath, i.category, p.h FROM images i
+                LEFT JOIN image_phash p ON p.image_id = i.id WHERE i.{col} = ?
+            """, (ident,)).fetchone()
+            if row:
+                break
+    if not row:
+        raise HTTPException(404, "image id not found")
+    if row["h"] is not None:
+        return row, row["h"] & _PHASH_MASK
+    if Image is None:
+        raise HTTPException(503, "Pillow is not installed; cannot hash images")
+    try:
+        return row, _dhash(GALLERY_DIR / row["relpath"])
+    except Exception as e:
+        raise HTTPException(422, f"cannot hash image: {type(e).__name__}: {e}")
+
+
+@app.get("/similar")
+def similar(
+    id: str = Query(..., description="images.id 或 relpath"),
+    radius: Optional[int] = Query(default=None, ge=0, le=PHASH_MAX_RADIUS, description="汉明半径（0~64 位里差几位）"),
+    limit: int = Query(default=10, ge=1, le=100),
+    preset: Optional[str] = Query(default=None, description="同 /random_pic：派生图预设"),
+):
+    """
+    和这张图相似的图，按汉明距离从近到远（不含它自己）；dup=true 表示距离在 PHASH_DUP_RADIUS 以内，基本是同一张图。
+    """
+    idx = _phash_index()
+    row, h = _phash_of(id)
+    r = PHASH_SIMILAR_RADIUS if radius is None else radius
+    items = []
+    with _span("phash.near", radius=r) as sp:
+        hits = idx.near(h, r)
+        sp["n"] = len(hits)
+    for d, j in hits:
+        if idx.ids[j] == row["id"] or not (GALLERY_DIR / idx.rels[j]).is_file():
+            continue
+        items.append({**_pic_payload(idx.rels[j], idx.ids[j], idx.cats[j], preset=preset),
+                      "distance": d, "dup": d <= PHASH_DUP_RADIUS})
+        if len(items) >= limit:
+            break
+    return {"query": {"id": row["id"], "relpath": row["relpath"], "phash": f"{h:016x}"},
+            "radius": r, "count": len(items), "items": items}
+
+
+@app.get("/duplicates")
+def duplicates(
+    request: Request,
+    radius: Optional[int] = Query(default=None, ge=0, le=6, description="距离不超过它的算重复，默认 PHASH_DUP_RADIUS；越大越慢"),
+    limit: int = Query(default=20, ge=1, le=200, description="返回几组"),
+    offset: int = Query(default=0, ge=0),
+):
+    """
+    重复图聚类：按组大小降序；组内评分次数多的在前（删重复时建议留第一张），distance 为与第一张的距离。
+    第一次请求某个半径时在整库上算一遍（20 万张、半径 4 约 3 秒），之后直到图片或哈希变化前都直接用结果。
+    """
+    idx = _phash_index()
+    r = PHASH_DUP_RADIUS if radius is None else radius
+
+    def build() -> dict:
+        with _span("phash.clusters", radius=r):
+            groups = idx.clusters(r)
+        page = groups[offset:offset + limit]
+        ids = [idx.ids[j] for g in page for j in g]
+        stats: dict = {}
+        with db() as conn:
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                q = ",".join("?" * len(chunk))
+                for row in conn.execute(f"SELECT id, cnt, avg FROM images WHERE id IN ({q})", tuple(chunk)):
+                    stats[row["id"]] = (int(row["cnt"] or 0), round(float(row["avg"] or 0), SCORE_PRECISION))
+        out = []
+        for g in page:
+            g = sorted(g, key=lambda j: (-stats.get(idx.ids[j], (0, 0))[0], idx.rels[j]))
+            head = idx.hashes[g[0]]
+            out.append({"size": len(g), "items": [
+                {"id": idx.ids[j], "relpath": idx.rels[j], "url": to_url(idx.rels[j]),
+                 "cnt": stats.get(idx.ids[j], (0, 0))[0], "avg": stats.get(idx.ids[j], (0, 0))[1],
+                 "distance": (idx.hashes[j] ^ head).bit_count()} for j in g]})
+        return {"radius": r, "clusters": len(groups), "images": sum(len(g) for g in groups),
+                "offset": offset, "items": out}
+
+    return _conditional_json(request, _etag_for("duplicates", *idx.gen, r, limit, offset), build)
+
+
+@app.get("/admin/phash")
+def phash_status():
+    idx = _phash_index()
+    with db() as conn:
+        pending = conn.execute("""SELECT COUNT(*) FROM images i
+                                  WHERE NOT EXISTS (SELECT 1 FROM image_phash p WHERE p.image_id = i.id)""").fetchone()[0]
+        failed = conn.execute("SELECT COUNT(*) FROM image_phash WHERE h IS NULL").fetchone()[0]
+    return {
+        "enabled": PHASH,
+        "pillow": Image is not None,
+        "images": idx.n,
+        "pending": pending,
+        "failed": failed,
+        "bytes": idx.nbytes(),
+        "gen": list(idx.gen),
+        "build_ms": idx.took_ms,
+        "cached_radii": sorted(idx._clusters),
+        **_phashidx.status(),
+    }
+
+
+@app.post("/admin/sync_phash")
+@_exclusive("sync_phash")
+def admin_sync_phash(limit: int = 0, full: bool = False):
+    """补算缺失的感知哈希（limit > 0 只算 N 张）；full=true 全库重算（换了哈希算法/参数时用）"""
+    if not PHASH or Image is None:
+        raise HTTPException(400, "PHASH is off or Pillow is not installed")
+    with db() as conn:
+        if full:
+            rels = [r[0] for r in conn.execute("SELECT relpath FROM images ORDER BY rowid")]
+            rels = rels[:limit] if limit > 0 else rels
+        else:
+            rels = _phash_missing(conn, limit if limit > 0 else None)
+        _set_prog("sync_phash", total=len(rels), done=0)
+        done = 0
+        try:
+            for i in range(0, len(rels), 200):
+                done += _phash_update(conn, rels[i:i + 200])
+                conn.commit()
+                _tick_prog(len(rels[i:i + 200]))
+        finally:
+            _set_prog("idle", 0, 0)
+    return {"processed": done}
+
+
+# ===== 只读副本：primary 用 SQLite 在线备份导出整库，replica 定期拉回来整文件替换 =====
+# - primary：GET /admin/snapshot，ETag = 数据库代数，副本带 If-None-Match，没变化只回 304
+# - replica：一个 worker 负责拉（flock），下载到 .incoming → quick_check → os.replace；
+#   其余 worker 每次新开连接自然读到新文件。/rate 转发给 primary，维护类接口 403
+_replica_state = {"mode": "off", "pulls": 0, "updated": 0, "last_pull": 0, "last_ok": 0,
+                  "bytes": 0, "errors": 0, "last_error": None}
+_replica_lock_fd: list = [None]
+
+
+def _forward_to_primary(method: str, path: str, payload: dict):
+    if not PRIMARY_URL:
+        raise HTTPException(503, "PRIMARY_URL is not configured on this replica")
+    headers = {"Content-Type": "application/json"}
+    tr = _trace_cur.get()
+    if tr is not None:
+        headers["X-Request-ID"] = tr.rid          # 主库那边的追踪记在同一个 ID 下
+    req = urllib.request.Request(PRIMARY_URL + path, data=json.dumps(payload).encode("utf-8"), method=method,
+                                 headers=headers)
+    try:
+        with _span("forward_to_primary", path=path), urllib.request.urlopen(req, timeout=30) as resp:
+            return JSONResponse(json.loads(resp.read() or b"null"), status_code=resp.status)
+    except urllib.error.HTTPError as e:
+        try:
+            detail = json.loads(e.read()).get("detail")
+        except Exception:
+            detail = e.reason
+        raise HTTPException(e.code, detail)
+    except OSError as e:
+        raise HTTPException(502, f"primary unreachable: {e}")
+
+
+def _replica_pull_once() -> bool:
+    """拉一次快照；换上了新库返回 True，没变化返回 False，出错抛异常"""
+    req = urllib.request.Request(PRIMARY_URL + "/admin/snapshot")
+    if DB_PATH.exists():
+        req.add_header("If-None-Match", f'"gen-{_db_gen()}"')
+    tmp = DB_PATH.with_name(DB_PATH.name + ".incoming")
+    _replica_state["pulls"] += 1
+    _replica_state["last_pull"] = int(time.time())
+    try:
+        with urllib.request.urlopen(req, timeout=max(REPLICA_PULL_INTERVAL, 60)) as resp, open(tmp, "wb") as f:
+            shutil.copyfileobj(resp, f, 1 << 20)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            _replica_state["last_ok"] = int(time.time())
+            return False
+        raise
+    try:
+        chk = sqlite3.connect(f"file:{urllib.parse.quote(str(tmp))}?mode=ro&immutable=1", uri=True)
+        try:
+            verdict = chk.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            chk.close()
+        if verdict != "ok":
+            raise RuntimeError(f"snapshot failed quick_check: {verdict}")
+        _replica_state["bytes"] = tmp.stat().st_size
+        os.replace(tmp, DB_PATH)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    _replica_state["updated"] += 1
+    _replica_state["last_ok"] = int(time.time())
+    _snapshot_mark_dirty()
+    return True
+
+
+def _replica_pull_safe():
+    try:
+        _replica_pull_once()
+        _replica_state["last_error"] = None
+    except Exception as e:
+        _replica_state["errors"] += 1
+        _replica_state["last_error"] = f"{type(e).__name__}: {e}"
+
+
+def _replica_loop():
+    while True:
+        time.sleep(REPLICA_PULL_INTERVAL)
+        _replica_pull_safe()
+
+
+def start_replica_sync():
+    if not PRIMARY_URL:
+        raise RuntimeError("PICAPI_ROLE=replica requires PRIMARY_URL")
+    if fcntl is not None:
+        _replica_lock_fd[0] = _try_flock("picapi.pull.lock")
+        if _replica_lock_fd[0] is None:
+            _replica_state["mode"] = "follower"   # 别的 worker 在拉，这里只读文件
+            return
+    _replica_state["mode"] = "puller"
+    _replica_pull_safe()   # 启动时先同步拉一次，拉不到也照常启动，后台继续重试
+    Thread(target=_replica_loop, name="picapi-replica", daemon=True).start()
+
+
+@app.get("/admin/snapshot")
+def admin_snapshot(request: Request):
+    """整库一致性快照（SQLite 在线备份，不阻塞写入），给只读副本拉取"""
+    if IS_REPLICA:
+        raise HTTPException(403, "snapshots are served by the primary only")
+    etag = f'"gen-{_db_gen()}"'
+    if _if_none_match(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    RUN_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = RUN_DIR / f"snapshot.{os.getpid()}.{random.getrandbits(32):08x}.sqlite"
+    src, dst = db(), sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode=DELETE")   # 副本单文件自包含，不带 -wal/-shm
+        row = dst.execute("SELECT value FROM meta WHERE key='gen'").fetchone()
+    finally:
+        dst.close()
+        src.close()
+    etag = f'"gen-{int(row[0]) if row else 0}"'
+    return FileResponse(tmp, media_type="application/vnd.sqlite3", headers={"ETag": etag},
+                        background=BackgroundTask(os.remove, tmp))
+
+
+@app.get("/admin/replica")
+def replica_status():
+    out = {"role": PICAPI_ROLE, "primary_url": PRIMARY_URL or None}
+    if IS_REPLICA:
+        out.update(_replica_state)
+        out["gen"] = _db_gen() if DB_PATH.exists() else None
+        out["age"] = int(time.time()) - _replica_state["last_ok"] if _replica_state["last_ok"] else None
+    return out
+
+
+
+_PROCESS_START = time.time()
+
+
+def _gauge(name: str, help_: str, value, _only: bool = False, **labels):
+    """设一个状态量；_only=True 时先清掉该指标的其它标签组合（如阶段切换后旧阶段那条不再输出）"""
+    m = _M_GAUGE.get(name)
+    if m is None:
+        m = _M_GAUGE[name] = _Metric(name, "gauge", help_, tuple(labels))
+    if _only:
+        with m.lock:
+            m.values.clear()
+    m.set(value, *labels.values())
+
+
+def _collect_gauges():
+    """抓取时现算的状态量：维护任务进度、各缓存大小与命中率、监听队列、快照/副本状态"""
+    _gauge("picapi_worker_info", "本 worker 的进程号与角色", 1, pid=str(os.getpid()), role=PICAPI_ROLE)
+    _gauge("picapi_process_start_time_seconds", "本 worker 启动时间", round(_PROCESS_START, 3))
+    prog = _prog_read()
+    _gauge("picapi_job_running", "维护任务是否在跑（按阶段）", int(prog["phase"] != "idle"), _only=True,
+           phase=prog["phase"])
+    _gauge("picapi_job_total", "当前维护任务的总量", prog["total"])
+    _gauge("picapi_job_done", "当前维护任务已完成量", prog["done"])
+    _gauge("picapi_job_updated_timestamp_seconds", "进度最后一次更新的时间", prog["updated"])
+    if DB_PATH.exists():
+        _gauge("picapi_db_generation", "数据库代数（meta.gen）", _db_gen())
+    with _deriv_lock:
+        _gauge("picapi_deriv_cache_bytes", "派生图缓存占用字节（本 worker 视图）", _deriv_bytes[0])
+        _gauge("picapi_deriv_cache_files", "派生图缓存文件数", len(_deriv_lru))
+        _gauge("picapi_deriv_inflight", "正在生成的派生图", len(_deriv_inflight))
+    _gauge("picapi_dirs_cache_entries", "/dirs 结果缓存条目", len(_dirs_cache))
+    for (cache, result), n in list(_M_CACHE.values.items()):
+        if result == "hit":
+            total = n + _M_CACHE.get(cache, "miss")
+            _gauge("picapi_cache_hit_ratio", "各缓存的累计命中率", round(n / total, 4) if total else 0.0, cache=cache)
+    with _watch_lock:
+        _gauge("picapi_watch_pending", "文件监听待落库的路径数", sum(len(v) for v in _watch_pending.values()))
+        _gauge("picapi_watch_applied_total", "文件监听累计落库的变更数", _watch_state["applied"])
+        _gauge("picapi_watch_errors_total", "文件监听落库失败次数", _watch_state["errors"])
+    snap = _snap_state["obj"]
+    if snap is not None:
+        _gauge("picapi_index_snapshot_images", "索引快照里的图片数", snap.n)
+        _gauge("picapi_index_snapshot_gen", "索引快照对应的数据库代数", snap.gen)
+    if IS_REPLICA and _replica_state["last_ok"]:
+        _gauge("picapi_replica_age_seconds", "副本距上次成功同步的秒数", int(time.time()) - _replica_state["last_ok"])
+    if ADMIT:
+        for name, g in _GATES.items():
+            _gauge("picapi_admission_in_flight", "各类接口正在执行的请求数（本 worker）", g.in_flight, cls=name)
+            _gauge("picapi_admission_waiting", "各类接口排队等位的请求数（本 worker）", g.waiting, cls=name)
+            _gauge("picapi_admission_limit", "各类接口的并发上限", g.limit, cls=name)
+
+
+@app.get("/admin/metrics")
+def admin_metrics():
+    """Prometheus 文本格式；METRICS=off 时只有状态量，没有请求/SQL/exiftool 的计时"""
+    _collect_gauges()
+    out: List[str] = []
+    for m in _metrics_registry:
+        m.render(out)
+    return Response("\n".join(out) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/admin/status")
+def admin_status(top: int = Query(default=5, ge=0, le=50)):
+    """
+    给插件 #图库状态 用的一页 JSON：本 worker 的请求量/进行中、最慢的几个路由（均值），以及全局的维护任务、
+    监听队列、快照/副本状态。不扫盘（/health 会列全库文件，不适合频繁调）。
+    """
+    routes = {}
+    with _M_HTTP.lock:
+        for (route, _method, status), h in _M_HTTP.values.items():
+            r = routes.setdefault(route, [0, 0.0, 0])
+            n = sum(h[:-1])
+            r[0] += n
+            r[1] += h[-1]
+            if status.startswith("5"):
+                r[2] += n
+    slow = sorted(((k, v) for k, v in routes.items() if v[0] and k != "/admin/status"),
+                  key=lambda kv: kv[1][1] / kv[1][0], reverse=True)[:top]
+    prog = _prog_read()
+    with _watch_lock:
+        pending = sum(len(v) for v in _watch_pending.values())
+    snap = _snap_state["obj"]
+    out = {
+        "role": PICAPI_ROLE,
+        "pid": os.getpid(),
+        "uptime_s": int(time.time() - _PROCESS_START),
+        "metrics": METRICS,
+        "requests": sum(v[0] for v in routes.values()),
+        "errors_5xx": sum(v[2] for v in routes.values()),
+        "in_flight": int(_M_INFLIGHT.get()) - (1 if METRICS else 0),   # 不算这次请求自己
+        "slow_routes": [{"route": k, "n": v[0], "mean_ms": round(v[1] / v[0] * 1000, 1)} for k, v in slow],
+        "job": {k: prog[k] for k in ("phase", "total", "done", "updated")},
+        "maintenance_running": _maintenance_running() if not IS_REPLICA else False,
+        "watch": {"mode": _watch_state["mode"], "pending": pending},
+        "snapshot": {"images": snap.n, "gen": snap.gen} if snap is not None else None,
+        "gen": _db_gen() if DB_PATH.exists() else None,
+        "admission": {name: g.stats() for name, g in _GATES.items()} if ADMIT else None,
+    }
+    if DB_PATH.exists():
+        with db() as conn:
+            out["images"] = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    if IS_REPLICA:
+        out["replica_age_s"] = int(time.time()) - _replica_state["last_ok"] if _replica_state["last_ok"] else None
+    return out
+
+
+@app.get("/admin/traces")
+def admin_traces(
+    min_ms: float = Query(default=None, ge=0, description="只看耗时 ≥ 这么多毫秒的请求；默认 TRACE_SLOW_MS"),
+    limit: int = Query(default=20, ge=1, le=500),
+    rid: Optional[str] = Query(default=None, description="按请求 ID 查（插件日志里的 rid=…）"),
+    route: Optional[str] = Query(default=None, description="只看某个路由模板，如 /rate"),
+    spans: bool = Query(default=True, description="false 只回每条的汇总（by_name），不回逐段明细"),
+):
+    """
+    本 worker 最近请求的分段耗时（内存环形缓冲：最近 TRACE_BUFFER 个 + 慢请求另存 TRACE_SLOW_BUFFER 个），新的在前。
+    多 worker 时每个进程各有一份，回包里带 pid；按 rid 查不到可以多请求几次碰到别的 worker。
+    """
+    if not TRACE:
+        raise HTTPException(404, "tracing is disabled (TRACE=off)")
+    if min_ms is None:
+        min_ms = 0.0 if rid else TRACE_SLOW_MS
+    with _traces_lock:
+        pool = list(_traces_slow) + list(_traces_recent)
+    seen = set()
+    hits = []
+    for tr in sorted(pool, key=lambda t: t.ts, reverse=True):
+        if id(tr) in seen:
+            continue
+        seen.add(id(tr))
+        if tr.ms < min_ms or (rid and tr.rid != rid) or (route and tr.route != route):
+            continue
+        hits.append(tr.as_dict(with_spans=spans))
+        if len(hits) >= limit:
+            break
+    return {"pid": os.getpid(), "min_ms": min_ms, "slow_ms": TRACE_SLOW_MS,
+            "buffered": len(seen), "traces": hits}
+
+
+@app.get("/admin/slow_queries")
+def admin_slow_queries(
+    sort: str = Query(default="total", description="total：累计耗时；max：单次最慢；n：次数"),
+    limit: int = Query(default=50, ge=1, le=500),
+    plan: bool = Query(default=True, description="false 不回 EXPLAIN QUERY PLAN"),
+):
+    """
+    本 worker 里超过 SLOW_SQL_MS 的语句，按形状汇总（字面量归一成 ?）：次数、累计/平均/最大耗时、参数个数、
+    最近一次所在请求的 rid（可接着查 /admin/traces?rid=…），以及该形状第一次变慢时抓到的查询计划。
+    """
+    if sort not in ("total", "max", "n"):
+        raise HTTPException(400, "sort must be total / max / n")
+    key = {"total": "total_ms", "max": "max_ms", "n": "n"}[sort]
+    with _slow_sql_lock:
+        rows = [dict(v) for v in _slow_sql.values()]
+        dropped = _slow_sql_dropped[0]
+    rows.sort(key=lambda r: r[key], reverse=True)
+    out = []
+    for r in rows[:limit]:
+        r["mean_ms"] = round(r["total_ms"] / r["n"], 1) if r["n"] else 0.0
+        r["total_ms"] = round(r["total_ms"], 1)
+        r["max_ms"] = round(r["max_ms"], 1)
+        if not plan:
+            r.pop("plan")
+        out.append(r)
+    return {"pid": os.getpid(), "threshold_ms": SLOW_SQL_MS, "shapes": len(rows), "dropped": dropped,
+            "queries": out}
+
+
+@app.post("/admin/slow_queries/reset")
+def admin_slow_queries_reset():
+    """清空本 worker 的慢 SQL 汇总（改完索引后重新观察用）；查询计划也会在下次变慢时重新抓"""
+    with _slow_sql_lock:
+        n = len(_slow_sql)
+        _slow_sql.clear()
+        _slow_sql_dropped[0] = 0
+    return {"ok": True, "cleared": n, "pid": os.getpid()}
+
+
+# ===== 采样剖析（/admin/profile）=====
+_profile_lock = Lock()
+# cpu 模式下栈顶停在这些函数里的线程算空闲：它们在两次采样之间醒过一下（CPU 时钟有增量），但此刻在等
+_IDLE_CODES = {threading.Condition.wait.__code__, threading.Thread._wait_for_tstate_lock.__code__,
+               selectors.DefaultSelector.select.__code__}
+
+
+def _frame_label(code) -> str:
+    path = code.co_filename.replace("\\", "/").rsplit("/", 2)
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({'/'.join(path[-2:])}:{code.co_firstlineno})".replace(";", ":")
+
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _thread_cpu_seconds(native_id: int) -> Optional[float]:
+    """
+    线程已用的 CPU 秒数（utime + stime，精度是一个时钟滴答，通常 10ms），读 /proc/self/task/<tid>/stat；线程已退出返回 None。
+    不用 pthread_getcpuclockid：拿 sys._current_frames() 里的 ident 去取，线程恰好退出时是未定义行为，可能直接段错误。
+    """
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLK_TCK     # 第 14、15 个字段；线程名里可能有 ')'，从最后一个后面数
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _sample_stacks(seconds: float, hz: float, mode: str) -> Tuple[dict, int, float]:
+    """
+    每 1/hz 秒用 sys._current_frames() 抓一次所有线程的栈，累计成 {折叠栈: 次数}。
+    wall：每个线程每次都算（含等锁/等 IO/空闲）；cpu：只算上次采样以来用掉至少 5% 采样间隔 CPU 的线程
+    （按 /proc 里的线程 CPU 时间判断），且栈顶不在 _IDLE_CODES 里。
+    返回 (栈计数, 采样轮数, 采样本身花掉的秒数)。
+    """
+    me = threading.get_ident()
+    labels = {}
+    stacks = {}
+    cpu_last = {}
+    rounds = 0
+    cost = 0.0
+    interval = 1.0 / hz
+    deadline = time.monotonic() + seconds
+    nxt = time.monotonic()
+    while True:
+        t0 = time.perf_counter()
+        threads = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if mode == "cpu":
+                t = threads.get(ident)
+                used = _thread_cpu_seconds(t.native_id) if t is not None and t.native_id else None
+                if used is None:                       # 线程刚好退出
+                    continue
+                prev = cpu_last.get(ident)
+                cpu_last[ident] = used
+                if prev is None or used - prev < interval * 0.05 or frame.f_code in _IDLE_CODES:
+                    continue
+            parts = []
+            depth = 0
+            while frame is not None and depth < 128:
+                code = frame.f_code
+                lbl = labels.get(code)
+                if lbl is None:
+                    lbl = labels[code] = _frame_label(code)
+                parts.append(lbl)
+                frame = frame.f_back
+                depth += 1
+            parts.append("thread:" + (threads[ident].name if ident in threads else str(ident)).replace(";", ":"))
+            key = ";".join(reversed(parts))
+            stacks[key] = stacks.get(key, 0) + 1
+        frame = None           # 别让最后一个栈帧的引用留到下一轮
+        rounds += 1
+        cost += time.perf_counter() - t0
+        nxt += interval
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        if nxt > now:
+            time.sleep(min(nxt, deadline) - now)
+        else:
+            nxt = now          # 落后了就不补采，免得连着空转
+    return stacks, rounds, cost
+
+
+@app.get("/admin/profile")
+def admin_profile(
+    seconds: float = Query(default=10.0, gt=0, description="采样多少秒（上限 PROFILE_MAX_S）"),
+    mode: str = Query(default="wall", description="wall：所有线程（含等待）；cpu：只算正在用 CPU 的线程"),
+    hz: float = Query(default=97.0, ge=1, le=1000, description="每秒采样次数；默认 97 避开与定时任务同频"),
+):
+    """
+    进程内采样剖析：不用重启、不装 profiler，采 N 秒本 worker 所有线程的 Python 栈，
+    回折叠栈文本（每行 “线程;外层;…;内层 次数”），可以直接喂给 flamegraph.pl / speedscope / inferno。
+    同一时间只允许一个（409）；多 worker 时只剖到处理这个请求的那个进程（响应头 X-Profile-Pid）。
+    """
+    if mode not in ("wall", "cpu"):
+        raise HTTPException(400, "mode must be wall or cpu")
+    if mode == "cpu" and not os.path.isdir("/proc/self/task"):
+        raise HTTPException(400, "cpu mode needs per-thread CPU times from /proc (not available on this platform)")
+    if seconds > PROFILE_MAX_S:
+        raise HTTPException(400, f"seconds must be <= {PROFILE_MAX_S:g} (PROFILE_MAX_S)")
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(409, "another profile is running")
+    try:
+        stacks, rounds, cost = _sample_stacks(seconds, hz, mode)
+    finally:
+        _profile_lock.release()
+    body = "".join(f"{k} {v}\n" for k, v in sorted(stacks.items(), key=lambda kv: -kv[1]))
+    return Response(body, media_type="text/plain; charset=utf-8", headers={
+        "X-Profile-Pid": str(os.getpid()),
+        "X-Profile-Mode": mode,
+        "X-Profile-Samples": str(rounds),
+        "X-Profile-Overhead-Ms": f"{cost * 1000:.1f}",
+    })
+
+
+@app.get("/health")
+def health():
+    files = list_all_files(GALLERY_DIR)
+    return {
+        "ok": True,
+        "gallery": str(GALLERY_DIR),
+        "allowed_suffixes": ALLOWED_SUFFIXES,
+        "recursive": RECURSIVE,
+        "top_categories": list_top_categories(),
+        "total_files": len(files),
+        "db": str(DB_PATH),
+    }
+
+@app.get("/categories")
+def categories(request: Request):
+    # 顶级分类只取决于图库根目录的直接子项 → 根目录 mtime 变了 ETag 才变
+    etag = _etag_for("categories", GALLERY_DIR.stat().st_mtime_ns)
+    return _conditional_json(request, etag, lambda: {"categories": list_top_categories()})
+
+@app.get("/tags")
+def tags(
+    request: Request,
+    prefix: str = Query(default="", description="标签前缀（不分大小写）；空=全库最常用的"),
+    limit: int = Query(default=20, ge=1, le=200),
+):
+    """标签自动补全：按前缀给出最常用的标签与各自的图片数。结果只随数据库代数变化 → 带 ETag"""
+    etag = _etag_for("tags", _db_gen(), prefix, limit)
+    return _conditional_json(request, etag, lambda: _tags_uncached(prefix, limit))
+
+
+def _tags_uncached(prefix: str, limit: int) -> dict:
+    p = prefix.strip().lower()
+    with db() as conn:
+        # 以库里记的展开长度为准（replica 的 TAG_PREFIX_MAX 可能和 primary 不一样）
+        built = conn.execute("SELECT value FROM meta WHERE key='tag_prefix_max'").fetchone()
+        if not p:
+            rows = conn.execute("SELECT tag, n FROM tag_stats ORDER BY n DESC, tag_lc LIMIT ?", (limit,)).fetchall()
+        elif built and len(p) <= int(built[0]):
+            # idx_tag_prefix_top：等值定位到这个前缀，按 n 倒序的索引顺序取前 limit 行
+            rows = conn.execute("""
+                SELECT s.tag, tp.n FROM tag_prefix tp JOIN tag_stats s ON s.tag_lc = tp.tag_lc
+                 WHERE tp.prefix = ? ORDER BY tp.n DESC, tp.tag_lc LIMIT ?
+            """, (p, limit)).fetchall()
+        else:
+            # 比展开长度还长的前缀：主键上的范围扫描，命中的标签很少，排序代价可以忽略
+            rows = conn.execute("""
+                SELECT tag, n FROM tag_stats WHERE tag_lc >= ? AND tag_lc < ?
+                 ORDER BY n DESC, tag_lc LIMIT ?
+            """, (p, p + "\U0010ffff", limit)).fetchall()
+    return {"prefix": prefix, "tags": [{"tag": t, "count": n} for t, n in rows]}
+
+
+@app.post("/admin/rebuild_tags")
+@_exclusive("rebuild_tags")
+def admin_rebuild_tags():
+    """从 image_tags 全量重算标签频次与前缀索引（改了 TAG_PREFIX_MAX、或怀疑计数漂了时用）"""
+    with db() as conn:
+        n = _rebuild_tag_stats(conn)
+        _bump_gen(conn)
+        conn.commit()
+    return {"ok": True, "tags": n}
+
+
+@app.get("/admin/pinyin")
+def admin_pinyin(q: str = Query(..., description="要试的拼音或首字母，如 fengjing / fj")):
+    """看一个拼音词会被换成哪些汉字串（/random_pic?q= 实际检索的就是原词加这些）"""
+    with db() as conn:
+        natives = _pinyin_natives(conn, q)
+        keys = conn.execute("SELECT COUNT(*) FROM pinyin_map").fetchone()[0]
+    return {"q": q, "enabled": bool(_PINYIN), "table_chars": len(_PINYIN), "keys": keys, "natives": natives}
+
+
+@app.post("/admin/rebuild_pinyin")
+@_exclusive("rebuild_pinyin")
+def admin_rebuild_pinyin():
+    """从现有标签与图片路径全量重建拼音索引（换了 pinyin.txt、或清理掉大量旧目录之后用）"""
+    with db() as conn:
+        n = _rebuild_pinyin(conn)
+        _bump_gen(conn)
+        conn.commit()
+    return {"ok": True, "keys": n}
+
+
+def _safe_join_under_gallery(sub: str) -> Path:
+    """
+    把用户传入的相对路径拼到 GALLERY_DIR 下，并做越界保护。
+    """
+    p = (GALLERY_DIR / (sub.strip("/"))) if sub else GALLERY_DIR
+    p = p.resolve()
+    g = GALLERY_DIR.resolve()
+    try:
+        p.relative_to(g)
+    except Exception:
+        raise HTTPException(status_code=400, detail="path out of gallery")
+    return p
+
+_dirs_cache: "OrderedDict[str, dict]" = OrderedDict()   # etag -> 已算好的 /dirs 结果
+_dirs_cache_lock = Lock()
+
+
+@app.get("/dirs")
+def list_subdirs(request: Request, path: str = ""):
+    """
+    列出 path（相对图库根）下的**直接子文件夹**。
+    返回相对 GALLERY_DIR 的子路径，并附带该子路径下（递归）图片文件数量。
+
+    ETag = 数据库代数 + 本层与直接子目录的 mtime（只 stat 一层，不递归）。
+    更深层目录里增删文件要等下一次 #整理图库（代数 +1）才会反映到计数上。
+    """
+    base = _safe_join_under_gallery(path)
+    if not base.exists() or not base.is_dir():
+        raise HTTPException(status_code=404, detail="path not found")
+
+    stamp = [base.stat().st_mtime_ns]
+    for child in base.iterdir():
+        if child.is_dir():
+            stamp.append((child.name, child.stat().st_mtime_ns))
+    etag = _etag_for("dirs", _db_gen(), base, sorted(stamp[1:]), stamp[0])
+
+    def build():
+        with _dirs_cache_lock:
+            hit = _dirs_cache.get(etag)
+        _cache_event("dirs", hit is not None)
+        if hit is None:
+            hit = _list_subdirs_uncached(base)
+            with _dirs_cache_lock:
+                _dirs_cache[etag] = hit
+                while len(_dirs_cache) > 256:
+                    _dirs_cache.popitem(last=False)
+        return hit
+
+    return _conditional_json(request, etag, build)
+
+
+def _list_subdirs_uncached(base: Path) -> dict:
+    # 只列一层目录
+    subdirs = []
+    for child in sorted(base.iterdir()):
+        if child.is_dir():
+            # 统计该子目录下的图片数量（递归）
+            cnt = 0
+            rel = child.relative_to(GALLERY_DIR).as_posix()
+            with _span("walk.dirs", dir=rel) as sp:
+                for root, _, files in os.walk(child):
+                    _count_walked("dirs", len(files))
+                    for fn in files:
+                        if _is_image_file(Path(root) / fn):
+                            cnt += 1
+                sp["files"] = cnt
+            subdirs.append({"path": rel, "name": child.name, "count": cnt})
+
+    # 当前层里的图片数量（非必须，仅用于提示）
     this_level_files = 0
     for fn in (f for f in base.iterdir() if f.is_file() and _is_image_file(f)):
         this_level_files += 1
@@ -707,100 +4043,665 @@ def list_subdirs(path: str = ""):
     }
 
 
+# ===== 派生图缓存（/deriv/{preset}/{relpath}）=====
+# - 缓存键 = 源文件指纹（_quick_fingerprint）+ 预设参数，内容不变就命中，改了自动换键
+# - 文件落在 DERIV_DIR/ab/<key>.<ext>，内存里用 OrderedDict 记 LRU 顺序与大小，超出 DERIV_MAX_BYTES 淘汰最旧的
+# - 同一个键同一时间只生成一次：后到的请求等待先到的结果
+def _parse_presets(raw: str) -> dict:
+    out = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        name, spec = item.split("=", 1)
+        parts = (spec.split(":") + ["", ""])[:3]
+        try:
+            edge = int(parts[0])
+        except ValueError:
+            continue
+        fmt = (parts[1] or "jpeg").lower()
+        fmt = "webp" if fmt == "webp" else "jpeg"
+        try:
+            quality = int(parts[2] or 85)
+        except ValueError:
+            quality = 85
+        out[name.strip()] = {"edge": edge, "format": fmt, "quality": quality}
+    return out
+
+
+DERIV_PRESETS = _parse_presets(DERIV_PRESETS_RAW)
+_DERIV_SKIP_SUFFIXES = {".gif"}     # 动图重新编码会丢帧，直接发原图
+
+_deriv_lru: "OrderedDict[str, int]" = OrderedDict()   # 缓存文件路径 -> 字节数
+_deriv_bytes = [0]
+_deriv_lock = Lock()
+_deriv_inflight: dict = {}                            # key -> Event
+_deriv_loaded = [0.0]                                 # 上次扫盘时间
+DERIV_RESCAN = 60.0   # 多 worker 共用缓存目录：定期按磁盘重建本进程的 LRU 视图（命中时 touch mtime，扫盘顺序即全局 LRU）
+_fp_memo: "OrderedDict[tuple, str]" = OrderedDict()   # (relpath, size, mtime_ns) -> 指纹
+
+
+def _deriv_enabled(preset: Optional[str]) -> bool:
+    return bool(preset) and Image is not None and preset in DERIV_PRESETS
+
+
+def deriv_url(rel: str, preset: str) -> str:
+    return f"{DERIV_PREFIX}/{urllib.parse.quote(preset)}/" + "/".join(urllib.parse.quote(seg) for seg in rel.split("/"))
+
+
+def _deriv_load_index():
+    """第一次用到及之后每 DERIV_RESCAN 秒，扫一遍缓存目录恢复 LRU（按 mtime 从旧到新）"""
+    if time.time() - _deriv_loaded[0] < DERIV_RESCAN:
+        return
+    _deriv_lru.clear()
+    _deriv_bytes[0] = 0
+    DERIV_DIR.mkdir(parents=True, exist_ok=True)
+    entries = []
+    for p in DERIV_DIR.glob("*/*"):
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, str(p), st.st_size))
+    for _, path, size in sorted(entries):
+        _deriv_lru[path] = size
+        _deriv_bytes[0] += size
+    _deriv_loaded[0] = time.time()
+
+
+def _deriv_evict_locked():
+    while _deriv_bytes[0] > DERIV_MAX_BYTES and len(_deriv_lru) > 1:
+        path, size = _deriv_lru.popitem(last=False)
+        _deriv_bytes[0] -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _render_derivative(src: Path, dst: Path, spec: dict):
+    tmp = dst.with_suffix(dst.suffix + f".{os.getpid()}.tmp")
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((spec["edge"], spec["edge"]))
+        if spec["format"] == "jpeg":
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            im.save(tmp, "JPEG", quality=spec["quality"], optimize=True, progressive=True)
+        else:
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+            im.save(tmp, "WEBP", quality=spec["quality"], method=4)
+    os.replace(tmp, dst)
+
+
+def get_derivative(rel: str, preset: str) -> Optional[Path]:
+    """返回派生图路径；不支持/生成失败返回 None（调用方退回原图）"""
+    spec = DERIV_PRESETS.get(preset)
+    if Image is None or spec is None:
+        return None
+    src = (GALLERY_DIR / rel).resolve()
+    if src.suffix.lower() in _DERIV_SKIP_SUFFIXES:
+        return None
+    try:
+        src.relative_to(GALLERY_DIR)
+        st = src.stat()
+    except Exception:
+        return None
+
+    memo_key = (rel, st.st_size, st.st_mtime_ns)
+    with _deriv_lock:
+        fp = _fp_memo.get(memo_key)
+    if fp is None:
+        fp = _quick_fingerprint(src, st)
+        with _deriv_lock:
+            _fp_memo[memo_key] = fp
+            while len(_fp_memo) > 50000:
+                _fp_memo.popitem(last=False)
+
+    key = hashlib.sha1(f"{fp}|{spec['edge']}|{spec['format']}|{spec['quality']}".encode()).hexdigest()
+    ext = ".jpg" if spec["format"] == "jpeg" else ".webp"
+    dst = DERIV_DIR / key[:2] / (key + ext)
+
+    while True:
+        with _deriv_lock:
+            _deriv_load_index()
+            try:
+                os.utime(dst)
+                if str(dst) not in _deriv_lru:   # 别的 worker 生成的
+                    _deriv_lru[str(dst)] = dst.stat().st_size
+                    _deriv_bytes[0] += _deriv_lru[str(dst)]
+                _deriv_lru.move_to_end(str(dst))
+                _cache_event("deriv", True)
+                return dst
+            except FileNotFoundError:
+                _deriv_bytes[0] -= _deriv_lru.pop(str(dst), 0)
+            ev = _deriv_inflight.get(key)
+            if ev is None:
+                ev = _deriv_inflight[key] = Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            ev.wait(60)
+            with _deriv_lock:
+                if str(dst) in _deriv_lru:
+                    continue
+            return None
+        break
+
+    _cache_event("deriv", False)
+    try:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        _render_derivative(src, dst, spec)
+        size = dst.stat().st_size
+        with _deriv_lock:
+            _deriv_lru[str(dst)] = size
+            _deriv_bytes[0] += size
+            _deriv_evict_locked()
+        return dst
+    except Exception:
+        return None
+    finally:
+        with _deriv_lock:
+            _deriv_inflight.pop(key, None)
+        ev.set()
+
+
+@app.get(DERIV_PREFIX + "/{preset}/{relpath:path}")
+def derivative(request: Request, preset: str, relpath: str):
+    rel = relpath.strip("/")
+    _safe_join_under_gallery(rel)
+    path = get_derivative(rel, preset)
+    if path is None:
+        # 预设不存在 / 动图 / 没装 Pillow：退回原图
+        return RedirectResponse(url=to_url(rel), status_code=302)
+    # 文件名就是内容键 → 天然的强 ETag
+    headers = {"ETag": f'"{path.stem}"', "Cache-Control": f"public, max-age={STATIC_MAX_AGE}"}
+    if _if_none_match(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    media = "image/jpeg" if path.suffix == ".jpg" else "image/webp"
+    return FileResponse(path, media_type=media, headers=headers)
+
+
+@app.get("/admin/deriv_cache")
+def deriv_cache_stats():
+    with _deriv_lock:
+        _deriv_load_index()
+        return {"enabled": Image is not None, "presets": DERIV_PRESETS, "files": len(_deriv_lru),
+                "bytes": _deriv_bytes[0], "max_bytes": DERIV_MAX_BYTES, "inflight": len(_deriv_inflight)}
+
+
+# ===== 不重复抽图：每个 (scope, 分类/检索) 一个随机排列游标 =====
+# 排列是以 seed 为密钥的 Feistel 置换（4 轮，定义在 ≥ n 的 2 的偶数次幂上，落到 n 外就接着置换，即 cycle walking），
+# 只存 [本轮大小, seed, offset, touched]；第 i 张 = perm(i)，取下一张 O(1)，不需要拒绝采样，相邻两张之间也没有固定步长。
+# 候选列表按 images.rowid 排序：新入库的图 rowid 最大、排在末尾，移动/改名保留 rowid，所以加图不会打乱已有下标。
+# 一轮内只走开轮时的那 n 个位置：中途新加的图等下一轮；列表变短时越界的位置直接跳过（删图会让其后的下标前移一位，
+# 本轮可能因此错过或重复个别张，不影响其余位置）。一轮走完按当前大小换一个 seed 重新洗牌。
+# 带 bias（min / weighted）时每次在排列接下来的 CURSOR_BIAS_WINDOW 张里按评分次数挑一张，提前取走的位置记在 skip 里，
+# 一轮照样每张恰好一次，只是少评的往前排；skip 攒到窗口的 4 倍就强制取 off 那张，免得评分多的一直被往后推。
+# 游标存在 state_db() 的 cursors 表里（BEGIN IMMEDIATE 读改写），多个 worker 轮流接同一个会话也不会重复；
+# 与主库分开，写锁只在抽图之间竞争，不会被 sync/reindex 的长事务卡住。
+_cursor_swept = [0.0]
+
+
+_M64 = (1 << 64) - 1
+
+
+def _feistel(x: int, seed: int, half: int) -> int:
+    """[0, 2^(2*half)) 上的置换：左右各 half 位，轮函数是 splitmix64 的整数混合（密钥 = seed + 轮次）"""
+    mask = (1 << half) - 1
+    left, right = x >> half, x & mask
+    for rnd in range(4):
+        z = (right * 0x9E3779B97F4A7C15 + seed + rnd) & _M64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _M64
+        left, right = right, left ^ ((z ^ (z >> 31)) & mask)
+    return (left << half) | right
+
+
+def _perm_at(i: int, n: int, seed: int) -> int:
+    """seed 决定的 [0, n) 随机排列的第 i 项（0 <= i < n）；置换域不超过 4n，平均置换不到 4 次"""
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    x = i
+    while True:
+        x = _feistel(x, seed, half)
+        if x < n:
+            return x
+
+
+def _cursor_next(key: tuple, n: int, k: int = 1, counts: Optional[Callable[[List[int]], List[int]]] = None,
+                 bias: str = "off", alpha: float = 1.0) -> List[int]:
+    """
+    从 key 对应的游标里取接下来 k 个下标（0 <= idx < n，本次结果内互不重复）。
+    调用方必须保证同一个 key 的候选列表顺序稳定，且新候选只追加在末尾（按 rowid 排序）。
+    counts：下标列表 → 评分次数列表；给了且 bias 是 min / weighted 时在窗口里按 bias 挑。
+    """
+    k = max(0, min(int(k), n))
+    now = time.time()
+    out: List[int] = []
+    ck = json.dumps(list(key), ensure_ascii=False)
+    with state_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if now - _cursor_swept[0] > 60:
+            _cursor_swept[0] = now
+            conn.execute("DELETE FROM cursors WHERE touched < ?", (now - CURSOR_TTL,))
+            conn.execute("""DELETE FROM cursors WHERE key IN (
+                SELECT key FROM cursors ORDER BY touched DESC LIMIT -1 OFFSET ?)""", (CURSOR_MAX,))
+
+        row = conn.execute("SELECT n, seed, off, skip FROM cursors WHERE key=?", (ck,)).fetchone()
+        if row is None:
+            rn, seed, off, skip = n, random.getrandbits(63), 0, set()
+        else:
+            rn, seed, off = row["n"], row["seed"], row["off"]
+            skip = set(map(int, row["skip"].split(","))) if row["skip"] else set()
+        window = max(1, CURSOR_BIAS_WINDOW) if counts is not None and bias in ("min", "weighted") else 1
+
+        renewed = False
+        while len(out) < k:
+            while off in skip:
+                skip.discard(off)
+                off += 1
+            if off >= rn:
+                if renewed:              # 新一轮也走完了（列表缩得比 k 还小）
+                    break
+                rn, seed, off, skip, renewed = n, random.getrandbits(63), 0, set(), True
+                continue
+            cands: List[Tuple[int, int]] = []      # (排列位置, 下标)
+            pos = off
+            while pos < rn and len(cands) < (1 if len(skip) >= 4 * window else window):
+                if pos not in skip:
+                    idx = _perm_at(pos, rn, seed)
+                    if idx < n and idx not in out:
+                        cands.append((pos, idx))
+                    else:                # 越界＝列表变短了；撞上 out 只会发生在跨轮时
+                        skip.add(pos)
+                pos += 1
+            if not cands:
+                continue
+            j = 0 if len(cands) == 1 else _sample_indices(counts([i for _, i in cands]), 1, bias, alpha)[0]
+            skip.add(cands[j][0])
+            out.append(cands[j][1])
+        while off in skip:
+            skip.discard(off)
+            off += 1
+
+        conn.execute("INSERT OR REPLACE INTO cursors(key, n, seed, off, touched, skip) VALUES (?,?,?,?,?,?)",
+                     (ck, rn, seed, off, now, ",".join(map(str, sorted(skip))) or None))
+        conn.commit()
+    return out
+
+
+def _sample_indices(cnts: List[int], k: int, bias: str, alpha: float) -> List[int]:
+    """
+    按 bias 规则一次抽 k 个**不重复**下标（k=1 时与原先单张逻辑等价）：
+    - min：按评分次数从低到高逐层取，同一层内随机
+    - weighted：权重 1/(cnt+1)^alpha 的无放回加权抽样（A-ES：key = u^(1/w)，取最大的 k 个）
+    - 其他：纯随机
+    """
+    n = len(cnts)
+    k = max(0, min(int(k), n))
+    if k == 0:
+        return []
+    if bias == "min":
+        layers = {}
+        for i, c in enumerate(cnts):
+            layers.setdefault(c, []).append(i)
+        out: List[int] = []
+        for c in sorted(layers):
+            need = k - len(out)
+            layer = layers[c]
+            out.extend(random.sample(layer, min(need, len(layer))))
+            if len(out) >= k:
+                break
+        return out
+    if bias == "weighted":
+        keyed = ((random.random() ** ((c + 1.0) ** alpha), i) for i, c in enumerate(cnts))
+        return [i for _, i in heapq.nlargest(k, keyed)]
+    return random.sample(range(n), k)
+
+
+def _effective_bias(bias: Optional[str], alpha: Optional[float]) -> Tuple[str, float]:
+    eff_bias = (bias or PICK_BIAS or "off").lower()
+    eff_alpha = float(alpha if (alpha is not None) else PICK_BIAS_ALPHA)
+    return eff_bias, max(eff_alpha, 0.0001)
+
+
+def _pic_payload(rel: str, iid: str, category: Optional[str], filename: Optional[str] = None,
+                 preset: Optional[str] = None) -> dict:
+    payload = {
+        "id": iid,
+        "relpath": rel,
+        "filename": filename or rel.split("/")[-1],
+        "category": category,
+        "url": to_url(rel),
+    }
+    preset = DERIV_DEFAULT_PRESET if preset is None else preset
+    if _deriv_enabled(preset) and Path(rel).suffix.lower() not in _DERIV_SKIP_SUFFIXES:
+        # 派生图在第一次被拉取时才生成；原图地址留在 orig_url
+        payload["orig_url"] = payload["url"]
+        payload["url"] = deriv_url(rel, preset)
+    return payload
+
+
+def _query_rows(q: str, limit: int = 200) -> list:
+    """q 检索：LIKE 命中后取少评优先的前 200 条（避免 ORDER BY RANDOM() 全表扫）"""
+    terms = _split_terms(q)
+    with db() as conn:
+        where_sql, args = _build_like_where_and_args(terms, conn)
+        cur = conn.execute(
+            f"""
+            SELECT i.relpath, i.id, i.category, i.filename, i.cnt, i.avg
+            FROM images i
+            WHERE {where_sql}
+            ORDER BY i.cnt ASC, i.avg DESC
+            LIMIT ?
+            """,
+            (*args, int(limit))
+        )
+        return cur.fetchall()
+
+
+def _snap_pool(snap: GallerySnapshot, cat: Optional[str]) -> Tuple[int, int, Optional[str]]:
+    """同 _files_for_cat，但返回快照里的区间；快照里没有就给空区间（调用方退回扫盘，由它报 404）"""
+    if not cat:
+        return 0, snap.n, None
+    weighted = parse_weighted_cats(cat)
+    chosen = choice_by_weight(weighted)
+    lo, hi = snap.prefix_range(chosen)
+    if lo < hi:
+        return lo, hi, chosen
+    for name, _ in weighted:
+        lo, hi = snap.prefix_range(name)
+        if lo < hi:
+            return lo, hi, name
+    return 0, 0, None
+
+
+def _cursor_key(scope: str, kind: str, arg: Optional[str]) -> tuple:
+    return (scope, kind, (arg or "").strip().lower())
+
+
+_scope_pools: "OrderedDict[tuple, Tuple[int, array]]" = OrderedDict()
+_scope_pools_lock = threading.Lock()
+
+
+def _scope_pool(kind: str, arg: Optional[str]) -> array:
+    """
+    带 scope 的 q / 分类抽图的候选集合：命中行的 rowid 升序数组（见上面游标的说明）。
+    以 meta.tag_gen 为键缓存在进程里（入库/移动/清理/改标签都会 bump），评分不会让它失效；
+    同一个检索词连续抽图只在第一次跑 LIKE / 前缀查询，之后每张 O(1)。
+    """
+    arg = (arg or "").strip()
+    key = (kind, arg)
+    with db() as conn:
+        gen = _meta_int(conn, "tag_gen")
+        with _scope_pools_lock:
+            hit = _scope_pools.get(key)
+            if hit is not None and hit[0] == gen:
+                _scope_pools.move_to_end(key)
+                return hit[1]
+        if kind == "q":
+            where_sql, args = _build_like_where_and_args(_split_terms(arg), conn)
+        elif arg.strip("/"):
+            p = arg.strip("/") + "/"
+            where_sql, args = "i.relpath >= ? AND i.relpath < ?", [p, p + "\U0010ffff"]
+        else:
+            where_sql, args = "1=1", []
+        rowids = array("q", (r[0] for r in conn.execute(
+            f"SELECT i.rowid FROM images i WHERE {where_sql} ORDER BY i.rowid", args)))
+    with _scope_pools_lock:
+        _scope_pools[key] = (gen, rowids)
+        _scope_pools.move_to_end(key)
+        while len(_scope_pools) > SCOPE_POOL_CACHE:
+            _scope_pools.popitem(last=False)
+    return rowids
+
+
+def _scope_take(scope: str, kind: str, arg: Optional[str], want: int, bias: str, alpha: float,
+                exclude=frozenset()) -> list:
+    """
+    在 _scope_pool 上按该会话的游标取 want 行（relpath, id, category, filename），不足时按实际数量返回。
+    库里有、盘上已经没有的（删了还没 reindex）以及 exclude 里的 relpath 跳过，再往后补几次。
+    """
+    pool = _scope_pool(kind, arg)
+
+    def counts(idx: List[int]) -> List[int]:
+        with db() as conn:
+            cnt = dict(conn.execute(
+                f"SELECT rowid, cnt FROM images WHERE rowid IN ({','.join('?' * len(idx))})", [pool[i] for i in idx]))
+        return [cnt.get(pool[i]) or 0 for i in idx]
+
+    out: list = []
+    taken = set(exclude)
+    for _ in range(3):
+        need = want - len(out)
+        if need <= 0 or not pool:
+            break
+        idx = _cursor_next(_cursor_key(scope, kind, arg), len(pool), need, counts, bias, alpha)
+        if not idx:
+            break
+        ids = [pool[i] for i in idx]
+        with db() as conn:
+            rows = {r["rowid"]: r for r in conn.execute(
+                f"SELECT rowid, relpath, id, category, filename FROM images WHERE rowid IN ({','.join('?' * len(ids))})",
+                ids)}
+        for rid in ids:
+            r = rows.get(rid)
+            if r is None or r["relpath"] in taken:
+                continue
+            taken.add(r["relpath"])
+            if (GALLERY_DIR / r["relpath"]).is_file():
+                out.append(r)
+    return out
+
+
+def _scope_cats(cat: Optional[str]) -> List[Optional[str]]:
+    """分类/权重 → 先按权重抽中的分类，再按表达式顺序排其余的（前面的没有图时依次顶上）；cat 为空 = [全库]"""
+    if not cat:
+        return [None]
+    weighted = parse_weighted_cats(cat)
+    chosen = choice_by_weight(weighted)
+    return [chosen] + [name for name, _ in weighted if name != chosen]
+
+
+def _files_for_cat(cat: Optional[str]) -> Tuple[List[Path], Optional[str]]:
+    """分类/权重 → (文件列表, 实际命中的分类)；cat 为空则全库"""
+    if not cat:
+        return list_all_files(GALLERY_DIR), None
+    weighted = parse_weighted_cats(cat)
+    chosen = choice_by_weight(weighted)
+    files = collect_in_category(chosen)
+    if not files:
+        for name, _ in weighted:
+            cand = collect_in_category(name)
+            if cand:
+                return cand, name
+        raise HTTPException(404, "No images under given categories.")
+    return files, chosen
+
+
 @app.get("/random_pic")
 def random_pic(
     cat: Optional[str] = Query(default=None, description="分类过滤，支持权重：风景 或 风景,人像 或 风景:3,人像:1；支持多级：壁纸/风景"),
     q:   Optional[str] = Query(default=None, description="全文搜索关键字（路径/文件名/标签）"),
+    tag: Optional[str] = Query(default=None, description="标签表达式，支持权重：风景 -夜景 或 猫|狗 或 猫:3,狗:1"),
     redirect: bool = False,
     bias: Optional[str] = None,
     alpha: Optional[float] = None,
+    scope: Optional[str] = Query(default=None, description="会话/范围标识；带上则按不重复游标出图（bias 在游标接下来的一小段里生效）"),
+    preset: Optional[str] = Query(default=None, description="派生图预设（如 chat/thumb）；url 指向压缩版，orig_url 为原图"),
 ):
-    import random
+    # ⓪ 带 tag：内存标签位图求值，在命中集合里按 bias 抽（带 scope 按游标取）
+    if tag and tag.strip():
+        rel, iid, category = _tag_pick(tag, 1, scope, bias, alpha)[0]
+        payload = _pic_payload(rel, iid, category, preset=preset)
+        if redirect:
+            return RedirectResponse(url=payload["url"], status_code=302)
+        return JSONResponse(payload)
 
-    # ① 带 q：用 LIKE 做检索 → 从前200里随机挑一张（避免 ORDER BY RANDOM() 全表扫）
+    # ① 带 q：用 LIKE 做检索 → 从前200里随机挑一张（带 scope：全部命中里按游标取下一张）
     if q and q.strip():
-        terms = _split_terms(q)
-        where_sql, args = _build_like_where_and_args(terms)
-        with db() as conn:
-            cur = conn.execute(
-                f"""
-                SELECT i.relpath, i.id, i.category, i.filename, i.cnt, i.avg
-                FROM images i
-                WHERE {where_sql}
-                ORDER BY i.cnt ASC, i.avg DESC
-                LIMIT 200
-                """,
-                args
-            )
-            items = cur.fetchall()
+        items = _scope_take(scope, "q", q, 1, *_effective_bias(bias, alpha)) if scope else _query_rows(q)
         if not items:
             raise HTTPException(status_code=404, detail="No images matched the query.")
-        row = random.choice(items)
-        relpath, iid, category, filename, cnt, avg = row
-        url = to_url(relpath)
-        payload = {
-            "id": iid,
-            "relpath": relpath,
-            "filename": filename or relpath.split("/")[-1],
-            "category": category,
-            "url": url,
-        }
+        row = items[0] if scope else random.choice(items)
+        payload = _pic_payload(row["relpath"], row["id"], row["category"], row["filename"], preset)
         if redirect:
-            return RedirectResponse(url=url, status_code=302)
+            return RedirectResponse(url=payload["url"], status_code=302)
         return JSONResponse(payload)
 
-    # ② 没有 q：保持你原来的“分类/权重 + 少评优先/加权/纯随机”的本地文件逻辑
-    if cat:
-        weighted = parse_weighted_cats(cat)
-        chosen = choice_by_weight(weighted)
-        files = collect_in_category(chosen)
+    # ② 没有 q：带 scope 在该分类的 rowid 候选上按游标取；否则有索引快照就直接在快照区间上抽
+    rel = iid = None
+    if scope:
+        for name in _scope_cats(cat):
+            rows = _scope_take(scope, "cat", name, 1, *_effective_bias(bias, alpha))
+            if rows:
+                rel, iid, category = rows[0]["relpath"], rows[0]["id"], name
+                break
+    snap = _snapshot() if rel is None else None
+    if snap is not None:
+        lo, hi, category = _snap_pool(snap, cat)
+        if lo < hi:
+            j = _snap_sample(snap, lo, hi, 1, *_effective_bias(bias, alpha))[0]
+            rel, iid = snap.relpath(j), snap.id_of(j)
+            if not (GALLERY_DIR / rel).is_file():   # 快照落后于磁盘：这次扫盘兜底，顺便安排重建
+                _snapshot_mark_dirty()
+                rel = iid = None
+            _cache_event("index_snapshot", rel is not None)
+
+    # 没有快照（或还没入库）：保持你原来的“分类/权重 + 少评优先/加权/纯随机”的本地文件逻辑
+    if rel is None:
+        files, category = _files_for_cat(cat)
         if not files:
-            for name, _ in weighted:
-                cand = collect_in_category(name)
-                if cand:
-                    files, chosen = cand, name
-                    break
-            else:
-                raise HTTPException(404, "No images under given categories.")
-        category = chosen
-    else:
-        files = list_all_files(GALLERY_DIR)
-        category = None
+            raise HTTPException(404, "No images in gallery.")
 
-    if not files:
-        raise HTTPException(404, "No images in gallery.")
+        rels_all = [p.relative_to(GALLERY_DIR).as_posix() for p in files]
+        cnts = get_counts_for_rels(rels_all)
+        eff_bias, eff_alpha = _effective_bias(bias, alpha)
+        rel = rels_all[_sample_indices(cnts, 1, eff_bias, eff_alpha)[0]]
 
-    rels_all = [p.relative_to(GALLERY_DIR).as_posix() for p in files]
-    cnts = get_counts_for_rels(rels_all)
+    if iid is None:
+        iid = ensure_image_record(rel, category)
+    payload = _pic_payload(rel, iid, category, preset=preset)
+    if redirect:
+        return RedirectResponse(url=payload["url"], status_code=302)
+    return JSONResponse(payload)
 
-    eff_bias = (bias or PICK_BIAS or "off").lower()
-    eff_alpha = float(alpha if (alpha is not None) else PICK_BIAS_ALPHA)
-    eff_alpha = max(eff_alpha, 0.0001)
-
-    if eff_bias == "min":
-        min_cnt = min(cnts)
-        candidates = [i for i, c in enumerate(cnts) if c == min_cnt]
-        idx = random.choice(candidates)
-    elif eff_bias == "weighted":
-        weights = [1.0 / ((c + 1.0) ** eff_alpha) for c in cnts]
-        idx = random.choices(range(len(files)), weights=weights, k=1)[0]
+
+@app.get("/random_pics")
+def random_pics(
+    cat: Optional[str] = Query(default=None, description="同 /random_pic：风景:3,人像:1 / 壁纸/风景"),
+    q:   Optional[str] = Query(default=None, description="同 /random_pic：全文搜索关键字"),
+    tag: Optional[str] = Query(default=None, description="同 /random_pic：标签表达式（可带权重）"),
+    n: int = Query(default=5, ge=1, le=RANDOM_PICS_MAX, description="一次抽几张（互不重复）"),
+    bias: Optional[str] = None,
+    alpha: Optional[float] = None,
+    scope: Optional[str] = Query(default=None, description="同 /random_pic：按不重复游标连续取 n 张"),
+    preset: Optional[str] = Query(default=None, description="同 /random_pic：派生图预设"),
+):
+    """
+    一次请求抽 n 张不重复的图，规则与 /random_pic 相同：
+    - q：一次查询取前 200 条，无放回随机取 n 条
+    - cat：按权重为每个名额抽分类，同一分类只扫一次盘，再按 bias 无放回抽
+    - tag：同 cat，只是每个名额抽的是标签表达式，候选集合来自内存标签位图
+    - scope：改为从该会话的不重复游标里连续取（候选来自库里按 rowid 排的集合；还没入库的分类照旧扫盘）
+    - 不足 n 张时按实际数量返回（至少 1 张，否则 404）
+    """
+    if tag and tag.strip():
+        items = [_pic_payload(rel, iid, category, preset=preset)
+                 for rel, iid, category in _tag_pick(tag, n, scope, bias, alpha)]
+        return {"count": len(items), "items": items}
+
+    if q and q.strip():
+        rows = _scope_take(scope, "q", q, n, *_effective_bias(bias, alpha)) if scope else _query_rows(q)
+        if not rows:
+            raise HTTPException(status_code=404, detail="No images matched the query.")
+        picked = rows if scope else random.sample(rows, min(n, len(rows)))
+        items = [_pic_payload(r["relpath"], r["id"], r["category"], r["filename"], preset) for r in picked]
+        return {"count": len(items), "items": items}
+
+    eff_bias, eff_alpha = _effective_bias(bias, alpha)
+
+    # 每个名额独立按权重抽分类；同一分类只扫一次盘、只查一次评分次数
+    if cat:
+        weighted = parse_weighted_cats(cat)
+        names = [name for name, _ in weighted]
+        quota: dict = {}
+        for name in random.choices(names, weights=[w for _, w in weighted], k=n):
+            quota[name] = quota.get(name, 0) + 1
     else:
-        idx = random.randrange(len(files))
+        names = [None]
+        quota = {None: n}
 
-    pic = files[idx]
-    rel = rels_all[idx]
-    iid = ensure_image_record(rel, category)
-    url = to_url(rel)
-    payload = {
-        "id": iid,
-        "relpath": rel,
-        "filename": pic.name,
-        "category": category,
-        "url": url,
-    }
-    if redirect:
-        return RedirectResponse(url=url, status_code=302)
-    return JSONResponse(payload)
+    pools: dict = {}
+    chosen: List[Tuple[str, Optional[str]]] = []   # (relpath, category)
+    seen = set()
+    snap = _snapshot()
+    snap_pools: dict = {}
+    snap_ids: dict = {}       # 快照/库里已带 id 的 relpath → id，省掉 ensure_image_records
+    snap_seen: set = set()    # 快照下标（重叠分类去重用）
+
+    def take_snap(name: Optional[str], want: int) -> bool:
+        if name not in snap_pools:
+            snap_pools[name] = snap.prefix_range(name or "")
+        lo, hi = snap_pools[name]
+        if lo >= hi:
+            return False
+        idx = _snap_sample(snap, lo, hi, want, eff_bias, eff_alpha, exclude=snap_seen)
+        for j in idx:
+            if j in snap_seen:
+                continue
+            snap_seen.add(j)
+            rel = snap.relpath(j)
+            if not (GALLERY_DIR / rel).is_file():
+                _snapshot_mark_dirty()
+                _cache_event("index_snapshot", False)
+                continue
+            _cache_event("index_snapshot", True)
+            seen.add(rel)
+            chosen.append((rel, name))
+            if snap.id_of(j):
+                snap_ids[rel] = snap.id_of(j)
+        return True
+
+    def take(name: Optional[str], want: int):
+        if scope:
+            # 游标本身保证一轮内不重复；与别的分类重叠（如 壁纸 与 壁纸/风景）的直接跳过
+            rows = _scope_take(scope, "cat", name, want, eff_bias, eff_alpha, exclude=seen)
+            for r in rows:
+                seen.add(r["relpath"])
+                chosen.append((r["relpath"], name))
+                snap_ids[r["relpath"]] = r["id"]
+            if rows:
+                return
+        if snap is not None and take_snap(name, want):
+            return
+        if name not in pools:
+            files = collect_in_category(name) if name is not None else list_all_files(GALLERY_DIR)
+            rels = [p.relative_to(GALLERY_DIR).as_posix() for p in files]
+            pools[name] = (rels, get_counts_for_rels(rels))
+        rels, cnts = pools[name]
+        keep = [i for i, r in enumerate(rels) if r not in seen]
+        picks = [rels[keep[j]] for j in _sample_indices([cnts[i] for i in keep], want, eff_bias, eff_alpha)]
+        for rel in picks:
+            if rel not in seen:
+                seen.add(rel)
+                chosen.append((rel, name))
+
+    for name, want in quota.items():
+        take(name, want)
+    # 某个分类不够分时，按表达式顺序从其它分类补位
+    for name in names:
+        if len(chosen) >= n:
+            break
+        take(name, n - len(chosen))
+
+    if not chosen:
+        raise HTTPException(404, "No images under given categories." if cat else "No images in gallery.")
+
+    ids = {**snap_ids, **ensure_image_records([c for c in chosen if c[0] not in snap_ids])}
+    items = [_pic_payload(rel, ids[rel], category, preset=preset) for rel, category in chosen]
+    return {"count": len(items), "items": items}
 
 
 
@@ -812,22 +4713,25 @@ class RateIn(BaseModel):
 
 @app.post("/rate")
 def rate_image(body: RateIn):
+    if IS_REPLICA:
+        return _forward_to_primary("POST", "/rate", {"id": body.id, "score": body.score, "note": body.note})
     ident = body.id
 
     with db() as conn:
-        # ① 先按 id 精确查（适配 TEXT/CHAR/VARCHAR 等）
-        row = conn.execute(
-            "SELECT id, relpath, cnt, avg FROM images WHERE id = ?",
-            (ident,)
-        ).fetchone()
-
-        # ② 找不到就把 ident 当成 relpath 再查一遍
-        if not row:
+        with _span("rate.lookup"):
+            # ① 先按 id 精确查（适配 TEXT/CHAR/VARCHAR 等）
             row = conn.execute(
-                "SELECT id, relpath, cnt, avg FROM images WHERE relpath = ?",
+                "SELECT id, relpath, category, cnt, avg, m2, fp_ts FROM images WHERE id = ?",
                 (ident,)
             ).fetchone()
 
+            # ② 找不到就把 ident 当成 relpath 再查一遍
+            if not row:
+                row = conn.execute(
+                    "SELECT id, relpath, category, cnt, avg, m2, fp_ts FROM images WHERE relpath = ?",
+                    (ident,)
+                ).fetchone()
+
         if not row:
             raise HTTPException(status_code=404, detail="image id not found")
 
@@ -835,31 +4739,52 @@ def rate_image(body: RateIn):
         rel    = row["relpath"]
         old_cnt = int(row["cnt"] or 0)
         old_avg = float(row["avg"] or 0.0)
+        old_m2 = float(row["m2"] or 0.0)
 
-        # ③ 计算新均分/次数
+        # ③ 计算新均分/次数（Welford：顺带增量维护方差）
+        x = float(body.score)
         new_cnt = old_cnt + 1
-        new_avg = (old_avg * old_cnt + float(body.score)) / new_cnt
+        delta = x - old_avg
+        new_avg = old_avg + delta / new_cnt
+        new_m2 = old_m2 + delta * (x - new_avg)
 #-----------
-        # ③.5 记录评分历史
-        conn.execute(
-            "INSERT INTO ratings(image_id, score, note, ts) VALUES (?,?,?,?)",
-            (db_id or file_id_for(rel), float(body.score), body.note, int(time.time()))
-        )
-        #--------
-        # ④ 用 relpath 做 WHERE（不依赖 id 的类型/是否稳定）
-        conn.execute(
-            "UPDATE images SET cnt = ?, avg = ? WHERE relpath = ?",
-            (new_cnt, new_avg, rel)
-        )
-        conn.commit()
+        # ③.5 记录评分历史 + 直方图/时间汇总
+        now = int(time.time())
+        with _span("rate.insert"):
+            conn.execute(
+                "INSERT INTO ratings(image_id, score, note, ts) VALUES (?,?,?,?)",
+                (db_id or file_id_for(rel), x, body.note, now)
+            )
+            _record_rating_aggregates(conn, db_id or file_id_for(rel), row["category"] or _top_category_of(rel), x, now)
+            #--------
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'ratings_n'")
+            conn.execute("UPDATE meta SET value = value + ? WHERE key = 'ratings_sum'", (float(body.score),))
+            new_bayes = _bayes(new_avg, new_cnt, _bayes_prior(conn))
+            # ④ 用 relpath 做 WHERE（不依赖 id 的类型/是否稳定）
+            conn.execute(
+                "UPDATE images SET cnt = ?, sum = sum + ?, avg = ?, m2 = ?, bayes = ? WHERE relpath = ?",
+                (new_cnt, x, new_avg, new_m2, new_bayes, rel)
+            )
+            _bump_gen(conn)
+        with _span("rate.commit"):
+            conn.commit()
+    _snapshot_set_count(rel, new_cnt)
+    _tag_index_set_count(rel, new_cnt)
 
     # ⑤ 达阈值写回 XMP（你之前已实现“覆写整数分”的 write_metadata）
     wrote = False
     try:
         if new_cnt >= WRITE_META_MIN_COUNT:
             abs_path = (GALLERY_DIR / rel).resolve()
-            write_metadata(abs_path, new_avg, new_cnt)
+            # 写之前文件和库里的指纹对得上（没有还没处理的外部修改）时，才把这次写入记成“自己写的”
+            in_sync = row["fp_ts"] is not None and abs_path.stat().st_mtime_ns == row["fp_ts"]
+            with _span("rate.write_meta"):
+                write_metadata(abs_path, new_avg, new_cnt)
             wrote = True
+            # 写回 XMP 会改动文件内容 → 指纹跟着刷新，否则之后移动这张图就认不出来了
+            with db() as conn, _span("rate.fingerprint"):
+                _refresh_fp(conn, rel)
+                conn.execute("UPDATE images SET self_ts = CASE WHEN ? THEN fp_ts END WHERE relpath=?", (in_sync, rel))
     except Exception:
         pass
 
@@ -869,19 +4794,116 @@ def rate_image(body: RateIn):
 
 
 @app.get("/stats")
-def stats(id: Optional[str] = None, top: int = 50):
+def stats(
+    request: Request,
+    id: Optional[str] = None,
+    top: int = Query(default=50, ge=1, le=500),
+    rank: str = Query(default="avg", description="avg：按均分；bayes：按贝叶斯均分（少票数向全站均分收缩）"),
+):
+    # 统计结果只会因写操作变化 → 代数没变就 304
+    etag = _etag_for("stats", _db_gen(), id, top, rank)
+    return _conditional_json(request, etag, lambda: _stats_uncached(id, top, rank))
+
+
+def _stats_uncached(id: Optional[str], top: int, rank: str) -> dict:
     with db() as conn:
         if id:
             cur = conn.execute("SELECT * FROM images WHERE id=?", (id,))
             row = cur.fetchone()
             if not row:
                 raise HTTPException(404, "image id not found")
-            cur2 = conn.execute("SELECT score, ts, note FROM ratings WHERE image_id=? ORDER BY rid DESC LIMIT 100", (id,))
+            cur2 = conn.execute("SELECT rid, score, ts, note FROM ratings WHERE image_id=? ORDER BY rid DESC LIMIT 100", (id,))
             ratings = [dict(r) for r in cur2.fetchall()]
             return {"image": dict(row), "ratings": ratings}
         else:
-            cur = conn.execute("SELECT * FROM images ORDER BY avg DESC, cnt DESC LIMIT ?", (int(top),))
-            return {"top": [dict(r) for r in cur.fetchall()]}
+            # ORDER BY 与索引列完全一致 → 走 idx_images_rank_* 顺序扫描，不排序全表
+            if rank == "bayes":
+                cur = conn.execute("SELECT * FROM images WHERE cnt > 0 ORDER BY bayes DESC, cnt DESC LIMIT ?", (int(top),))
+            else:
+                cur = conn.execute("SELECT * FROM images ORDER BY avg DESC, cnt DESC LIMIT ?", (int(top),))
+            return {"rank": "bayes" if rank == "bayes" else "avg",
+                    "prior": round(_bayes_prior(conn), 3),
+                    "top": [dict(r) for r in cur.fetchall()]}
+
+
+@app.get("/stats/history")
+def stats_history(
+    id: str = Query(..., description="images.id"),
+    before: Optional[int] = Query(default=None, description="游标：上一页返回的 next_before（rid）"),
+    limit: int = Query(default=50, ge=1, le=500),
+):
+    """
+    单张图的评分历史，按 rid 倒序做 keyset 翻页：
+    WHERE image_id=? AND rid<? 直接命中 (image_id, rid) 索引，翻到多深都不用 OFFSET 扫描。
+    """
+    with db() as conn:
+        if before is None:
+            cur = conn.execute(
+                "SELECT rid, score, ts, note FROM ratings WHERE image_id=? ORDER BY rid DESC LIMIT ?",
+                (id, int(limit)))
+        else:
+            cur = conn.execute(
+                "SELECT rid, score, ts, note FROM ratings WHERE image_id=? AND rid<? ORDER BY rid DESC LIMIT ?",
+                (id, int(before), int(limit)))
+        items = [dict(r) for r in cur.fetchall()]
+    next_before = items[-1]["rid"] if len(items) == limit else None
+    return {"id": id, "items": items, "next_before": next_before}
+
+
+@app.get("/stats/hist")
+def stats_hist(id: str = Query(..., description="images.id 或 relpath")):
+    """单图分数分布 + 均值/方差（直接读物化的直方图和 Welford 累计值）"""
+    with db() as conn:
+        row = conn.execute("SELECT id, relpath, cnt, avg, m2 FROM images WHERE id=?", (id,)).fetchone()
+        if not row:
+            row = conn.execute("SELECT id, relpath, cnt, avg, m2 FROM images WHERE relpath=?", (id,)).fetchone()
+        if not row:
+            raise HTTPException(404, "image id not found")
+        hist = {b: n for b, n in conn.execute(
+            "SELECT bucket, n FROM rating_hist WHERE image_id=? ORDER BY bucket", (row["id"],))}
+    cnt = int(row["cnt"] or 0)
+    var = float(row["m2"] or 0.0) / cnt if cnt > 0 else 0.0
+    return {
+        "id": row["id"],
+        "relpath": row["relpath"],
+        "count": cnt,
+        "avg": round(float(row["avg"] or 0.0), SCORE_PRECISION),
+        "var": round(var, 4),
+        "std": round(math.sqrt(var), 4),
+        "hist": [{"score": b / 2, "n": hist.get(b, 0)} for b in range(11)],
+    }
+
+
+@app.get("/stats/rollup")
+def stats_rollup(
+    gran: str = Query(default="day", description="day|hour"),
+    span: int = Query(default=30, ge=1, le=24 * 90, description="往回看多少天/小时"),
+    category: str = Query(default="*", description="顶级分类；* 为全站合计"),
+):
+    """按天/小时的评分量与均分：主键 (gran, category, bucket_ts) 范围扫描，行数 = 桶数"""
+    g = "h" if gran.lower().startswith("h") else "d"
+    now = int(time.time())
+    since = _rollup_buckets(now - span * (3600 if g == "h" else 86400))[1 if g == "d" else 0][1]
+    with db() as conn:
+        cur = conn.execute("""
+            SELECT bucket_ts, n, sum FROM rating_rollup
+             WHERE gran=? AND category=? AND bucket_ts>=?
+             ORDER BY bucket_ts
+        """, (g, category, since))
+        series = [{"ts": ts, "n": n, "avg": round(sm / n, SCORE_PRECISION) if n else 0.0} for ts, n, sm in cur.fetchall()]
+    return {"gran": "hour" if g == "h" else "day", "category": category, "series": series}
+
+
+@app.post("/admin/refresh_rank")
+@_exclusive("refresh_rank")
+def admin_refresh_rank():
+    """全站均分变化较大后，用新的先验重算物化的贝叶斯均分"""
+    with db() as conn:
+        _refresh_bayes(conn)
+        _bump_gen(conn)
+        conn.commit()
+        prior = _bayes_prior(conn)
+    return {"ok": True, "prior": round(prior, 3), "m": BAYES_M}
 
 from fastapi import Query
 from typing import List, Tuple
@@ -902,35 +4924,39 @@ def _split_terms(q: str) -> List[str]:
         parts = [p for p in q.split() if p]
     return parts
 
-def _build_like_where_and_args(terms: List[str]) -> Tuple[str, List[str]]:
+def _build_like_where_and_args(terms: List[str], conn=None) -> Tuple[str, List[str]]:
     """
     WHERE ( i.relpath LIKE ? ESCAPE '\' OR i.filename LIKE ? ESCAPE '\' OR
             EXISTS (SELECT 1 FROM image_tags t WHERE t.relpath=i.relpath AND t.tag LIKE ? ESCAPE '\') )
     对每个 term 生成一组三个条件，然后 AND 串联（多词＝都要匹配）。
+    给了 conn 时，纯字母的 term 还会按拼音换成图库里的汉字串，任一写法命中都算（OR）。
     """
     where_clauses = []
     args: List[str] = []
     for raw in terms:
-        t = _like_escape(raw)
-        # 前后都加 %，即包含匹配；英文/数字同样走包含
-        pat = f"%{t}%"
-        where_clauses.append(
-            "("
-            " i.relpath LIKE ? ESCAPE '\\' "
-            " OR i.filename LIKE ? ESCAPE '\\' "
-            " OR EXISTS (SELECT 1 FROM image_tags t WHERE t.relpath = i.relpath AND t.tag LIKE ? ESCAPE '\\') "
-            ")"
-        )
-        args.extend([pat, pat, pat])
+        alts = [raw] + (_pinyin_natives(conn, raw) if conn is not None else [])
+        groups = []
+        for alt in alts:
+            # 前后都加 %，即包含匹配；英文/数字同样走包含
+            pat = f"%{_like_escape(alt)}%"
+            groups.append(
+                "("
+                " i.relpath LIKE ? ESCAPE '\\' "
+                " OR i.filename LIKE ? ESCAPE '\\' "
+                " OR EXISTS (SELECT 1 FROM image_tags t WHERE t.relpath = i.relpath AND t.tag LIKE ? ESCAPE '\\') "
+                ")"
+            )
+            args.extend([pat, pat, pat])
+        where_clauses.append(groups[0] if len(groups) == 1 else "(" + " OR ".join(groups) + ")")
     where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
     return where_sql, args
 
 @app.get("/search")
 def search(q: str = Query(..., description="模糊查询（标签/文件名/路径）"), limit: int = 10):
     terms = _split_terms(q)
-    where_sql, args = _build_like_where_and_args(terms)
 
     with db() as conn:
+        where_sql, args = _build_like_where_and_args(terms, conn)
         # 提前保证 filename 列存在
         try:
             conn.execute("ALTER TABLE images ADD COLUMN filename TEXT")
@@ -943,9 +4969,10 @@ def search(q: str = Query(..., description="模糊查询（标签/文件名/路
         except Exception:
             pass
 
-        # 用 Python 回填 filename（取 relpath 的最后一段）
-        for (rel,) in conn.execute("SELECT relpath FROM images WHERE filename IS NULL OR filename=''"):
-            conn.execute("UPDATE images SET filename=? WHERE relpath=?", (Path(rel).name, rel))
+        # 用 Python 回填 filename（取 relpath 的最后一段）；只读副本跳过，随 primary 的快照同步
+        if not IS_REPLICA:
+            for (rel,) in conn.execute("SELECT relpath FROM images WHERE filename IS NULL OR filename=''"):
+                conn.execute("UPDATE images SET filename=? WHERE relpath=?", (Path(rel).name, rel))
 
         sql = f"""
             SELECT i.relpath, i.cnt, i.avg
@@ -0,0 +1 @@
+"""picapi 基准测试：合成图库生成（gengallery）、压测（run）与结果对比（compare）"""
@@ -0,0 +1,70 @@
+"""
+对比两次 bench.run 的结果：
+
+    python -m bench.compare base.json new.json [--threshold 0.15] [--min-ms 0.5]
+
+按 (规模, 接口) 对齐，打印 p50/p95/p99 与吞吐的变化；任一项 p95 比基线慢 threshold 以上
+（且绝对差超过 min-ms，避免亚毫秒级的噪声）即视为退步，退出码为 1，可直接放进 CI。
+新结果里有跑失败的规模（接口报错等）同样退出码为 1。
+"""
+import argparse
+import json
+import sys
+
+
+def _index(report: dict) -> dict:
+    out = {}
+    for run in report.get("runs", []):
+        for name, r in (run.get("results") or {}).items():
+            if "p95_ms" in r:
+                out[(run["size"], name)] = r
+    return out
+
+
+def _pct(new: float, old: float) -> str:
+    if not old:
+        return "   n/a"
+    return f"{(new - old) / old * 100:+6.1f}%"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="compare two picapi benchmark reports")
+    ap.add_argument("base")
+    ap.add_argument("new")
+    ap.add_argument("--threshold", type=float, default=0.15, help="p95 允许变慢的比例")
+    ap.add_argument("--min-ms", type=float, default=0.5, help="绝对差小于这个毫秒数的不算退步")
+    args = ap.parse_args()
+
+    with open(args.base, encoding="utf-8") as f:
+        base = _index(json.load(f))
+    with open(args.new, encoding="utf-8") as f:
+        new_report = json.load(f)
+    new = _index(new_report)
+    failed = [run for run in new_report.get("runs", []) if "error" in run]
+
+    regressions = []
+    print(f"{'size':>8}  {'bench':<26} {'p50':>9} {'p95':>9} {'p99':>9} {'rps':>9}   p95 ms (base → new)")
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        bad = (n["p95_ms"] - b["p95_ms"] > args.min_ms) and (n["p95_ms"] > b["p95_ms"] * (1 + args.threshold))
+        if bad:
+            regressions.append(key)
+        print(f"{key[0]:>8}  {key[1]:<26} {_pct(n['p50_ms'], b['p50_ms']):>9} {_pct(n['p95_ms'], b['p95_ms']):>9} "
+              f"{_pct(n['p99_ms'], b['p99_ms']):>9} {_pct(n.get('throughput_rps') or 0, b.get('throughput_rps') or 0):>9}"
+              f"   {b['p95_ms']:.2f} → {n['p95_ms']:.2f}{'  ← REGRESSION' if bad else ''}")
+    for key in sorted(set(base) ^ set(new)):
+        print(f"{key[0]:>8}  {key[1]:<26} only in {'base' if key in base else 'new'}")
+
+    for run in failed:
+        print(f"{run['size']:>8}  FAILED: {' '.join(run['error'])}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%} at p95", file=sys.stderr)
+    if failed:
+        print(f"{len(failed)} failed run(s) in {args.new}", file=sys.stderr)
+    if regressions or failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
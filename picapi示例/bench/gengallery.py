@@ -0,0 +1,173 @@
+"""
+合成测试图库：多级分类目录 + 极小的 JPEG/PNG（只用标准库拼字节），每张带随机的 XMP dc:subject 标签（中英混合）。
+
+    python -m bench.gengallery /tmp/bench/gallery --count 100000
+
+同一组参数重复运行会跳过（目录下有 .bench-gallery.json 记录参数）；文件内容各不相同（带序号注释），
+这样 picapi 的内容指纹不会撞车。评分历史在图片入库之后由 seed_ratings() 直接写库。
+"""
+import argparse
+import json
+import math
+import random
+import struct
+import time
+import zlib
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+TAGS_ZH = ["猫", "狗", "风景", "人像", "夜景", "海边", "雪山", "城市", "花", "美食", "动漫", "壁纸",
+           "天空", "森林", "街拍", "复古", "黑白", "日落", "樱花", "建筑"]
+TAGS_EN = ["cat", "dog", "landscape", "portrait", "night", "beach", "mountain", "city", "flower", "food",
+           "anime", "wallpaper", "sky", "forest", "street", "retro", "bw", "sunset", "sakura", "architecture"]
+TOP_CATS = ["风景", "人像", "壁纸", "动漫", "wallpapers", "photos", "misc", "收藏"]
+
+# 8x8 灰色基线 JPEG（SOI 之后的全部段），生成时在 SOI 后插入 APP1(XMP) 与 COM(序号)
+_JPEG_BODY = bytes.fromhex(
+    "ffe000104a46494600010100000100010000ffdb004300100b0c0e0c0a100e0d0e1211101318281a181616183123251d28"
+    "3a333d3c3933383740485c4e404457453738506d51575f626768673e4d71797064785c656763ffc0000b080008000801011100"
+    "ffc4001f0000010501010101010100000000000000000102030405060708090a0bffc400b51000020103030204030505040400"
+    "00017d01020300041105122131410613516107227114328191a1082342b1c11552d1f02433627282090a161718191a2526272829"
+    "2a3435363738393a434445464748494a535455565758595a636465666768696a737475767778797a838485868788898a92939495"
+    "969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2"
+    "f3f4f5f6f7f8f9faffda0008010100003f002bffd9"
+)
+_XMP_NS = "http://ns.adobe.com/xap/1.0/\x00"
+
+
+def xmp_packet(tags) -> bytes:
+    items = "".join(f"<rdf:li>{escape(t)}</rdf:li>" for t in tags)
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f"<dc:subject><rdf:Bag>{items}</rdf:Bag></dc:subject>"
+        "</rdf:Description></rdf:RDF></x:xmpmeta>"
+        '<?xpacket end="w"?>'
+    ).encode("utf-8")
+
+
+def make_jpeg(tags, serial: int) -> bytes:
+    app1 = _XMP_NS.encode() + xmp_packet(tags)
+    com = f"bench#{serial}".encode()
+    return (b"\xff\xd8"
+            + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+            + b"\xff\xfe" + struct.pack(">H", len(com) + 2) + com
+            + _JPEG_BODY)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def make_png(tags, serial: int) -> bytes:
+    w = h = 8
+    shade = serial % 256
+    raw = b"".join(b"\x00" + bytes([shade]) * w for _ in range(h))
+    # XMP 放在 iTXt "XML:com.adobe.xmp"（未压缩），exiftool 读得到
+    itxt = b"XML:com.adobe.xmp\x00\x00\x00\x00\x00" + xmp_packet(tags)
+    return (b"\x89PNG\r\n\x1a\n"
+            + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 0, 0, 0, 0))
+            + _png_chunk(b"iTXt", itxt)
+            + _png_chunk(b"tEXt", b"Comment\x00" + f"bench#{serial}".encode())
+            + _png_chunk(b"IDAT", zlib.compress(raw))
+            + _png_chunk(b"IEND", b""))
+
+
+def _random_tags(rng: random.Random):
+    n = rng.randint(0, 5)
+    pool = TAGS_ZH if rng.random() < 0.6 else TAGS_EN
+    tags = rng.sample(pool, min(n, len(pool)))
+    if rng.random() < 0.2:   # 少量中英混排
+        tags.append(rng.choice(TAGS_EN if pool is TAGS_ZH else TAGS_ZH))
+    return tags
+
+
+def _dir_layout(count: int, rng: random.Random):
+    """每个末级目录约 200 张：顶层分类 × 二级 × 三级，层数随规模增加"""
+    leaves = max(1, count // 200)
+    per_top = max(1, math.ceil(leaves / len(TOP_CATS)))
+    fan = max(1, math.ceil(math.sqrt(per_top)))
+    dirs = []
+    for top in TOP_CATS:
+        for i in range(fan):
+            for j in range(fan):
+                dirs.append(f"{top}/{rng.choice(TAGS_ZH + TAGS_EN)}_{i:02d}/批次{j:02d}")
+                if len(dirs) >= leaves:
+                    return dirs
+    return dirs
+
+
+def generate(root: Path, count: int, seed: int = 42, png_ratio: float = 0.25) -> dict:
+    """生成图库；参数没变则直接返回上次的记录"""
+    root = Path(root)
+    marker = root / ".bench-gallery.json"
+    params = {"count": count, "seed": seed, "png_ratio": png_ratio}
+    if marker.exists():
+        info = json.loads(marker.read_text(encoding="utf-8"))
+        if info.get("params") == params:
+            return info
+    rng = random.Random(seed)
+    t0 = time.time()
+    dirs = _dir_layout(count, rng)
+    made = set()
+    total_bytes = 0
+    for serial in range(count):
+        d = root / dirs[serial % len(dirs)]
+        if d not in made:
+            d.mkdir(parents=True, exist_ok=True)
+            made.add(d)
+        tags = _random_tags(rng)
+        if rng.random() < png_ratio:
+            data, ext = make_png(tags, serial), ".png"
+        else:
+            data, ext = make_jpeg(tags, serial), ".jpg"
+        (d / f"img_{serial:07d}{ext}").write_bytes(data)
+        total_bytes += len(data)
+    info = {"params": params, "files": count, "dirs": len(dirs), "bytes": total_bytes,
+            "took_s": round(time.time() - t0, 2)}
+    marker.write_text(json.dumps(info, ensure_ascii=False), encoding="utf-8")
+    return info
+
+
+def seed_ratings(conn, rated_ratio: float = 0.3, max_per_image: int = 20, days: int = 90, seed: int = 7,
+                 refresh=None) -> int:
+    """
+    给已入库的一部分图片写入评分历史（ratings），并按历史回填 images 的 cnt/avg；
+    refresh(conn) 由调用方传入（picapi 的聚合回填：直方图/汇总表/贝叶斯均分）。返回写入的评分条数。
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    ids = [r[0] for r in conn.execute("SELECT id FROM images")]
+    picked = rng.sample(ids, int(len(ids) * rated_ratio))
+    rows, updates = [], []
+    for iid in picked:
+        scores = [round(rng.triangular(0, 5, 3.5) * 2) / 2 for _ in range(rng.randint(1, max_per_image))]
+        rows.extend((iid, s, None, now - rng.randint(0, days * 86400)) for s in scores)
+        updates.append((len(scores), sum(scores) / len(scores), iid))
+        if len(rows) >= 50000:
+            conn.executemany("INSERT INTO ratings(image_id, score, note, ts) VALUES (?,?,?,?)", rows)
+            rows.clear()
+    conn.executemany("INSERT INTO ratings(image_id, score, note, ts) VALUES (?,?,?,?)", rows)
+    conn.executemany("UPDATE images SET cnt=?, avg=? WHERE id=?", updates)
+    n, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(score), 0) FROM ratings").fetchone()
+    conn.execute("UPDATE meta SET value=? WHERE key='ratings_n'", (n,))
+    conn.execute("UPDATE meta SET value=? WHERE key='ratings_sum'", (total,))
+    if refresh is not None:
+        refresh(conn)
+    conn.commit()
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description="generate a synthetic gallery for picapi benchmarks")
+    ap.add_argument("root")
+    ap.add_argument("--count", type=int, default=10000)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--png-ratio", type=float, default=0.25)
+    args = ap.parse_args()
+    print(json.dumps(generate(Path(args.root), args.count, args.seed, args.png_ratio), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+picapi 基准测试：按规模生成合成图库 → 入库 → 预置评分历史 → 逐个接口压测，结果写成 JSON。
+
+    cd picapi示例
+    python -m bench.run --sizes 10000,100000 --out bench-$(date +%F).json
+    python -m bench.compare old.json new.json          # 对比两次结果，p95 退步超过阈值时退出码为 1
+
+每个规模在独立子进程里跑（app.py 在导入时读环境变量），接口经 FastAPI TestClient 在进程内调用，
+测的是服务端处理耗时，不含网络。需要 httpx（TestClient 依赖）；没装 exiftool 时跳过 sync_subjects。
+/rate 默认不写回 XMP（WRITE_META_MIN_COUNT 调到极大），只测数据库路径；加 --write-meta 连 exiftool 一起测。
+"""
+import argparse
+import html
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from .gengallery import TAGS_EN, TAGS_ZH, generate, seed_ratings
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+
+def summarize(samples_ms, wall_s: float, errors: int = 0) -> dict:
+    s = sorted(samples_ms)
+    n = len(s)
+
+    def pct(p: float) -> float:
+        return round(s[min(n - 1, max(0, math.ceil(p / 100 * n) - 1))], 3) if n else 0.0
+
+    return {
+        "count": n,
+        "errors": errors,
+        "wall_s": round(wall_s, 3),
+        "throughput_rps": round(n / wall_s, 1) if wall_s > 0 else None,
+        "mean_ms": round(sum(s) / n, 3) if n else 0.0,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+        "max_ms": round(s[-1], 3) if n else 0.0,
+    }
+
+
+def bench_loop(call, n: int, before=None) -> dict:
+    """call() 返回 Response；状态码 >= 400 计为错误。before() 在每次计时前调用（如清缓存）"""
+    call()   # 预热一次，不计入
+    samples, errors = [], 0
+    t_wall = time.perf_counter()
+    for _ in range(n):
+        if before is not None:
+            before()
+        t0 = time.perf_counter()
+        r = call()
+        samples.append((time.perf_counter() - t0) * 1000)
+        if r.status_code >= 400:
+            errors += 1
+    return summarize(samples, time.perf_counter() - t_wall, errors)
+
+
+def bench_once(call) -> dict:
+    """只跑一次的重活（reindex、重建 FTS…）：非 2xx 说明接口坏了，耗时没有意义，直接让这一轮失败"""
+    t0 = time.perf_counter()
+    r = call()
+    dt = time.perf_counter() - t0
+    if not 200 <= r.status_code < 300:
+        raise RuntimeError(f"{r.request.method} {r.request.url.path} -> HTTP {r.status_code}: {r.text[:200]}")
+    out = summarize([dt * 1000], dt)
+    try:
+        out["response"] = r.json()
+    except ValueError:
+        pass
+    return out
+
+
+_XMP_LI = re.compile(rb"<rdf:li>(.*?)</rdf:li>")
+
+
+def _seed_tags_from_xmp(app, gallery: Path) -> int:
+    """没有 exiftool 时的替代：直接从生成器写进去的 XMP 包里取标签入库（不计时，只为让 q/search 有真实命中）"""
+    n = 0
+    with app.db() as conn:
+        for (rel,) in conn.execute("SELECT relpath FROM images").fetchall():
+            with open(gallery / rel, "rb") as f:
+                head = f.read(4096)
+            app._upsert_tags(conn, rel, [html.unescape(t.decode("utf-8")) for t in _XMP_LI.findall(head)])
+            n += 1
+        app._bump_gen(conn)
+        conn.commit()
+    return n
+
+
+def _load_app(base: Path, write_meta: bool):
+    db_dir = base / "db"
+    shutil.rmtree(db_dir, ignore_errors=True)
+    db_dir.mkdir(parents=True)
+    os.environ.update({
+        "GALLERY_DIR": str(base / "gallery"),
+        "DB_PATH": str(db_dir / "picapi.sqlite"),
+        "RUN_DIR": str(db_dir),
+        "DERIV_DIR": str(db_dir / "deriv"),
+        "INDEX_SNAPSHOT_PATH": str(db_dir / "gallery.idx"),
+        "WATCH": "off",
+    })
+    if not write_meta:
+        os.environ["WRITE_META_MIN_COUNT"] = str(10 ** 9)
+    spec = importlib.util.spec_from_file_location("picapi_app", APP_DIR / "app.py")
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules["picapi_app"] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def run_one(size: int, work: Path, n_req: int, rated_ratio: float, write_meta: bool) -> dict:
+    from fastapi.testclient import TestClient
+
+    base = work / f"n{size}"
+    t0 = time.time()
+    gallery = generate(base / "gallery", size)
+    gen_s = time.time() - t0
+    app = _load_app(base, write_meta)
+    rng = random.Random(1)
+    tags = TAGS_ZH + TAGS_EN
+    res: dict = {}
+
+    with TestClient(app.app) as c:
+        res["reindex"] = bench_once(lambda: c.post("/reindex", json=False))
+
+        t0 = time.perf_counter()
+        with app.db() as conn:
+            def refresh(conn):
+                app._backfill_rating_aggregates(conn)
+                app._refresh_bayes(conn)
+                app._bump_gen(conn)
+            n_ratings = seed_ratings(conn, rated_ratio=rated_ratio, refresh=refresh)
+        seed_s = time.perf_counter() - t0
+
+        res["rebuild_fts"] = bench_once(lambda: c.post("/admin/rebuild_fts", params={"full": "true"}))
+        if shutil.which("exiftool"):
+            res["sync_subjects"] = bench_once(lambda: c.post("/sync_subjects", params={"limit": 0}))
+        else:
+            res["sync_subjects"] = {"skipped": "exiftool not found",
+                                    "tags_seeded_from_xmp": _seed_tags_from_xmp(app, base / "gallery")}
+        # 小规模时不是每个顶层分类都有图：只从实际存在的目录里挑
+        cats = sorted(p.name for p in (base / "gallery").iterdir() if p.is_dir())
+
+        for bias in ("off", "min", "weighted"):
+            res[f"random_pic[bias={bias}]"] = bench_loop(lambda: c.get("/random_pic", params={"bias": bias}), n_req)
+        res["random_pic[cat]"] = bench_loop(lambda: c.get("/random_pic", params={"cat": rng.choice(cats)}), n_req)
+        res["random_pic[q]"] = bench_loop(lambda: c.get("/random_pic", params={"q": rng.choice(tags)}), n_req)
+        res["random_pic[tag]"] = bench_loop(
+            lambda: c.get("/random_pic", params={"tag": f"{rng.choice(tags)}|{rng.choice(tags)} -{rng.choice(tags)}"}), n_req)
+        res["random_pic[scope]"] = bench_loop(lambda: c.get("/random_pic", params={"scope": "bench"}), n_req)
+        res["random_pics[n=9]"] = bench_loop(lambda: c.get("/random_pics", params={"n": 9}), max(1, n_req // 4))
+        res["search"] = bench_loop(lambda: c.get("/search", params={"q": rng.choice(tags), "limit": 20}), n_req)
+
+        ids = [r[0] for r in app.db().execute("SELECT id FROM images ORDER BY RANDOM() LIMIT 5000")]
+        res["rate"] = bench_loop(
+            lambda: c.post("/rate", json={"id": rng.choice(ids), "score": rng.choice([1, 2, 3, 4, 5])}), n_req)
+
+        res["dirs"] = bench_loop(lambda: c.get("/dirs", params={"path": rng.choice(cats)}), n_req)
+        res["dirs[uncached]"] = bench_loop(lambda: c.get("/dirs", params={"path": rng.choice(cats)}),
+                                           max(1, n_req // 10), before=app._dirs_cache.clear)
+        res["stats[top=50]"] = bench_loop(lambda: c.get("/stats", params={"top": 50}), n_req)
+
+    return {
+        "size": size,
+        "gallery": {**gallery, "generate_s": round(gen_s, 2)},
+        "ratings_seeded": n_ratings,
+        "seed_ratings_s": round(seed_s, 2),
+        "rss_max_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "results": res,
+    }
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main():
+    ap = argparse.ArgumentParser(description="picapi benchmarks on a synthetic gallery")
+    ap.add_argument("--sizes", default="10000", help="逗号分隔的图片数量，如 10000,100000,1000000")
+    ap.add_argument("--work", default="/tmp/picapi-bench", help="合成图库与临时数据库放这里（图库会复用）")
+    ap.add_argument("--requests", type=int, default=300, help="每个接口压多少次")
+    ap.add_argument("--rated", type=float, default=0.3, help="有评分历史的图片比例")
+    ap.add_argument("--write-meta", action="store_true", help="/rate 时真的写回 XMP（需要 exiftool）")
+    ap.add_argument("--out", default="", help="结果 JSON 路径；不给则打印到标准输出")
+    ap.add_argument("--one", type=int, default=0, help=argparse.SUPPRESS)   # 子进程模式
+    args = ap.parse_args()
+    work = Path(args.work).resolve()
+
+    if args.one:
+        print(json.dumps(run_one(args.one, work, args.requests, args.rated, args.write_meta), ensure_ascii=False))
+        return
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "requests": args.requests,
+            "rated": args.rated,
+            "write_meta": args.write_meta,
+        },
+        "runs": [],
+    }
+    for size in [int(x) for x in args.sizes.split(",") if x.strip()]:
+        print(f"[bench] size={size} …", file=sys.stderr)
+        cmd = [sys.executable, "-m", "bench.run", "--one", str(size), "--work", str(work),
+               "--requests", str(args.requests), "--rated", str(args.rated)]
+        if args.write_meta:
+            cmd.append("--write-meta")
+        proc = subprocess.run(cmd, cwd=APP_DIR, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr, file=sys.stderr)
+            report["runs"].append({"size": size, "error": proc.stderr.strip().splitlines()[-1:]})
+            continue
+        report["runs"].append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+        print(f"[bench] wrote {args.out}", file=sys.stderr)
+    else:
+        print(text)
+    if any("error" in run for run in report["runs"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+重新生成 pinyin.txt（picapi 拼音/首字母检索用的离线拼音表）。只有维护者更新表时才需要 pypinyin，运行 picapi 不需要。
+
+    pip install pypinyin
+    python gen_pinyin_table.py            # 写到 app.py 旁边的 pinyin.txt
+
+格式（纯文本，UTF-8）：
+- 以 # 开头的是注释
+- 每行 “拼音 字字字…”：这些字的首选读音；以 * 开头的行是多音字的其他读音（每个字最多再记 2 个）
+- 拼音不带声调，ü 写作 v（lv、nv），与输入法习惯一致
+"""
+import argparse
+from pathlib import Path
+
+LO, HI = 0x4E00, 0x9FFF      # CJK 统一汉字基本区，常用字都在这里
+MAX_READINGS = 3
+
+
+def build():
+    import pypinyin
+    from pypinyin import Style, pinyin
+
+    primary, extra = {}, {}
+    for cp in range(LO, HI + 1):
+        ch = chr(cp)
+        got = pinyin(ch, style=Style.NORMAL, heteronym=True, errors="ignore")   # 没有读音的字返回 []
+        readings = []
+        for r in (got[0] if got else []):
+            r = r.strip().lower().replace("ü", "v")
+            if r.isascii() and r.isalpha() and r not in readings:
+                readings.append(r)
+        if not readings:
+            continue
+        primary.setdefault(readings[0], []).append(ch)
+        for r in readings[1:MAX_READINGS]:
+            extra.setdefault(r, []).append(ch)
+    return pypinyin.__version__, primary, extra
+
+
+def main():
+    ap = argparse.ArgumentParser(description="regenerate the offline pinyin table for picapi")
+    ap.add_argument("--out", default=str(Path(__file__).with_name("pinyin.txt")))
+    args = ap.parse_args()
+    version, primary, extra = build()
+    lines = [
+        "# 汉字 → 拼音（不带声调，ü 写作 v），picapi 的拼音/首字母检索用；格式见 gen_pinyin_table.py",
+        f"# 由 gen_pinyin_table.py 从 pypinyin {version}（MIT License）的读音数据生成，范围 U+{LO:04X}–U+{HI:04X}",
+    ]
+    lines += [f"{py} {''.join(chars)}" for py, chars in sorted(primary.items())]
+    lines += [f"*{py} {''.join(chars)}" for py, chars in sorted(extra.items())]
+    Path(args.out).write_text("\n".join(lines) + "\n", encoding="utf-8")
+    n = sum(len(c) for c in primary.values())
+    print(f"wrote {args.out}: {n} chars, {len(primary)} syllables, {sum(len(c) for c in extra.values())} extra readings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+本机起一套 primary + N 个只读副本，用来测试副本模式（不需要 docker）：
+
+    python run_cluster.py --gallery /data/gallery --data ./cluster-data --replicas 2
+
+- primary 监听 --port，副本依次 +1、+2 …；每个进程有自己的 DB_PATH / RUN_DIR，图库目录共用
+- 副本每 --pull-interval 秒向 primary 拉一次快照
+- 启动后打印插件可用的 PICAPI_URL（第一个是 primary，负责写；其余参与读请求的最低延迟选择）
+- Ctrl+C 一起停掉
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+
+
+def _wait_ready(url: str, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/admin/replica", timeout=2):
+                return True
+        except OSError:
+            time.sleep(0.3)
+    return False
+
+
+def _spawn(name: str, port: int, env: dict, workers: int) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning"]
+    print(f"[cluster] start {name} on :{port}")
+    return subprocess.Popen(cmd, cwd=str(HERE), env=env)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="local primary + replicas for picapi")
+    ap.add_argument("--gallery", default=os.environ.get("GALLERY_DIR", "/data/gallery"))
+    ap.add_argument("--data", default="./cluster-data", help="每个实例的库/运行目录放在这下面")
+    ap.add_argument("--replicas", type=int, default=2)
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--workers", type=int, default=1, help="每个实例的 uvicorn worker 数")
+    ap.add_argument("--pull-interval", type=float, default=5.0)
+    args = ap.parse_args()
+
+    data = Path(args.data).resolve()
+    primary_url = f"http://127.0.0.1:{args.port}"
+    procs = []
+
+    def env_for(name: str, **extra) -> dict:
+        d = data / name
+        d.mkdir(parents=True, exist_ok=True)
+        env = dict(os.environ, GALLERY_DIR=str(Path(args.gallery).resolve()),
+                   DB_PATH=str(d / "picapi.sqlite"), RUN_DIR=str(d),
+                   DERIV_DIR=str(data / "deriv"), INDEX_SNAPSHOT_PATH=str(d / "gallery.idx"))
+        env.update(extra)
+        return env
+
+    try:
+        procs.append(_spawn("primary", args.port, env_for("primary", PICAPI_ROLE="primary"), args.workers))
+        if not _wait_ready(primary_url, 60):
+            raise SystemExit("[cluster] primary did not come up")
+        urls = [primary_url]
+        for i in range(1, args.replicas + 1):
+            port = args.port + i
+            env = env_for(f"replica{i}", PICAPI_ROLE="replica", PRIMARY_URL=primary_url,
+                          REPLICA_PULL_INTERVAL=str(args.pull_interval))
+            procs.append(_spawn(f"replica{i}", port, env, args.workers))
+            urls.append(f"http://127.0.0.1:{port}")
+        for u in urls[1:]:
+            _wait_ready(u, 60)
+        print(f"[cluster] ready. PICAPI_URL={','.join(urls)}")
+        while all(p.poll() is None for p in procs):
+            time.sleep(1)
+        print("[cluster] a process exited, shutting down")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+        for p in procs:
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+if __name__ == "__main__":
+    main()